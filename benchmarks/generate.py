@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Deterministic synthetic input data for the pipeline.
+
+Writes a project laid out like the pipeline expects:
+
+- original_files/<gene>.fasta: random codon alignments of every taxon, each
+  ending in a stop codon, with a fraction of the taxa missing (all gaps)
+- trees/original/master.tre: a random rooted tree of every taxon
+- lists/taxa/taxa_<lineage>.txt: the taxa of each lineage
+- lists/test_taxa/test_taxa_<lineage>.txt: the test taxa of each lineage
+
+Gene names are real plastid genes, so 1b_alignment_concatenator.py groups
+them. Test taxa never have missing sequences, so every gene can be fitted.
+The same arguments and seed always give byte-identical files.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import numpy as np  # Random sequences
+import typer  # CLI argument handler
+
+# Plastid genes in the order 1b_alignment_concatenator.py groups them
+GENES = ['accD', 'atpA', 'atpB', 'atpE', 'atpF', 'atpH', 'atpI', 'ccsA', 'cemA', 'clpP', 'infA', 'matK',
+         'ndhA', 'ndhB', 'ndhC', 'ndhD', 'ndhE', 'ndhF', 'ndhG', 'ndhH', 'ndhI', 'ndhJ', 'ndhK',
+         'petA', 'petB', 'petD', 'petG', 'petL', 'petN', 'psaA', 'psaB', 'psaC', 'psaI', 'psaJ', 'psbA',
+         'psbB', 'psbC', 'psbD', 'psbE', 'psbF', 'psbH', 'psbI', 'psbJ', 'psbK', 'psbL', 'psbM', 'psbN', 'psbT',
+         'rbcL', 'rpl14', 'rpl16', 'rpl2', 'rpl20', 'rpl22', 'rpl23', 'rpl32', 'rpl33', 'rpl36',
+         'rpoA', 'rpoB', 'rpoC1', 'rpoC2', 'rps11', 'rps12', 'rps14', 'rps15', 'rps16', 'rps18', 'rps19',
+         'rps2', 'rps3', 'rps4', 'rps7', 'rps8', 'ycf3', 'ycf4']
+
+STOP_CODONS = ('TAA', 'TAG', 'TGA')
+SENSE_CODONS = np.array([a + b + c for a in 'TCAG' for b in 'TCAG' for c in 'TCAG'
+                         if a + b + c not in STOP_CODONS])
+
+
+def gene_names(n_genes):
+    '''returns n_genes gene names: the plastid genes, then orf<n> for any more'''
+    return GENES[:n_genes] + [f"orf{i}" for i in range(n_genes - len(GENES))]
+
+
+def random_tree(rng, taxa):
+    '''returns a random rooted Newick tree of taxa, joining random pairs of subtrees'''
+    subtrees = [f"{taxon}:{rng.uniform(0.01, 0.2):.4f}" for taxon in taxa]
+    while len(subtrees) > 1:
+        i, j = sorted(rng.choice(len(subtrees), size=2, replace=False))
+        right = subtrees.pop(j)
+        left = subtrees.pop(i)
+        subtrees.append(f"({left},{right}):{rng.uniform(0.01, 0.2):.4f}")
+    return subtrees[0].rsplit(':', 1)[0] + ';\n'
+
+
+def random_alignment(rng, taxa, n_codons, missing, keep=()):
+    '''returns FASTA text of random codon sequences ending in a stop codon. Each taxon
+       except those in keep is missing, all gaps, with probability missing'''
+    codons = SENSE_CODONS[rng.integers(len(SENSE_CODONS), size=(len(taxa), n_codons))]
+    stops = rng.choice(STOP_CODONS, size=len(taxa))
+    absent = rng.random(len(taxa)) < missing
+    lines = []
+    for taxon, row, stop, is_absent in zip(taxa, codons, stops, absent):
+        if is_absent and taxon not in keep:
+            sequence = '-' * (3 * n_codons + 3)
+        else:
+            sequence = ''.join(row) + stop
+        lines.append(f">{taxon}\n{sequence}\n")
+    return ''.join(lines)
+
+
+def generate(out_dir, taxa=50, genes=10, lineages=2, sites=300, missing=0.1, test_taxa=3, seed=1):
+    '''
+    Write a synthetic project into out_dir.
+
+    Args:
+        out_dir (Path): Directory to write the project into.
+        taxa (int): Number of taxa in the master tree and the alignments.
+        genes (int): Number of alignments.
+        lineages (int): Number of lineages, each a random contiguous half to three quarters of the taxa.
+        sites (int): Number of codons in each alignment, before the stop codon.
+        missing (float): Probability that a taxon is missing from an alignment.
+        test_taxa (int): Number of test taxa in each lineage.
+        seed (int): Random seed.
+
+    Returns:
+        dict: The arguments, as recorded in the benchmark results.
+    '''
+    out_dir = Path(out_dir)
+    rng = np.random.default_rng(seed)
+    names = [f"T{i}" for i in range(taxa)]
+
+    lineage_taxa = {}
+    lineage_test_taxa = {}
+    for lineage in range(1, lineages + 1):
+        size = int(rng.integers(max(test_taxa + 1, taxa // 2), max(test_taxa + 2, 3 * taxa // 4 + 1)))
+        size = min(size, taxa)
+        start = int(rng.integers(0, taxa - size + 1))
+        lineage_taxa[f"L{lineage}"] = names[start:start + size]
+        lineage_test_taxa[f"L{lineage}"] = sorted(rng.choice(names[start:start + size], size=test_taxa, replace=False),
+                                                  key=names.index)
+    keep = {taxon for chosen in lineage_test_taxa.values() for taxon in chosen}
+
+    (out_dir / 'original_files').mkdir(parents=True, exist_ok=True)
+    for gene in gene_names(genes):
+        (out_dir / 'original_files' / f"{gene}.fasta").write_text(random_alignment(rng, names, sites, missing, keep))
+
+    (out_dir / 'trees' / 'original').mkdir(parents=True, exist_ok=True)
+    (out_dir / 'trees' / 'original' / 'master.tre').write_text(random_tree(rng, names))
+
+    (out_dir / 'lists' / 'taxa').mkdir(parents=True, exist_ok=True)
+    (out_dir / 'lists' / 'test_taxa').mkdir(parents=True, exist_ok=True)
+    for lineage, members in lineage_taxa.items():
+        (out_dir / 'lists' / 'taxa' / f"taxa_{lineage}.txt").write_text('\n'.join(members) + '\n')
+        (out_dir / 'lists' / 'test_taxa' / f"test_taxa_{lineage}.txt").write_text(
+            '\n'.join(lineage_test_taxa[lineage]) + '\n')
+
+    return {'taxa': taxa, 'genes': genes, 'lineages': lineages, 'sites': sites,
+            'missing': missing, 'test_taxa': test_taxa, 'seed': seed}
+
+
+def main(
+    out_dir: Path = typer.Argument(..., help="Directory to write the synthetic project into"),
+    taxa: int = typer.Option(50, help="Number of taxa"),
+    genes: int = typer.Option(10, help="Number of alignments"),
+    lineages: int = typer.Option(2, help="Number of lineages"),
+    sites: int = typer.Option(300, help="Number of codons per alignment"),
+    missing: float = typer.Option(0.1, help="Probability that a taxon is missing from an alignment"),
+    test_taxa: int = typer.Option(3, help="Number of test taxa per lineage"),
+    seed: int = typer.Option(1, help="Random seed")
+):
+    if test_taxa >= taxa // 2 or lineages < 1 or not 0 <= missing < 1:
+        typer.echo("Error: Need fewer test taxa than half the taxa, at least one lineage and 0 <= missing < 1")
+        raise typer.Exit(code=1)
+    generate(out_dir, taxa, genes, lineages, sites, missing, test_taxa, seed)
+    typer.echo(f"Synthetic project with {taxa} taxa, {genes} genes and {lineages} lineages written to {out_dir}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
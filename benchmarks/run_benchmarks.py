@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Benchmark every pipeline script on synthetic data.
+
+`run` generates a synthetic project with generate.py and runs the scripts
+on it in pipeline order, timing each one and recording its peak memory:
+
+    0a_filter-species, 0b_prune-tree, 1_trim-terminal-stops (on copies of
+    the filtered alignments), 1_preprocess, 1a_check-frame,
+    1b_alignment_concatenator, 1c_paml_prep, 2a_paml, 3b_paml_stats,
+    relax/2c_make_relax_tree, relax/2b_make_bf, relax/2d_relax (running the
+    fake hyphy on every gene), relax/3c_retrieve_relax_results,
+    and the Snakefile's DAG build (`snakemake -n`) on a fresh and on a
+    processed project.
+
+codeml and hyphy are replaced by the stand-ins in fake_bin/, which write
+canned output instantly, so the times are the Python side's alone. Results
+are written as JSON; `compare` reports the change between two result files
+and fails if any benchmark got slower than a threshold.
+
+Peak memory is the largest resident set of the script, or of any process it
+started and waited for, as reported by wait4(2).
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import Optional  # Optional arguments
+import datetime  # Timestamping results
+import json  # Results
+import os  # Running and measuring scripts
+import platform  # Recording the machine
+import shutil  # Copying and cleaning up
+import statistics  # Summarising repeats
+import subprocess  # Running scripts
+import sys  # The Python interpreter to run scripts with
+import tempfile  # Default working directory
+import time  # Timing
+import typer  # CLI argument handler
+from generate import generate  # Synthetic data
+
+app = typer.Typer()
+
+REPO = Path(__file__).resolve().parents[1]
+SCRIPTS = REPO / 'scripts'
+FAKE_BIN = Path(__file__).resolve().parent / 'fake_bin'
+
+
+def run_timed(command, cwd, env):
+    '''runs a command and returns (wall seconds, peak resident set in MB, exit code, last lines of stderr)'''
+    with tempfile.TemporaryFile() as stderr:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr.seek(0)
+        error = stderr.read().decode(errors='replace').strip().splitlines()[-3:]
+    return seconds, usage.ru_maxrss / 1024, process.returncode, '\n'.join(error)
+
+
+def fake_binaries(bin_dir):
+    '''fills bin_dir with the fake codeml and hyphy, and returns the environment to run scripts in.
+       ete3 looks for codeml next to its own executable, so that is linked in as well'''
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    links = {'codeml': FAKE_BIN / 'codeml', 'hyphy': FAKE_BIN / 'hyphy', 'hyphymp': FAKE_BIN / 'hyphy'}
+    ete3 = shutil.which('ete3')
+    if ete3 is not None:
+        links['ete3'] = Path(ete3)
+    for name, target in links.items():
+        link = bin_dir / name
+        if link.is_symlink() or link.exists():
+            link.unlink()
+        link.symlink_to(target)
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+    env.pop('PYTHONPATH', None)
+    return env
+
+
+def lineages_of(work):
+    return sorted(path.stem[len('taxa_'):] for path in (work / 'lists' / 'taxa').glob('taxa_*.txt'))
+
+
+def relax_dirs(work):
+    '''returns the relax/<lineage>/<gene> directories with their alignment, tree and test taxa,
+       copying the preprocessed alignments in as <gene>_<lineage>_bench.fasta the first time'''
+    dirs = []
+    for lineage in lineages_of(work):
+        for alignment in sorted((work / 'alignments' / lineage).glob('*_gaps_trimmed.fasta')):
+            gene = alignment.name.split('_')[0]
+            gene_dir = work / 'relax' / lineage / gene
+            name = f"{gene}_{lineage}_bench.fasta"
+            if not (gene_dir / name).exists():
+                gene_dir.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(alignment, gene_dir / name)
+            dirs.append((gene_dir, name, work / 'trees' / lineage / f"master_{lineage}.tre",
+                         work / 'lists' / 'test_taxa' / f"test_taxa_{lineage}.txt"))
+    return dirs
+
+
+def stop_trim_copies(work):
+    '''copies the filtered alignments to stops_trimmed/<lineage>/, as 1_trim-terminal-stops.py deletes its input,
+       and returns the (copy, output) pairs to trim'''
+    pairs = []
+    for alignment in sorted((work / 'filtered').glob('*/*_filtered.fasta')):
+        out_dir = work / 'stops_trimmed' / alignment.parent.name
+        out_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(alignment, out_dir / alignment.name)
+        pairs.append((out_dir / alignment.name,
+                      out_dir / alignment.name.replace('_filtered.fasta', '_stops_trimmed.fasta')))
+    return pairs
+
+
+def stages(work, dag_dir, paml_groups, paml_test):
+    '''returns (benchmark name, function returning the (command, working directory) pairs to run)
+       for every benchmark, in pipeline order. The function is called again before every repeat'''
+    python = sys.executable
+    lineages = lineages_of(work)
+    sources = sorted(str(path.relative_to(work)) for path in (work / 'original_files').glob('*.fasta'))
+
+    def paml_group_dirs():
+        groups = sorted(path for lineage in lineages for path in (work / 'paml' / lineage).iterdir() if path.is_dir())
+        return groups[:paml_groups] if paml_groups is not None else groups
+
+    def snakemake(directory):
+        return [(['snakemake', '-n', '--quiet', '--snakefile', str(REPO / 'Snakefile')], directory)]
+
+    return [
+        ('0a_filter-species', lambda: [
+            ([python, SCRIPTS / '0a_filter-species.py', source, '--taxa-dir', 'lists/taxa', '--out-dir', 'filtered'], work)
+            for source in sources]),
+        ('0b_prune-tree', lambda: [
+            ([python, SCRIPTS / '0b_prune-tree.py', 'trees/original/master.tre', '--taxa-dir', 'lists/taxa',
+              '--out-dir', 'trees'], work)]),
+        ('1_trim-terminal-stops', lambda: [
+            ([python, SCRIPTS / '1_trim-terminal-stops.py', alignment, out_path], work)
+            for alignment, out_path in stop_trim_copies(work)]),
+        ('1_preprocess', lambda: [
+            ([python, SCRIPTS / '1_preprocess.py', *sources, '--taxa', f"lists/taxa/taxa_{lineage}.txt",
+              '--out-dir', f"alignments/{lineage}"], work)
+            for lineage in lineages]),
+        ('1a_check-frame', lambda: [
+            ([python, SCRIPTS / '1a_check-frame.py',
+              *sorted(str(path.relative_to(work)) for path in work.glob('alignments/*/*.fasta'))], work)]),
+        ('1b_alignment_concatenator', lambda: [
+            ([python, SCRIPTS / '1b_alignment_concatenator.py'], work / 'alignments' / lineage)
+            for lineage in lineages]),
+        ('1c_paml_prep', lambda: [
+            ([python, SCRIPTS / '1c_paml_prep.py', lineage, '--taxa', f"lists/test_taxa/test_taxa_{lineage}.txt"], work)
+            for lineage in lineages]),
+        ('2a_paml', lambda: [
+            ([python, SCRIPTS / '2a_paml.py', next(group.glob('*.fasta')).name, f"../master_{group.parent.name}.tre",
+              paml_test, f"../test_taxa_{group.parent.name}.txt",
+              '--workdir', work / 'scratch' / group.parent.name / group.name, '--db', work / 'results.sqlite'], group)
+            for group in paml_group_dirs()]),
+        ('3b_paml_stats', lambda: [
+            ([python, SCRIPTS / '3b_paml_stats.py', 'results.sqlite'], work)]),
+        ('relax/2c_make_relax_tree', lambda: [
+            ([python, SCRIPTS / 'relax' / '2c_make_relax_tree.py', tree,
+              *[gene_dir / name for gene_dir, name, gene_tree, _ in relax_dirs(work) if gene_tree == tree], test_taxa], work)
+            for tree, test_taxa in dict.fromkeys((tree, test_taxa) for _, _, tree, test_taxa in relax_dirs(work))]),
+        ('relax/2b_make_bf', lambda: [
+            ([python, SCRIPTS / 'relax' / '2b_make_bf.py', name], gene_dir)
+            for gene_dir, name, _, _ in relax_dirs(work)]),
+        ('relax/2d_relax (fake hyphy)', lambda: [
+            ([python, SCRIPTS / 'relax' / '2d_relax.py', 'relax', '--hyphy', 'hyphy', '--force'], work)]),
+        ('relax/3c_retrieve_relax_results', lambda: [
+            ([python, SCRIPTS / 'relax' / '3c_retrieve_relax_results.py', 'relax', '--db', 'results.sqlite'], work)]),
+        ('snakemake DAG (fresh project)', lambda: snakemake(dag_dir)),
+        ('snakemake DAG (processed project)', lambda: snakemake(work)),
+    ]
+
+
+def run_benchmark(name, commands, env, repeat):
+    '''runs the commands one benchmark's function returns repeat times and returns its result record'''
+    times, peaks, failures, error, calls = [], [], 0, '', 0
+    for _ in range(repeat):
+        total = 0.0
+        listed = commands()
+        calls = len(listed)
+        for command, cwd in listed:
+            seconds, peak, code, stderr = run_timed([str(part) for part in command], cwd, env)
+            total += seconds
+            peaks.append(peak)
+            if code != 0:
+                failures += 1
+                error = stderr
+        times.append(total)
+    return {
+        'name': name,
+        'calls': calls,
+        'seconds': min(times) if times else 0.0,
+        'median_seconds': statistics.median(times) if times else 0.0,
+        'all_seconds': times,
+        'peak_rss_mb': max(peaks) if peaks else 0.0,
+        'failed_calls': failures,
+        'error': error,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def run(
+    out_file: Path = typer.Option(Path('benchmark_results.json'), "--out", help="JSON file to write the results to"),
+    work_dir: Optional[Path] = typer.Option(None, help="Directory to generate and process the project in. "
+                                                       "Defaults to a temporary directory that is removed afterwards"),
+    taxa: int = typer.Option(50, help="Number of taxa"),
+    genes: int = typer.Option(10, help="Number of alignments"),
+    lineages: int = typer.Option(2, help="Number of lineages"),
+    sites: int = typer.Option(300, help="Number of codons per alignment"),
+    missing: float = typer.Option(0.1, help="Probability that a taxon is missing from an alignment"),
+    seed: int = typer.Option(1, help="Random seed of the synthetic data"),
+    repeat: int = typer.Option(1, help="Number of times to run each benchmark; the fastest run is reported"),
+    paml_groups: Optional[int] = typer.Option(None, help="Only fit this many gene groups with 2a_paml.py"),
+    paml_test: str = typer.Option('branch', help="Test 2a_paml.py runs: branch, bsA, cmD or cmC"),
+    only: Optional[str] = typer.Option(None, help="Comma-separated benchmark names to keep in the results; "
+                                                  "the other stages still run to prepare their inputs")
+):
+    """Generate a synthetic project and benchmark every pipeline stage on it."""
+    temporary = work_dir is None
+    root = Path(tempfile.mkdtemp(prefix='selection_bench_')) if temporary else work_dir
+    if not temporary and root.exists() and any(root.iterdir()):
+        typer.echo(f"Error: {root} is not empty")
+        raise typer.Exit(code=1)
+    work = root / 'project'
+    dag_dir = root / 'fresh'
+    try:
+        data = generate(work, taxa, genes, lineages, sites, missing, seed=seed)
+        generate(dag_dir, taxa, genes, lineages, sites, missing, seed=seed)
+        for directory in (work, dag_dir):
+            (directory / 'scripts').symlink_to(SCRIPTS)  # the Snakefile imports from scripts/
+        env = fake_binaries(root / 'bin')
+
+        kept = set(only.split(',')) if only else None
+        results = []
+        for name, commands in stages(work, dag_dir, paml_groups, paml_test):
+            if name.startswith('snakemake') and shutil.which('snakemake', path=env['PATH']) is None:
+                typer.echo(f"{name:<36} skipped, snakemake is not installed")
+                continue
+            result = run_benchmark(name, commands, env, repeat)
+            if kept is None or name in kept:
+                results.append(result)
+            status = f"{result['failed_calls']} FAILED" if result['failed_calls'] else 'ok'
+            typer.echo(f"{name:<36} {result['calls']:>5} calls {result['seconds']:>9.3f} s "
+                       f"{result['peak_rss_mb']:>8.1f} MB  {status}")
+            if result['failed_calls']:
+                typer.echo(f"    {result['error']}")
+    finally:
+        if temporary:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'data': data,
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+    out_file.write_text(json.dumps(report, indent=2) + '\n')
+    typer.echo(f"Results written to {out_file}")
+    if any(result['failed_calls'] for result in results):
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., help="Results of the baseline run"),
+    current: Path = typer.Argument(..., help="Results of the run to compare"),
+    threshold: float = typer.Option(1.2, help="Ratio of current to baseline time above which a benchmark "
+                                              "counts as a regression")
+):
+    """Compare the times and peak memory of two benchmark runs."""
+    before = {result['name']: result for result in json.loads(baseline.read_text())['benchmarks']}
+    after = {result['name']: result for result in json.loads(current.read_text())['benchmarks']}
+    regressions = []
+    for name, result in after.items():
+        if name not in before:
+            continue
+        ratio = result['seconds'] / before[name]['seconds'] if before[name]['seconds'] else float('inf')
+        memory = result['peak_rss_mb'] / before[name]['peak_rss_mb'] if before[name]['peak_rss_mb'] else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        typer.echo(f"{name:<36} {before[name]['seconds']:>9.3f} s -> {result['seconds']:>9.3f} s "
+                   f"({ratio:>5.2f}x time, {memory:>5.2f}x memory){flag}")
+    if regressions:
+        typer.echo(f"{len(regressions)} benchmarks slower than {threshold}x the baseline")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
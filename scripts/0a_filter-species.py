@@ -1,68 +1,128 @@
 #!/usr/bin/env python3
 
 from pathlib import Path  # Manipulating filenames
-from Bio import SeqIO  # Reading DNA sequences
-from Bio.SeqRecord import SeqRecord  # Create an empty sequence if the species is missing
-from Bio.Seq import Seq  # Create an empty sequence if the species is missing
-import sys # Retrieve output directory from Snakemake
+from typing import Optional  # Arguments only used by one of the two modes
 import typer  # CLI argument handler
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from instrument import timed  # Timing records
 
-def main(
-    alignment_file: Path = typer.Argument(
-        ..., help="Path to the alignment file."
-    ),
-    wanted_species_file: Path = typer.Argument(
-        ..., help="Path to the file containing species to filter down to."
-    ),
-    out_path: Path = typer.Argument(
-        ..., help="Path to the output directory."
-    )
-):
-    # Retrieve clade and alignment names for output
+
+def get_clade_name(wanted_species_file: Path) -> str:
+    """Return the clade name from a taxa_<clade>.txt filename."""
     try:
-        clade_name = wanted_species_file.stem.split('_')[1]
+        return wanted_species_file.stem.split('_', 1)[1]
     except IndexError:
         typer.echo("Error: The wanted_species_file is formatted incorrectly, it needs to be taxa_*.txt")
         raise typer.Exit(code=1)
-    
-    alignment_name = alignment_file.stem
-    alignment_format = alignment_file.suffix.lstrip('.')
-    out_filename = f"{alignment_name}_{clade_name}_filtered.{alignment_format}"
-    output_path_filename = sys.argv[3]
 
-    # Read in the wanted species names
+
+def read_species_list(wanted_species_file: Path) -> list:
+    """Read the wanted species names, one per line, keeping their order."""
     wanted_species_names = []
     with wanted_species_file.open('r') as species_file:
         for line in species_file:
             name = line.strip()
             if name:
                 wanted_species_names.append(name)
-    
-    # Collect matching records
-    matching_records = []
-    sequence_length = None
-    for record in SeqIO.parse(alignment_file, 'fasta'):
-        if record.id in wanted_species_names:
-            matching_records.append(record)
-            wanted_species_names.remove(record.id)
-            sequence_length = len(record.seq)  # Get sequence length for gap sequences
-    
-    if sequence_length is None:
+    return wanted_species_names
+
+
+@timed()
+def filter_alignment(alignment_file: Path, wanted_species: dict, out_paths: dict) -> list:
+    """
+    Read an alignment once and write a filtered copy of it for every clade.
+
+    Args:
+        alignment_file (Path): Path to the source alignment.
+        wanted_species (dict): Clade name -> ordered list of wanted species names.
+        out_paths (dict): Clade name -> path of the filtered alignment to write.
+
+    Returns:
+        list: Clades for which no matching records were found. Their output
+            files are not written.
+    """
+    alignment = AlignmentMatrix.read(alignment_file, alignment_file.suffix.lstrip('.'))
+    duplicates = alignment.duplicate_ids()
+    if duplicates:
+        typer.echo(f"Warning: {alignment_file} has several records for {', '.join(duplicates)}, keeping the first of each")
+
+    failed_clades = []
+    for clade, names in wanted_species.items():
+        wanted = set(names)
+        # The index has each id once, so only the first of several records with the same id is kept
+        present = [taxon for taxon in alignment.index if taxon in wanted]
+        if not present:
+            failed_clades.append(clade)
+            out_paths[clade].unlink(missing_ok=True)
+            continue
+        # Add missing species with gap sequences
+        missing = [name for name in dict.fromkeys(names) if name not in alignment]
+        out_paths[clade].parent.mkdir(parents=True, exist_ok=True)
+        alignment.subset_rows(present).add_empty_rows(missing).write(out_paths[clade])
+    return failed_clades
+
+
+def main(
+    alignment_file: Path = typer.Argument(
+        ..., help="Path to the alignment file."
+    ),
+    wanted_species_file: Optional[Path] = typer.Argument(
+        None, help="Path to the file containing species to filter down to."
+    ),
+    out_path: Optional[Path] = typer.Argument(
+        None, help="Path to the output alignment file."
+    ),
+    taxa_dir: Optional[Path] = typer.Option(
+        None, help="Filter for every taxa_*.txt in this directory in one pass, instead of a single species file."
+    ),
+    out_dir: Path = typer.Option(
+        Path("alignments"), help="With --taxa-dir, write <out-dir>/<clade>/<alignment>_filtered.fasta for each clade."
+    )
+):
+    if taxa_dir is not None:
+        # Multi-lineage mode: the source alignment is shared, so it is kept
+        taxa_files = sorted(taxa_dir.glob("taxa_*.txt"))
+        if not taxa_files:
+            typer.echo(f"Error: No taxa_*.txt files found in {taxa_dir}")
+            raise typer.Exit(code=1)
+
+        wanted_species = {get_clade_name(f): read_species_list(f) for f in taxa_files}
+        out_paths = {
+            clade: out_dir / clade / f"{alignment_file.stem}_filtered{alignment_file.suffix}"
+            for clade in wanted_species
+        }
+        failed_clades = filter_alignment(alignment_file, wanted_species, out_paths)
+
+        for clade, path in out_paths.items():
+            if clade not in failed_clades:
+                typer.echo(f"Filtered alignment written to {path}")
+        if len(failed_clades) == len(wanted_species):
+            typer.echo(f"Error: No matching records found in {alignment_file} for any lineage")
+            raise typer.Exit(code=1)
+        # The other lineages' alignments are good, so one without any of its taxa is only skipped
+        for clade in failed_clades:
+            typer.echo(f"Warning: No matching records found in {alignment_file} for {clade}, skipping it")
+        return
+
+    if wanted_species_file is None or out_path is None:
+        typer.echo("Error: Give a wanted_species_file and out_path, or use --taxa-dir")
+        raise typer.Exit(code=1)
+
+    # Retrieve clade name for output
+    clade_name = get_clade_name(wanted_species_file)
+
+    failed_clades = filter_alignment(
+        alignment_file,
+        {clade_name: read_species_list(wanted_species_file)},
+        {clade_name: out_path}
+    )
+    if failed_clades:
         typer.echo("Error: No matching records found in the alignment file.")
         raise typer.Exit(code=1)
-    
-    # Add missing species with gap sequences
-    for name in wanted_species_names:
-        gap_seq = '-' * sequence_length
-        empty_seq = SeqRecord(Seq(gap_seq), id=name, description='')
-        matching_records.append(empty_seq)
-    
-    # Write the filtered records to a new file
-    SeqIO.write(matching_records, output_path_filename, format=alignment_format)
-    typer.echo(f"Filtered alignment written to {output_path_filename}")
-    
+    typer.echo(f"Filtered alignment written to {out_path}")
+
     # Delete the old alignment file
     alignment_file.unlink()
 
 if __name__ == "__main__":
-    typer.run(main)
\ No newline at end of file
+    typer.run(main)
@@ -1,42 +1,25 @@
 #!/usr/bin/env python3
 
 from pathlib import Path  # Manipulating filenames
+from typing import Optional  # Arguments only used by one of the two modes
 from ete3 import Tree  # Pruning trees
 import typer  # CLI argument handler
+from fit_cache import file_digest  # Hashing the tree for the cache
+from tree_cache import TreeCache, pruned_newick  # Pruning each taxon set once
+from instrument import phase  # Timing records
 
-def main(
-    tree_file: Path = typer.Argument(
-        ..., help="Path to the tree file in Newick format."
-    ),
-    taxa_to_keep_file: Path = typer.Argument(
-        ..., help="Path to the file containing taxa to keep."
-    ),
-    clade: str = typer.Argument(
-        ..., help="Name of the clade being pruned down to."
-    ),
-):
-    # Construct the output tree filename
-    tree_name = tree_file.stem
-    out_tree_filename = f"{tree_name}_{clade}.tre"
-    out_tree_path = tree_file.parent / out_tree_filename
-
-    # Read the tree
-    try:
-        full_tree = Tree(str(tree_file))
-    except Exception as e:
-        typer.echo(f"Error reading tree file '{tree_file}': {e}")
-        raise typer.Exit(code=1)
-
-    # Read the list of taxa to keep
+def read_taxa(taxa_to_keep_file: Path) -> list:
+    """Read the taxa to keep, one per line, keeping their order."""
     try:
         with taxa_to_keep_file.open('r') as taxa_list:
-            taxa_to_keep = [line.strip() for line in taxa_list if line.strip()]
+            return [line.strip() for line in taxa_list if line.strip()]
     except Exception as e:
         typer.echo(f"Error reading taxa file '{taxa_to_keep_file}': {e}")
         raise typer.Exit(code=1)
 
+def taxa_in_tree(taxa_to_keep: list, tree_leaf_names: set, clade: str) -> list:
+    """Return the taxa to keep that are in the tree, warning about the others."""
     # Check for taxa not present in the tree
-    tree_leaf_names = set(leaf.name for leaf in full_tree.get_leaves())
     missing_taxa = [taxon for taxon in taxa_to_keep if taxon not in tree_leaf_names]
     if missing_taxa:
         typer.echo(
@@ -46,22 +29,77 @@ def main(
     # Keep only taxa present in the tree
     taxa_to_keep_in_tree = [taxon for taxon in taxa_to_keep if taxon in tree_leaf_names]
     if not taxa_to_keep_in_tree:
-        typer.echo("Error: None of the taxa to keep are present in the tree.")
+        typer.echo(f"Error: None of the taxa to keep for {clade} are present in the tree.")
         raise typer.Exit(code=1)
+    return taxa_to_keep_in_tree
 
-    # Prune the tree
-    full_tree.prune(taxa_to_keep_in_tree, preserve_branch_length=True)
-
-    # Ensure the tree is unrooted
-    full_tree.unroot()
+def main(
+    tree_file: Path = typer.Argument(
+        ..., help="Path to the tree file in Newick format."
+    ),
+    taxa_to_keep_file: Optional[Path] = typer.Argument(
+        None, help="Path to the file containing taxa to keep."
+    ),
+    clade: Optional[str] = typer.Argument(
+        None, help="Name of the clade being pruned down to."
+    ),
+    taxa_dir: Optional[Path] = typer.Option(
+        None, help="Prune for every taxa_*.txt in this directory, parsing the tree once."
+    ),
+    out_dir: Path = typer.Option(
+        Path("trees"), help="With --taxa-dir, write <out-dir>/<clade>/<tree>_<clade>.tre for each clade."
+    ),
+    cache_dir: Optional[Path] = typer.Option(
+        None, help="Directory of pruned trees to reuse and add to."
+    ),
+):
+    if taxa_dir is not None:
+        # Multi-lineage mode: one pruned tree per taxa_<clade>.txt
+        taxa_files = sorted(taxa_dir.glob("taxa_*.txt"))
+        if not taxa_files:
+            typer.echo(f"Error: No taxa_*.txt files found in {taxa_dir}")
+            raise typer.Exit(code=1)
+        targets = {
+            f.stem[len("taxa_"):]: f for f in taxa_files
+        }
+        out_paths = {
+            name: out_dir / name / f"{tree_file.stem}_{name}.tre" for name in targets
+        }
+    elif taxa_to_keep_file is not None and clade is not None:
+        targets = {clade: taxa_to_keep_file}
+        out_paths = {clade: tree_file.parent / f"{tree_file.stem}_{clade}.tre"}
+    else:
+        typer.echo("Error: Give a taxa_to_keep_file and clade, or use --taxa-dir")
+        raise typer.Exit(code=1)
 
-    # Write the pruned tree to a file
+    # Read the tree once for every clade
     try:
-        full_tree.write(outfile=str(out_tree_path))
-        typer.echo(f"Pruned tree written to {out_tree_path}")
+        with phase('read_tree'):
+            full_tree = Tree(str(tree_file))
     except Exception as e:
-        typer.echo(f"Error writing pruned tree: {e}")
+        typer.echo(f"Error reading tree file '{tree_file}': {e}")
         raise typer.Exit(code=1)
+    tree_leaf_names = set(full_tree.get_leaf_names())
+    tree_cache = TreeCache(cache_dir) if cache_dir is not None else None
+    tree_digest = file_digest(tree_file) if tree_cache is not None else None
+
+    for name, taxa_file in targets.items():
+        taxa_to_keep_in_tree = taxa_in_tree(read_taxa(taxa_file), tree_leaf_names, name)
+
+        # Prune a copy of the tree and unroot it, or look it up in the cache
+        with phase('prune_tree', clade=name):
+            newick = pruned_newick(tree_file, taxa_to_keep_in_tree, cache=tree_cache,
+                                   tree=full_tree, tree_digest=tree_digest)
+
+        # Write the pruned tree to a file
+        out_tree_path = out_paths[name]
+        try:
+            out_tree_path.parent.mkdir(parents=True, exist_ok=True)
+            out_tree_path.write_text(newick)
+            typer.echo(f"Pruned tree written to {out_tree_path}")
+        except Exception as e:
+            typer.echo(f"Error writing pruned tree: {e}")
+            raise typer.Exit(code=1)
 
 if __name__ == "__main__":
-    typer.run(main)
\ No newline at end of file
+    typer.run(main)
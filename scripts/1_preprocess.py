@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several alignments per lineage
+import typer  # CLI argument handler
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from codon_check import CodonIssue, find_codon_issues, summarise_issues, write_report  # Vectorised codon checks
+from fit_cache import file_digest  # Hashing source alignments for the stage store
+from stage_store import StageStore, materialize, stage_key  # Skipping unchanged alignments
+from instrument import phase, timed  # Timing records
+
+# Bump when the preprocessing steps change, so stored outputs aren't reused
+PREPROCESS_VERSION = 1
+
+
+def filter_species(alignment: AlignmentMatrix, wanted_species_names: list):
+    """
+    Keep the wanted species and add gap sequences for the ones that are missing.
+
+    Args:
+        alignment (AlignmentMatrix): The source alignment.
+        wanted_species_names (list): Species to filter down to, in order.
+
+    Returns:
+        AlignmentMatrix: The filtered alignment, or None if no species matched.
+    """
+    wanted = set(wanted_species_names)
+    # The index has each id once, so only the first of several records with the same id is kept
+    present = [taxon for taxon in alignment.index if taxon in wanted]
+    if not present:
+        return None
+    missing = [name for name in dict.fromkeys(wanted_species_names) if name not in alignment]
+    return alignment.subset_rows(present).add_empty_rows(missing)
+
+
+def trim_terminal_stops(alignment: AlignmentMatrix) -> AlignmentMatrix:
+    """Trim the last three nucleotides (terminal stop codon) of every record."""
+    return alignment.subset_columns(slice(None, -3))
+
+
+def trim_gap_columns(alignment: AlignmentMatrix) -> AlignmentMatrix:
+    """Remove columns that are gaps in every record, like trimal -noallgaps -keepseqs."""
+    return alignment.subset_columns(~alignment.gap_columns())
+
+
+def preprocess_params(wanted_species_names: list) -> dict:
+    """Return everything besides the source alignment that the preprocessed output depends on."""
+    return {
+        'version': PREPROCESS_VERSION,
+        'taxa': list(dict.fromkeys(wanted_species_names)),
+        'steps': ['filter_species', 'trim_terminal_stops', 'trim_gap_columns'],
+        'codon_table': 1,
+    }
+
+
+@timed()
+def preprocess(alignment_file: Path, out_name: str, wanted_species_names: list):
+    """
+    Filter, trim and check the reading frame of one alignment in memory.
+
+    Returns:
+        tuple: (the preprocessed AlignmentMatrix, its CodonIssues), or None if no species matched.
+    """
+    source = AlignmentMatrix.read(alignment_file, alignment_file.suffix.lstrip('.'))
+    duplicates = source.duplicate_ids()
+    if duplicates:
+        typer.echo(f"Warning: {alignment_file} has several records for {', '.join(duplicates)}, keeping the first of each")
+    alignment = filter_species(source, wanted_species_names)
+    if alignment is None:
+        return None
+    alignment = trim_gap_columns(trim_terminal_stops(alignment))
+    return alignment, find_codon_issues(alignment, out_name)
+
+
+def main(
+    alignment_files: List[Path] = typer.Argument(
+        ..., help="Paths to the source alignment files. They are not modified."
+    ),
+    wanted_species_file: Path = typer.Option(
+        ..., "--taxa", help="Path to the file containing species to filter down to."
+    ),
+    out_dir: Path = typer.Option(
+        ..., help="Directory to write <alignment>_<lineage>_gaps_trimmed.fasta files into."
+    ),
+    issues_file: Path = typer.Option(
+        None, "--issues", help="Path to the frame diagnostics file. Defaults to <out-dir>/issues.txt."
+    ),
+    report_file: Path = typer.Option(
+        None, "--report", help="Path to the per-codon issues table. Defaults to issues.tsv next to --issues."
+    ),
+    store_dir: Optional[Path] = typer.Option(
+        None, "--store", help="Content-addressed store of preprocessed alignments. Alignments whose source "
+                              "and taxa are unchanged are taken from it, and outputs are only rewritten "
+                              "when their contents change."
+    )
+):
+    """
+    Filter species, trim terminal stops, remove all-gap columns and check the
+    reading frame of each alignment in memory, writing only the final
+    _<lineage>_gaps_trimmed alignment and the issues file. The lineage is
+    taken from the taxa_<lineage>.txt name. Alignments with none of the
+    lineage's taxa are skipped with a warning. With --store, unchanged
+    alignments are skipped and keep their modification times.
+    """
+    if not wanted_species_file.stem.startswith('taxa_'):
+        typer.echo("Error: The --taxa file is named incorrectly, it needs to be taxa_<lineage>.txt")
+        raise typer.Exit(code=1)
+    lineage = wanted_species_file.stem[len('taxa_'):]
+    if issues_file is None:
+        issues_file = out_dir / "issues.txt"
+    if report_file is None:
+        report_file = issues_file.with_suffix('.tsv')
+
+    # Read in the wanted species names
+    with wanted_species_file.open('r') as species_file:
+        wanted_species_names = [line.strip() for line in species_file if line.strip()]
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    store = StageStore(store_dir) if store_dir is not None else None
+    params = preprocess_params(wanted_species_names)
+    all_issues = []
+    for alignment_file in alignment_files:
+        alignment_format = alignment_file.suffix.lstrip('.')
+        out_path = out_dir / f"{alignment_file.stem}_{lineage}_gaps_trimmed.{alignment_format}"
+
+        stored = None
+        if store is not None:
+            key = stage_key('preprocess', file_digest(alignment_file), params)
+            stored = store.get(key)
+
+        if stored is None:
+            processed = preprocess(alignment_file, out_path.name, wanted_species_names)
+            issues = None
+            if processed is None:
+                if store is not None:
+                    store.put(key, None, {'issues': []})
+            else:
+                alignment, issues = processed
+                # Write to a temporary file first so a failed run never leaves a partial alignment
+                tmp_path = out_path.with_name(out_path.name + '.tmp')
+                alignment.write(tmp_path)
+                if store is None:
+                    tmp_path.replace(out_path)
+                    written = True
+                else:
+                    store.put(key, tmp_path, {'issues': [list(issue) for issue in issues]})
+                    # Only replace the output if its contents changed, keeping its modification time otherwise
+                    written = materialize(tmp_path, out_path)
+                    tmp_path.unlink(missing_ok=True)
+        else:
+            issues = None
+            if stored['output']:
+                # Issues name the output alignment, which a stored run may have called differently
+                issues = [CodonIssue(*issue)._replace(alignment=out_path.name) for issue in stored['issues']]
+                written = materialize(store.output_path(key), out_path)
+
+        if issues is None:
+            # A gene can be missing from a lineage altogether, so this isn't an error
+            typer.echo(f"Warning: No matching records found in {alignment_file}, skipping it.")
+            out_path.unlink(missing_ok=True)
+            continue
+        all_issues.extend(issues)
+        if written:
+            typer.echo(f"Preprocessed alignment written to {out_path}")
+        else:
+            typer.echo(f"Preprocessed alignment {out_path} unchanged")
+
+    with phase('write_issues'):
+        with issues_file.open('w') as issues:
+            for line in sorted(set(summarise_issues(all_issues))):
+                issues.write(line + '\n')
+        write_report(all_issues, report_file)
+
+if __name__ == "__main__":
+    typer.run(main)
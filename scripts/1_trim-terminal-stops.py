@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 from pathlib import Path  # Manipulating filenames
-from Bio import SeqIO  # Reading in sequences
+from typing import Optional  # Default output name
 import typer  # CLI argument handler
+from alignment_matrix import AlignmentMatrix, remove_sidecar  # Shared alignment representation
 
 def main(
     alignment_file: Path = typer.Argument(
         ..., help="Path to the alignment file."
+    ),
+    out_path: Optional[Path] = typer.Argument(
+        None, help="Path to the output alignment file. Defaults to <alignment>_trimmed next to the alignment."
     )
 ):
     # Get the filename without extension
@@ -14,21 +18,20 @@ def main(
     # Get the file extension without the dot
     alignment_format = alignment_file.suffix[1:]
     # Output filename with '_trimmed' suffix
-    alignment_outname = alignment_file.parent / f"{alignment_name}_trimmed.{alignment_format}"
+    alignment_outname = out_path or alignment_file.parent / f"{alignment_name}_trimmed.{alignment_format}"
 
 
-    terminal_stops_trimmed_alignment = []
-    for record in SeqIO.parse(alignment_file, format=alignment_format):
-        # Trim the last three nucleotides (terminal stop codon)
-        record.seq = record.seq[:-3]
-        terminal_stops_trimmed_alignment.append(record)
+    alignment = AlignmentMatrix.open(alignment_file, alignment_format)
+    # Trim the last three nucleotides (terminal stop codon)
+    terminal_stops_trimmed_alignment = alignment.subset_columns(slice(None, -3))
 
     # Write the trimmed sequences to the output file
-    SeqIO.write(terminal_stops_trimmed_alignment, alignment_outname, format=alignment_format)
+    terminal_stops_trimmed_alignment.write(alignment_outname, sidecar=True)
     typer.echo(f"Trimmed alignment written to {alignment_outname}")
 
     # Delete the old alignment file
     alignment_file.unlink()
+    remove_sidecar(alignment_file)
 
 if __name__ == "__main__":
     typer.run(main)
\ No newline at end of file
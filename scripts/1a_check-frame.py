@@ -1,56 +1,73 @@
 #!/usr/bin/env python3
 
 from pathlib import Path  # Manipulating filenames
+from typing import List  # Checking many alignments in one run
 import typer  # CLI argument handler
-from Bio import SeqIO  # Reading sequences
-from Bio.Data import CodonTable  # Check for oddities in the data
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from codon_check import find_codon_issues, summarise_issues, write_report  # Vectorised codon checks
+from instrument import phase  # Timing records
 
-def check_frame(alignment_file: str):
+def check_frame(
+    alignment_files: List[str] = typer.Argument(
+        ..., help="Paths to the alignment files to check."
+    ),
+    report: bool = typer.Option(
+        False, help="Write issues.txt and a per-codon issues.tsv into each alignment's lineage directory."
+    ),
+    report_name: str = typer.Option(
+        "issues", help="Name of the report files, before their .txt and .tsv extensions."
+    ),
+    table: int = typer.Option(
+        1, help="NCBI genetic code used to find stop codons."
+    )
+):
     """
-    Check if an alignment is in-frame, has no stop codons, or other erroneous characters.
+    Check if alignments are in-frame, have no stop codons, or other erroneous characters.
 
     Args:
-        alignment_file (str): Path to the alignment file to check.
+        alignment_files (list): Paths to the alignment files to check.
+        report (bool): Write per-lineage report files next to the alignments.
+        report_name (str): Name of the report files, without their extensions.
+        table (int): NCBI genetic code used to find stop codons.
     """
 
-    # Use pathlib to handle file paths
-    alignment_path = Path(alignment_file)
-    
-    # Retrieve file extension to determine the format, removing the leading dot
-    alignment_format = alignment_path.suffix.lstrip('.')
-
-    # Remove 'temp_' prefix from filename if present
-    clean_alignment_file_name = alignment_path.name
-    if clean_alignment_file_name.startswith("temp_"):
-        clean_alignment_file_name = clean_alignment_file_name[len("temp_"):]
-
-    # Check if the file exists
-    if not alignment_path.is_file():
-        typer.echo(f"File not found: {alignment_file}")
-        raise typer.Exit(code=1)
-
-    try:
-        # Parse the first record to check sequence length
-        record = next(SeqIO.parse(alignment_path, format=alignment_format))
-        seq_len = len(record.seq)
-    except Exception as e:
-        typer.echo(f"Error reading {alignment_file}: {e}")
-        raise typer.Exit(code=1)
-
-    # Check if sequence length is a multiple of 3
-    if seq_len % 3 != 0:
-        typer.echo(f"{clean_alignment_file_name} is out of frame.")
-    else:
-        # Check each record for stop codons after translation
-        for record in SeqIO.parse(alignment_path, format=alignment_format):
-            record_N = record.seq.replace('-', 'N')
-            try:
-                aa_record = record_N.translate()
-                if '*' in aa_record:
-                    typer.echo(f"{clean_alignment_file_name} contains at least one stop codon in {record.id}.")
-            except CodonTable.TranslationError as e:
-                typer.echo(f"{clean_alignment_file_name} {record.id} has a Translation Error: {e}")
+    issues_by_lineage = {}
+    for alignment_file in alignment_files:
+        # Use pathlib to handle file paths
+        alignment_path = Path(alignment_file)
+
+        # Retrieve file extension to determine the format, removing the leading dot
+        alignment_format = alignment_path.suffix.lstrip('.')
+
+        # Remove 'temp_' prefix from filename if present
+        clean_alignment_file_name = alignment_path.name
+        if clean_alignment_file_name.startswith("temp_"):
+            clean_alignment_file_name = clean_alignment_file_name[len("temp_"):]
+
+        # Check if the file exists
+        if not alignment_path.is_file():
+            typer.echo(f"File not found: {alignment_file}")
+            raise typer.Exit(code=1)
+
+        try:
+            with phase('read_alignment'):
+                alignment = AlignmentMatrix.open(alignment_path, alignment_format)
+        except Exception as e:
+            typer.echo(f"Error reading {alignment_file}: {e}")
+            raise typer.Exit(code=1)
+
+        with phase('check_codons'):
+            issues = find_codon_issues(alignment, clean_alignment_file_name, table_id=table)
+        for line in summarise_issues(issues):
+            typer.echo(line)
+        issues_by_lineage.setdefault(alignment_path.parent, []).extend(issues)
+
+    if report:
+        for lineage_dir, issues in issues_by_lineage.items():
+            with (lineage_dir / f"{report_name}.txt").open('w') as issues_txt:
+                for line in sorted(set(summarise_issues(issues))):
+                    issues_txt.write(line + '\n')
+            write_report(issues, lineage_dir / f"{report_name}.tsv")
 
 if __name__ == "__main__":
     typer.run(check_frame)
-    
\ No newline at end of file
@@ -1,34 +1,43 @@
 #!/usr/bin/env python3
 
-from Bio.Seq import Seq
-from Bio import AlignIO
-from Bio.Align import MultipleSeqAlignment
+import numpy as np
 import os
-from sys import argv
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+import typer
+from alignment_matrix import AlignmentMatrix
+from stage_store import materialize
+from instrument import phase
+
+PLASTID_GENE_GROUPS = {'accD': ['accD'], 'atp': ['atpA', 'atpB', 'atpE', 'atpF', 'atpH', 'atpI'],
+                       'ccsA': ['ccsA'], 'cemA': ['cemA'], 'clpP': ['clpP'], 'infA': ['infA'], 'matK': ['matK'],
+                       'ndh': ['ndhA', 'ndhB', 'ndhC', 'ndhD', 'ndhE', 'ndhF', 'ndhG', 'ndhH', 'ndhI', 'ndhJ', 'ndhK'],
+                       'pet': ['petA', 'petB', 'petD', 'petG', 'petL', 'petN'], 'psa': ['psaA', 'psaB', 'psaC', 'psaI', 'psaJ', 'psbA'],
+                       'psb': ['psbB', 'psbC', 'psbD', 'psbE', 'psbF', 'psbH', 'psbI', 'psbJ', 'psbK', 'psbL', 'psbM', 'psbN', 'psbT', 'lhbA'],
+                       'rbcL': ['rbcL'], 'rpl': ['rpl14', 'rpl16', 'rpl2', 'rpl20', 'rpl22', 'rpl23', 'rpl32', 'rpl33', 'rpl36'],
+                       'rpo': ['rpoA', 'rpoB', 'rpoC1', 'rpoC2'], 'rps': ['rps11', 'rps12', 'rps14', 'rps15', 'rps16', 'rps18', 'rps19', 'rps2', 'rps3', 'rps4', 'rps7', 'rps8'],
+                       'ycf3': ['ycf3'], 'ycf4': ['ycf4']
+                       }
+MITO_GENE_GROUPS = {'mito': ['atp1', 'atp4', 'atp6', 'atp8', 'atp9', 'ccmb', 'ccmC', 'ccmFc', 'ccmFn', 'cob', 'cox1', 'cox2', 'cox3', 'matR',
+                             'mttB', 'nad1', 'nad2', 'nad3', 'nad4L', 'nad4', 'nad5', 'nad6', 'nad7', 'nad9', 'rpl16', 'rpl2', 'rpl5', 'rps12',
+                             'rps19', 'rps1', 'rps3', 'rps4', 'rps7', 'sdh4', ]}
+
+
+def gene_group_index(geneDict='plastid'):
+    '''returns a dictionary from each gene name to the groups it belongs to.
+       if no gene dictionary is given, it will use the plastid groups.'''
+    groups = PLASTID_GENE_GROUPS if geneDict == 'plastid' else MITO_GENE_GROUPS
+    index = {}
+    for group, genes in list(groups.items()):
+        for gene in genes:
+            index.setdefault(gene, []).append(group)
+    return index
+
 
 def check_gene_group(geneName, geneDict='plastid'):
     '''takes a gene name and looks it up against a dictionary of gene names separated into groups.
        if no gene dictionary is given, it will use a preset dictionary.'''
-    if geneDict == 'plastid':
-        geneDict = {'accD': ['accD'], 'atp': ['atpA', 'atpB', 'atpE', 'atpF', 'atpH', 'atpI'],
-                    'ccsA': ['ccsA'], 'cemA': ['cemA'], 'clpP': ['clpP'], 'infA': ['infA'], 'matK': ['matK'],
-                    'ndh': ['ndhA', 'ndhB', 'ndhC', 'ndhD', 'ndhE', 'ndhF', 'ndhG', 'ndhH', 'ndhI', 'ndhJ', 'ndhK'],
-                    'pet': ['petA', 'petB', 'petD', 'petG', 'petL', 'petN'], 'psa': ['psaA', 'psaB', 'psaC', 'psaI', 'psaJ', 'psbA'],
-                    'psb': ['psbB', 'psbC', 'psbD', 'psbE', 'psbF', 'psbH', 'psbI', 'psbJ', 'psbK', 'psbL', 'psbM', 'psbN', 'psbT', 'lhbA'],
-                    'rbcL': ['rbcL'], 'rpl': ['rpl14', 'rpl16', 'rpl2', 'rpl20', 'rpl22', 'rpl23', 'rpl32', 'rpl33', 'rpl36'],
-                    'rpo': ['rpoA', 'rpoB', 'rpoC1', 'rpoC2'], 'rps': ['rps11', 'rps12', 'rps14', 'rps15', 'rps16', 'rps18', 'rps19', 'rps2', 'rps3', 'rps4', 'rps7', 'rps8'],
-                    'ycf3': ['ycf3'], 'ycf4': ['ycf4']
-                    }
-    else:
-        geneDict = {'mito': ['atp1', 'atp4', 'atp6', 'atp8', 'atp9', 'ccmb', 'ccmC', 'ccmFc', 'ccmFn', 'cob', 'cox1', 'cox2', 'cox3', 'matR',
-                             'mttB', 'nad1', 'nad2', 'nad3', 'nad4L', 'nad4', 'nad5', 'nad6', 'nad7', 'nad9', 'rpl16', 'rpl2', 'rpl5', 'rps12',
-                              'rps19', 'rps1', 'rps3', 'rps4', 'rps7', 'sdh4', ]}
-    geneGroups = []
-    for group, genes in list(geneDict.items()):
-        if geneName in genes:
-            geneGroups.append(group)
-    return geneGroups
+    return list(gene_group_index(geneDict).get(geneName, []))
 
 
 def get_gene_name(alignmentFile):
@@ -38,30 +47,22 @@ def get_gene_name(alignmentFile):
 
 
 def check_missing(alignment):
-    '''alignment is a MultipleSeqAlignment object.
+    '''alignment is an AlignmentMatrix object.
         returns a list of taxa that don't have a sequence in the alignment'''
-    missing_taxa = []
-    for record in alignment:
-        gapSeq = '-'*len(alignment[0])
-        if (str(record.seq).upper().replace("N", "-")) == gapSeq:
-            missing_taxa.append(record.id)
-    return missing_taxa
+    return alignment.empty_ids()
 
 
 def remove_missing(alignment, taxaToRemove):
-    '''alignment is a MultipleSeqAlignment object.
+    '''alignment is an AlignmentMatrix object.
         taxaToRemove is a list of the ids of taxa to remove.'''
-    indices = [i for i in range(len(alignment)) if alignment[i].id in taxaToRemove]
-    return MultipleSeqAlignment([alignment[i] for i in range(len(alignment)) if i not in indices])
+    taxaToRemove = set(taxaToRemove)
+    return alignment.subset_rows([taxon not in taxaToRemove for taxon in alignment.ids])
 
 
 def replace_missing(alignment):
-    '''alignment is a MultipleseqAlignment object.
-       taxaToRemove is a list of the ids of taxa to replace with N's'''
-    for record in alignment:
-        gapSeq = '-'*len(alignment[0])
-        if (str(record.seq).upper().replace("N", "-")) == gapSeq:
-            record.seq = Seq("N"*len(record.seq))
+    '''alignment is an AlignmentMatrix object.
+       replaces the sequences of taxa with no data with N's'''
+    alignment.matrix[alignment.empty_rows()] = ord('N')
     return alignment
 
 
@@ -73,34 +74,62 @@ def get_alignment_type(alignmentFile):
 
 def concat(alignmentFiles):
     '''takes a list of alignment file names.
-       returns a concatenated alignment sorted by record id, with any taxa with missing data removed'''
-    alignments = [AlignIO.read(file, get_alignment_type(file)) for file in alignmentFiles]
-    
+       returns a concatenated alignment sorted by record id, with the sequences of taxa missing
+       from an alignment replaced by N's, and the (start, end) columns of each alignment'''
+    alignments = [AlignmentMatrix.open(file, get_alignment_type(file)) for file in alignmentFiles]
+
     numberOfTaxa = len(alignments[0])
     for alignment in alignments:
         if len(alignment) != numberOfTaxa:
-            print("The alignments do not have equal numbers of taxa!")
-            exit()
-    
-    for alignment in alignments: #make sure they're all sorted by name so it's all the same
-        alignment.sort()
-    
-    
-    #makes a set of all of the taxa missing in any alignment
+            raise ValueError("The alignments do not have equal numbers of taxa!")
+
+    #make sure they're all sorted by name so it's all the same
+    ids = sorted(alignments[0].ids)
+    if any(sorted(alignment.ids) != ids for alignment in alignments):
+        raise ValueError('could not concatenate the alignments')
+
+    #fill one taxa x total length buffer, placing each alignment's rows in id order
+    totalLength = sum(alignment.n_sites for alignment in alignments)
+    matrix = np.empty((len(ids), totalLength), dtype=np.uint8)
+    boundaries = []
+    start = 0
     for alignment in alignments:
-        alignment = replace_missing(alignment)
-            
-    concatenated = alignments[0]
-    
+        end = start + alignment.n_sites
+        rows = [alignment.index[taxon] for taxon in ids]
+        matrix[:, start:end] = alignment.matrix[rows]
+        #replace the sequences of taxa missing from an alignment with N's
+        matrix[alignment.empty_rows()[rows], start:end] = ord('N')
+        boundaries.append((start, end))
+        start = end
+
+    return AlignmentMatrix(ids, matrix), boundaries
+
+
+def write_partitions(alignmentFiles, boundaries, outFileName):
+    '''writes the 1-based, inclusive columns of each gene in a concatenated alignment,
+       one "DNA, gene = start-end" line per gene as RAxML and IQ-TREE read them'''
+    with open(outFileName, 'w') as partitionFile:
+        for file, (start, end) in zip(alignmentFiles, boundaries):
+            partitionFile.write(f"DNA, {get_gene_name(file)} = {start + 1}-{end}\n")
+
+
+def concat_group(group, files):
+    '''concatenates the alignments of one gene group into group/ and writes its partition file.
+       returns an error message, or None if the group was written'''
+    outFileName = group + '_' + '_'.join(files[0].split('_')[1:]) # makes the out file name based on the first file
+    outFileName = os.path.join(group, outFileName)
     try:
-        for alignment in alignments[1:]:
-            concatenated += alignment
-        
-    except: # TODO find out what the actual exception is
-        print('could not concatenate the alignments')
-    
-    
-    return concatenated
+        concatenatedAlignment, boundaries = concat(files)
+    except ValueError as e:
+        return str(e)
+    # Only replace the concatenated alignment if its contents changed, so unchanged
+    # groups keep their modification times and aren't refitted downstream
+    tmpFileName = outFileName + '.tmp'
+    concatenatedAlignment.write(tmpFileName)
+    materialize(tmpFileName, outFileName)
+    os.remove(tmpFileName)
+    write_partitions(files, boundaries, os.path.splitext(outFileName)[0] + '_partitions.txt')
+    return None
 
 
 def make_directories(dirList=[]):
@@ -112,30 +141,33 @@ def make_directories(dirList=[]):
     
 
 
-def main():
+def main(
+    gene_type: str = typer.Argument('plastid', help="Gene groups to use: plastid, or anything else for mito"),
+    jobs: int = typer.Option(1, "--jobs", "-j", help="Number of gene groups to concatenate in parallel")
+):
     alignmentFiles = glob('*.fasta')
-    geneType = 'plastid'
-    if len(argv) > 1:
-        geneType = argv[1]
-    
+    groupIndex = gene_group_index(geneDict=gene_type)
+
     geneGroups = {}
     for file in alignmentFiles:
-        groupNames = check_gene_group(get_gene_name(file), geneDict=geneType)
-        for groupName in groupNames:
-            if(groupName not in list(geneGroups.keys())):
-                geneGroups[groupName] = [file]
-            else:
-                geneGroups[groupName].append(file)
-    
+        for groupName in groupIndex.get(get_gene_name(file), []):
+            geneGroups.setdefault(groupName, []).append(file)
+
     make_directories(list(geneGroups.keys()))  # makes all of the directories needed
-    
-    for group, files in list(geneGroups.items()):
-        outFileName = group + '_' + '_'.join(files[0].split('_')[1:]) # makes the out file name based on the first file
-        outFileName = os.path.join(group, outFileName)
-        concatenatedAlignment = concat(files)
-        AlignIO.write(concatenatedAlignment, handle=outFileName, format=get_alignment_type(alignmentFiles[0]))
-    
+
+    with phase('concatenate', groups=len(geneGroups)):
+        if jobs > 1 and len(geneGroups) > 1:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(geneGroups))) as pool:
+                errors = list(pool.map(concat_group, geneGroups.keys(), geneGroups.values()))
+        else:
+            errors = [concat_group(group, files) for group, files in list(geneGroups.items())]
+
+    errors = [error for error in errors if error is not None]
+    for error in errors:
+        print(error)
+    if errors:
+        raise typer.Exit(code=1)
 
 
 if __name__ == '__main__':
-    main()
+    typer.run(main)
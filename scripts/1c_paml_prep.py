@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Stage the PAML working directory of a lineage without copying alignments.
+
+Every gene-group directory made by 1b_alignment_concatenator.py, every
+alignment directly in the lineage directory, the test taxa file and the
+pruned trees are staged into paml/<lineage> as hardlinks (or relative
+symlinks with --mode symlink). When a link can't be made, for example across
+filesystems, files are reflinked where the filesystem supports it and copied
+otherwise. Linking takes the same time whatever the size of the alignment.
+
+Staged files share their contents with the pipeline's own files, so nothing
+may write into them: the pipeline only ever replaces alignments atomically,
+which gives the replaced file a new inode and leaves the staged one alone,
+and 2a_paml.py --workdir runs codeml in a separate scratch directory.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import errno  # Telling unsupported links from real errors
+import fcntl  # Reflinks
+import os  # Links
+import shutil  # Copying when nothing else works
+import typer  # CLI argument handler
+from instrument import phase  # Timing records
+
+MODES = ('hardlink', 'symlink', 'copy')
+
+FICLONE = 0x40049409  # ioctl cloning a whole file on btrfs, XFS and other reflink filesystems
+
+# Errors meaning a link or reflink can't be made here, rather than that something is wrong
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY}
+
+
+def reflink(src, dst):
+    '''clones src to dst, sharing its blocks until either is written. Raises OSError where unsupported'''
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.unlink(dst)
+            raise
+
+
+def stage_file(src, dst, mode='hardlink'):
+    '''
+    Stage src at dst, replacing whatever dst was.
+
+    Args:
+        src (Path): File to stage.
+        dst (Path): Where to stage it.
+        mode (str): hardlink or symlink, falling back to a reflink and then a copy; or copy.
+
+    Returns:
+        str: How the file was staged: hardlink, symlink, reflink or copy.
+    '''
+    src, dst = Path(src), Path(dst)
+    if dst.is_symlink() or dst.exists():
+        if mode == 'hardlink' and not dst.is_symlink() and os.path.samefile(src, dst):
+            return 'hardlink'
+        dst.unlink()
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    elif mode == 'symlink':
+        try:
+            os.symlink(os.path.relpath(src.resolve(), dst.parent.resolve()), dst)
+            return 'symlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    if mode != 'copy':
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def staged_files(lineage, alignments_dir, tree_dir, taxa_file):
+    '''yields (source, path relative to the lineage's PAML directory) of every file to stage'''
+    lineage_dir = alignments_dir / lineage
+    # Gene-group subdirectories created by 1b_alignment_concatenator.py
+    for inner_dir in sorted(path for path in lineage_dir.iterdir() if path.is_dir()):
+        for path in sorted(inner_dir.rglob('*')):
+            if path.is_file() and not path.name.endswith('.tmp'):
+                yield path, Path(inner_dir.name) / path.relative_to(inner_dir)
+    # Alignments directly in the lineage directory go into their own gene-named
+    # subdirectories (handles both concat and no-concat)
+    for fasta in sorted(lineage_dir.glob('*.fasta')):
+        yield fasta, Path(fasta.name.split('_')[0]) / fasta.name
+    yield taxa_file, Path(taxa_file.name)
+    if tree_dir.is_dir():
+        for tree_file in sorted(tree_dir.glob(f"*_{lineage}.tre")):
+            yield tree_file, Path(tree_file.name)
+
+
+def main(
+    lineage: str = typer.Argument(..., help="Lineage to stage"),
+    taxa_file: Path = typer.Option(..., "--taxa", help="Path to the lineage's test taxa file"),
+    alignments_dir: Path = typer.Option(Path("alignments"), help="Directory of the lineages' alignments"),
+    tree_dir: Path = typer.Option(None, help="Directory of the lineage's pruned trees. Defaults to trees/<lineage>"),
+    out_dir: Path = typer.Option(None, help="Directory to stage into. Defaults to paml/<lineage>"),
+    mode: str = typer.Option('hardlink', help=f"How to stage files: {', '.join(MODES)}. Links fall back to "
+                                              "a reflink, then a copy, where they can't be made")
+):
+    if mode not in MODES:
+        typer.echo(f"Error: --mode must be one of {', '.join(MODES)}")
+        raise typer.Exit(code=1)
+    if tree_dir is None:
+        tree_dir = Path("trees") / lineage
+    if out_dir is None:
+        out_dir = Path("paml") / lineage
+    if not (alignments_dir / lineage).is_dir():
+        typer.echo(f"Error: No alignments found for {lineage} in {alignments_dir}")
+        raise typer.Exit(code=1)
+
+    counts = {}
+    with phase('stage', lineage=lineage):
+        for src, relative in staged_files(lineage, alignments_dir, tree_dir, taxa_file):
+            dst = out_dir / relative
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            how = stage_file(src, dst, mode)
+            counts[how] = counts.get(how, 0) + 1
+    summary = ', '.join(f"{count} by {how}" for how, count in sorted(counts.items()))
+    typer.echo(f"Staged {sum(counts.values())} files into {out_dir}: {summary}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
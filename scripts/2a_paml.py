@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 
-from Bio import SeqIO
 from pathlib import Path
+import os
+import signal
+from typing import Optional
 from ete3 import EvolTree
-from itertools import combinations
+from itertools import islice
 import typer
+from alignment_matrix import AlignmentMatrix
+from codeml_driver import CodemlFit, paml_alignment, run_fits
+from fit_queue import FitQueue
+from fit_cache import FitCache, CachedFit, codeml_version, file_digest, fit_key
+from codeml_parser import parse_fit
+from foreground import FOREGROUND_MODES, mark_foreground
+from tree_cache import TreeCache, pruned_newick
+from results_db import connect, write_alignment, write_fits
+from instrument import phase, record as trace_record
 
 app = typer.Typer()
 
@@ -14,12 +25,113 @@ tests = {'branch': ['M0', 'b_free'],
          'cmC': ['XX', 'bsC']
          }  # NOTE XX refers to M2a_rel - this is just how to do a user-defined model
 
+
+def start_points(model):
+    '''yields (model_specifications, branch_estimation, fix_blength, omega) for each
+       start point of the multi-start grid of a model'''
+    for starting_branch_length_option in [1, -1]:
+        branch_estimation = 'bl' if starting_branch_length_option == 1 else 'random'
+        for initial_omega in [0.2, 0.7, 1.2]:
+            if model == 'bsA1':
+                initial_omega = 1.0
+            yield f"{model}.{branch_estimation}_{initial_omega}w", branch_estimation, starting_branch_length_option, initial_omega
+            if model == 'bsA1':
+                break
+
+
+def adaptive_start_points(model):
+    '''yields the start points of the adaptive multi-start search, in the order they are tried:
+       the grid's omegas with both branch length options, then further omegas.
+       bsA1 fixes omega at 1, so it only has its two branch length options'''
+    initial_omegas = [1.0] if model == 'bsA1' else [0.7, 0.2, 1.2, 0.05, 2.0, 0.4, 3.0]
+    for initial_omega in initial_omegas:
+        for starting_branch_length_option in [1, -1]:
+            branch_estimation = 'bl' if starting_branch_length_option == 1 else 'random'
+            yield f"{model}.{branch_estimation}_{initial_omega}w", branch_estimation, starting_branch_length_option, initial_omega
+
+
+def starts_agree(lnLs, agree, tolerance):
+    '''returns True if at least `agree` start points reached the best lnL to within tolerance'''
+    if not lnLs:
+        return False
+    best = max(lnLs)
+    return sum(best - lnL <= tolerance for lnL in lnLs) >= agree
+
+
+def model_options(model, fix_blength, omega):
+    '''returns the codeml options for one start point'''
+    if model == 'XX':
+        return {'fix_blength': fix_blength, 'omega': omega, 'NSsites': 22, 'ncatG': 3}
+    return {'fix_blength': fix_blength, 'omega': omega}
+
+
+def model_parameters(model, current_model, foreground_id, marked_ids, node_ids):
+    '''returns the named parameters of a fitted model, in the order they are written out'''
+    if model == 'M0':
+        return {'w': current_model.branches[1].get('w')}
+
+    if model == 'b_free':
+        fg_branch = current_model.branches.get(foreground_id, {})  # the root has no branch either
+        fg_omega = fg_branch.get('w') if fg_branch.get('mark') == ' #1' else None
+
+        bg_omega = None
+        for node_id in node_ids:
+            if node_id not in marked_ids:
+                bg_branch = current_model.branches.get(node_id, {})  # the root has no branch
+                if bg_branch.get('mark') == ' #0':
+                    bg_omega = bg_branch.get('w')
+                    break
+        return {'background_w': bg_omega, 'foreground_w': fg_omega}
+
+    classes = current_model.classes
+    proportions = classes.get('proportions')
+    if model in ['M3', 'XX']:  # XX is M2a_rel
+        omegas = classes.get('w')
+        return {f"{name}_{i}": values[i] for i in range(3)
+                for name, values in [('proportion', proportions), ('w', omegas)]}
+
+    if model in ['bsD', 'bsC']:
+        background_omegas = classes.get('branch type 0')
+        foreground_omegas = classes.get('branch type 1')
+        site_classes = 3
+    else:  # bsA and bsA1
+        background_omegas = classes.get('background w')
+        foreground_omegas = classes.get('foreground w')
+        site_classes = 4
+    return {f"{name}_{i}": values[i] for i in range(site_classes)
+            for name, values in [('proportion', proportions), ('background_w', background_omegas),
+                                 ('foreground_w', foreground_omegas)]}
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
 @app.command()
 def main(
     alignment: str = typer.Argument(..., help="Path to the alignment file"),
     tree: str = typer.Argument(..., help="Path to the phylogenetic tree file"),
     test: str = typer.Argument(..., help="Test name to run (branch, bsA, cmD, cmC)"),
-    test_taxa: str = typer.Argument(..., help="Path to the test_taxa file")
+    test_taxa: str = typer.Argument(..., help="Path to the test_taxa file"),
+    clade: Optional[str] = typer.Option(None, help="Lineage the results are stored under; defaults to the lineage "
+                                                   "directory of paml/<lineage>/<gene group>/<alignment>"),
+    foreground: str = typer.Option('induced', help=f"Foreground branches to mark: {', '.join(FOREGROUND_MODES)}"),
+    jobs: int = typer.Option(1, "--jobs", "-j", help="Number of codeml start points to fit in parallel"),
+    timeout: Optional[float] = typer.Option(None, help="Minutes after which a codeml run is killed and retried "
+                                                       "from a perturbed start point"),
+    retries: int = typer.Option(2, help="Times a timed out or failed start point is retried"),
+    queue: Optional[Path] = typer.Option(None, help="Shared queue directory to hand the start points to, for fit_queue.py "
+                                                    "workers to run; --workdir must then be on the shared filesystem too"),
+    cache_dir: Optional[Path] = typer.Option(None, help="Directory of cached codeml fits to reuse and add to"),
+    cache_max_mb: float = typer.Option(1024, help="Size the fit cache is pruned to, least recently used fits first"),
+    tree_cache_dir: Optional[Path] = typer.Option(None, help="Directory of pruned trees to reuse and add to"),
+    workdir: Optional[Path] = typer.Option(None, help="Scratch directory codeml runs in, one subdirectory per start point. "
+                                                      "Defaults to the current directory"),
+    db: Optional[Path] = typer.Option(None, help="SQLite results database to store every fit in, instead of one CSV per model"),
+    adaptive: bool = typer.Option(False, help="Stop fitting start points once enough of them agree, instead of fitting the whole grid"),
+    agree: int = typer.Option(2, help="Number of start points that must reach the best lnL for a fit to count as converged"),
+    tolerance: float = typer.Option(1e-3, help="Largest lnL difference between start points that agree"),
+    max_starts: Optional[int] = typer.Option(None, help="Most start points the adaptive search fits per model")
 ):
     alignment_file = alignment
     tree_file = tree
@@ -28,36 +140,41 @@ def main(
 
     alignment_name = Path(alignment_file).name
     gene_name = alignment_name.split('_')[0]
-    clade_name = Path(alignment_file).stem.split('_')[1]
+    # The lineage isn't part of the concatenated alignment's name, so it comes from its directory
+    clade_name = clade or Path(alignment_file).resolve().parent.parent.name
     alignment_format = Path(alignment_file).suffix[1:]  # Remove '.' from filetype
 
 
     # Check for empty sequences
-    empty_seq_count = 0
-    for record in SeqIO.parse(alignment_file, format=alignment_format):
-        gapSeq = '-' * len(record.seq)
-        if str(record.seq).upper().replace("N", "-") == gapSeq:
-            empty_seq_count += 1
+    with phase('read_alignment'):
+        alignment_matrix = AlignmentMatrix.open(alignment_file, alignment_format)
+        empty_rows = alignment_matrix.empty_rows()
+        empty_seq_count = int(empty_rows.sum())
 
     # Process tree pruning if there are empty sequences
     if empty_seq_count >= 1:
         taxa_in_alignment = [
-            record.id
-            for record in SeqIO.parse(alignment_file, format=alignment_format)
-            if str(record.seq).upper().replace("N", "-") != '-' * len(record.seq)
+            taxon for taxon, empty in zip(alignment_matrix.ids, empty_rows) if not empty
         ]
 
-    tree = EvolTree(tree_file)
-    out_tree_name = f"{Path(tree_file).stem}_{gene_name}.tre"
+    # Everything the fits write goes into the scratch directory, so the staged inputs are never written to
+    if workdir is None:
+        workdir = Path.cwd()
+    workdir.mkdir(parents=True, exist_ok=True)
+    out_tree_name = workdir / f"{Path(tree_file).stem}_{gene_name}.tre"
+    fitted_tree_file = tree_file
 
+    # Genes often lack the same taxa, so pruned trees are looked up in the tree cache first
     if empty_seq_count >= 1 and len(taxa_in_alignment) >= 1:
-        tree.prune(taxa_in_alignment, preserve_branch_length=True)
-        tree.unroot()
-        tree.write(outfile=out_tree_name, format=0)
-        tree = EvolTree(out_tree_name)
+        tree_cache = TreeCache(tree_cache_dir) if tree_cache_dir is not None else None
+        with phase('prune_tree'):
+            out_tree_name.write_text(pruned_newick(tree_file, taxa_in_alignment, cache=tree_cache))
+        fitted_tree_file = str(out_tree_name)
 
-    tree.link_to_alignment(alignment_file)
-    tree.workdir = str(Path.cwd())
+    with phase('load_tree'):
+        tree = EvolTree(fitted_tree_file)
+        tree.link_to_alignment(alignment_file)
+    tree.workdir = str(workdir.resolve())
 
     # Collect node IDs for later use
     list_of_node_ids = [node.node_id for node in tree.traverse('postorder')]
@@ -67,21 +184,28 @@ def main(
     with open(test_taxa_file, 'r') as test_taxa_list:
         test_taxa = [taxon.rstrip() for taxon in test_taxa_list]
 
-    marked_taxon_ids = []
-    for taxon in test_taxa:
-        taxon_node = tree & taxon
-        marked_taxon_id = taxon_node.node_id
-        tree.mark_tree([marked_taxon_id])
-        marked_taxon_ids.append(marked_taxon_id)
-
-    # Find and mark internal nodes below test taxa
-    for i in range(len(test_taxa), 1, -1):
-        taxa_groups = combinations(test_taxa, i)
-        for group in taxa_groups:
-            common_node = tree.get_common_ancestor(*group)
-            marked_taxon_id = common_node.node_id
-            tree.mark_tree([marked_taxon_id])
-            marked_taxon_ids.append(marked_taxon_id)
+    # Mark the test taxa and the foreground branches between them in one call
+    try:
+        with phase('mark_tree'):
+            marked_taxon_ids = mark_foreground(tree, test_taxa, foreground)
+    except ValueError as e:
+        typer.echo(f"Error marking {alignment_name}: {e}")
+        raise typer.Exit(code=1)
+    # b_free reports the branch of the topmost foreground node; the root of the unrooted tree has none
+    branch_ids = [node_id for node_id in marked_taxon_ids if node_id != tree.node_id]
+    if not branch_ids:
+        typer.echo(f"Error marking {alignment_name}: No marked node other than the root has a branch")
+        raise typer.Exit(code=1)
+    marked_taxon_id = branch_ids[-1]
+
+    # codeml gets the tree's leaves in PAML format and the marked tree, written once for every fit
+    leaf_names = tree.get_leaf_names()
+    alignment_text = paml_alignment(alignment_matrix, leaf_names)
+    marked_newick = tree.write(format=10)
+    # The size codeml's runtime mostly depends on, recorded for cost_model.py
+    codons, taxa = alignment_matrix.n_sites // 3, len(leaf_names)
+    codeml_path = os.path.join(tree.execpath, 'codeml')
+    fit_queue = FitQueue(queue) if queue is not None else None
 
     # Best model and likelihood dictionaries
     best_model = {key: None for key in ['M0', 'b_free', 'bsA1', 'bsA', 'M3', 'bsD', 'XX', 'bsC']}
@@ -101,150 +225,169 @@ def main(
     #         best_lnL[model] = current_model.lnL
     #         best_model[model] = current_model
 
-    # Run each test
-    for model in test_models:
-        for starting_branch_length_option in [1, -1]:
-            branch_estimation = 'bl' if starting_branch_length_option == 1 else 'random'
-            for initial_omega in [0.2, 0.7, 1.2]:
-                if model == 'bsA1':
-                    initial_omega = 1.0
-                model_specifications = f"{model}.{branch_estimation}_{initial_omega}w"
-                print(f"Testing model: {model} on: {alignment_name} with starting branch length option: {branch_estimation} and initial omega: {initial_omega}w\n")
-                
-                if model == 'XX':
-                    tree.run_model(model_specifications, fix_blength=starting_branch_length_option, omega=initial_omega, NSsites=22, ncatG=3)
-                    tree.get_evol_model(model_specifications).properties['typ'] = 'branch-site'
-                    tree.get_evol_model(model_specifications)._load(f"{model_specifications}/out")
-                else:
-                    tree.run_model(model_specifications, fix_blength=starting_branch_length_option, omega=initial_omega)
-                
-                current_model = tree.get_evol_model(model_specifications)
-                print(f"""Model fitting of: {alignment_name} complete, the likelihood was: {current_model.lnL} with these settings:
-                    - Model: {model}
-                    - Starting Branch Length Option: {branch_estimation}
-                    - Initial Omega: {initial_omega}w\n""")
-                
-                if current_model.lnL > best_lnL[model]:
-                    best_lnL[model] = current_model.lnL
-                    best_model[model] = current_model
-
-                if model == 'bsA1':
-                    break
+    # Cached fits are keyed by everything that determines a fit's result
+    fit_cache = FitCache(cache_dir) if cache_dir is not None else None
+    if fit_cache is not None:
+        alignment_digest = alignment_matrix.digest or file_digest(alignment_file)
+        tree_digest = file_digest(fitted_tree_file)
+        codeml = codeml_version(tree.execpath)
 
-    # Output results for all models
-    for model in test_models:
-        current_model = best_model[model]
-        model_name = current_model.name
-        lnL = current_model.lnL
-
-        if model == 'M0':
-            all_branch_stats = current_model.branches
-            one_branch = all_branch_stats[1]
-            omega = one_branch.get('w')
-            results = f"{clade_name},{gene_name},{model_name},{lnL},{omega}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}\n")
-
-        elif model == 'b_free':
-            all_branch_stats = current_model.branches
-            fg_branch = all_branch_stats[marked_taxon_id]
-            fg_omega = fg_branch.get('w') if fg_branch.get('mark') == ' #1' else None
-
-            bg_omega = None
-            for node_id in list_of_node_ids:
-                if node_id not in marked_taxon_ids:
-                    bg_branch = current_model.branches[node_id]
-                    if bg_branch.get('mark') == ' #0':
-                        bg_omega = bg_branch.get('w')
-                        break
-
-            results = f"{clade_name},{gene_name},{model_name},{lnL},{bg_omega},{fg_omega}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}\n")
-
-        elif model == 'M3':
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            omegas = classes.get('w')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{omegas[0]}," \
-                    f"{proportions[1]},{omegas[1]}," \
-                    f"{proportions[2]},{omegas[2]}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}")
+    def fit_start_points(batch):
+        '''fits a batch of (model, model_specifications, branch_estimation, fix_blength, omega) start
+           points, `jobs` at a time, and returns (fitted model, seconds codeml took) for each start
+           point in batch order; the fitted model is None for start points codeml failed on'''
+        cache_keys = {}
+        cached_fits = {}
+        if fit_cache is not None:
+            for model, model_specifications, _, starting_branch_length_option, initial_omega in batch:
+                key = fit_key(alignment_digest, tree_digest, marked_taxon_ids, model_specifications,
+                              model_options(model, starting_branch_length_option, initial_omega), codeml)
+                cache_keys[model_specifications] = key
+                record = fit_cache.get(key)
+                if record is not None:
+                    cached_fits[model_specifications] = CachedFit(record)
 
-        elif model == 'bsD':
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            background_omegas = classes.get('branch type 0')
-            foreground_omegas = classes.get('branch type 1')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{background_omegas[0]},{foreground_omegas[0]}," \
-                    f"{proportions[1]},{background_omegas[1]},{foreground_omegas[1]}," \
-                    f"{proportions[2]},{background_omegas[2]},{foreground_omegas[2]}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}")
+        # Fit the uncached start points side by side. The fits are loaded below in
+        # batch order, so the best model is picked as in a serial run.
+        uncached = [start for start in batch if start[1] not in cached_fits]
+        outcomes = {}
+        if uncached:
+            models = ', '.join(dict.fromkeys(start[0] for start in uncached))
+            fits = [CodemlFit(model_specifications, model, model_options(model, starting_branch_length_option, initial_omega))
+                    for model, model_specifications, _, starting_branch_length_option, initial_omega in uncached]
+            if fit_queue is not None:
+                print(f"Queueing {len(uncached)} start points for {models} on: {alignment_name} in {queue}\n")
+                batch_outcomes = fit_queue.run_fits(fits, tree.workdir, alignment_text, marked_newick,
+                                                    timeout * 60 if timeout else None, retries)
+            else:
+                print(f"Fitting {len(uncached)} start points for {models} on: {alignment_name} with {jobs} jobs\n")
+                batch_outcomes = run_fits(fits, codeml_path, tree.workdir, alignment_text, marked_newick, jobs,
+                                          timeout * 60 if timeout else None, retries)
+            for outcome in batch_outcomes:
+                outcomes[outcome.fit.name] = outcome
 
-        elif model == 'XX':  # If model is M2a_rel
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            omegas = classes.get('w')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{omegas[0]}," \
-                    f"{proportions[1]},{omegas[1]}," \
-                    f"{proportions[2]},{omegas[2]}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}")
+        fitted = []
+        for model, model_specifications, branch_estimation, starting_branch_length_option, initial_omega in batch:
+            if model_specifications in cached_fits:
+                current_model = cached_fits[model_specifications]
+                runtime = current_model.runtime
+                print(f"Using the cached fit of: {alignment_name}, the likelihood was: {current_model.lnL} with these settings:")
+            else:
+                outcome = outcomes[model_specifications]
+                runtime = outcome.seconds
+                if outcome.status != 'done':
+                    print(f"Model fitting of: {alignment_name} with {model_specifications} {outcome.status} after "
+                          f"{outcome.attempts} attempts ({outcome.error}), leaving this start point out\n")
+                    trace_record('fit', model_specifications, model=model, alignment=alignment_name, seconds=runtime,
+                                 codons=codons, taxa=taxa, cached=False, status=outcome.status,
+                                 attempts=outcome.attempts)
+                    fitted.append((None, runtime))
+                    continue
+                if outcome.attempts > 1:
+                    print(f"{model_specifications} on: {alignment_name} was retried {outcome.attempts - 1} times, "
+                          f"the last from omega {outcome.options.get('omega')} and kappa {outcome.options.get('kappa')}")
 
-        elif model == 'bsC':
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            background_omegas = classes.get('branch type 0')
-            foreground_omegas = classes.get('branch type 1')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{background_omegas[0]},{foreground_omegas[0]}," \
-                    f"{proportions[1]},{background_omegas[1]},{foreground_omegas[1]}," \
-                    f"{proportions[2]},{background_omegas[2]},{foreground_omegas[2]}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}")
+                # codeml's out and rst files are parsed directly, so no ete3 model is loaded
+                record = parse_fit(os.path.join(tree.workdir, model_specifications), model_specifications,
+                                   marked_taxon_ids, runtime)
+                current_model = CachedFit(record)
+                if fit_cache is not None:
+                    # A retry's perturbed start depends only on the fit and the attempt, so the original
+                    # options lead to this fit again; the options it finished from are kept with it
+                    if outcome.attempts > 1:
+                        record['retry_options'] = outcome.options
+                    fit_cache.put(cache_keys[model_specifications], record)
+                print(f"Model fitting of: {alignment_name} complete, the likelihood was: {current_model.lnL} with these settings:")
+            print(f"""                - Model: {model}
+                - Starting Branch Length Option: {branch_estimation}
+                - Initial Omega: {initial_omega}w\n""")
+            trace_record('fit', model_specifications, model=model, alignment=alignment_name, seconds=runtime,
+                         codons=codons, taxa=taxa, cached=model_specifications in cached_fits, lnL=current_model.lnL,
+                         np=getattr(current_model, 'np', None), status='done',
+                         attempts=outcomes[model_specifications].attempts if model_specifications in outcomes else 0)
+            fitted.append((current_model, runtime))
+        return fitted
 
-        elif model == 'bsA':
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            background_omegas = classes.get('background w')
-            foreground_omegas = classes.get('foreground w')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{background_omegas[0]},{foreground_omegas[0]}," \
-                    f"{proportions[1]},{background_omegas[1]},{foreground_omegas[1]}," \
-                    f"{proportions[2]},{background_omegas[2]},{foreground_omegas[2]}," \
-                    f"{proportions[3]},{background_omegas[3]},{foreground_omegas[3]}\n"
-            out_filename = f"{clade_name}_{gene_name}_{model}.csv"
-            with open(out_filename, 'w') as out_results:
-                out_results.write(results)
-            print(f"Results for the best model {model} written to {out_filename}")
+    # The grid fits every start point in one round. The adaptive search fits
+    # `agree` start points per model, then one more at a time (or enough to keep
+    # every job busy) for the models whose start points don't agree yet.
+    if adaptive:
+        queued = {model: list(islice(adaptive_start_points(model), max_starts)) for model in test_models}
+        starts_per_round = agree
+    else:
+        queued = {model: list(start_points(model)) for model in test_models}
+        starts_per_round = None
+    start_lnLs = {model: [] for model in test_models}
+    start_fits = {model: [] for model in test_models}  # (fitted model, runtime) of every start point
+
+    # codeml runs in sessions of their own, so they are stopped here when this run is terminated
+    signal.signal(signal.SIGTERM, _terminate)
+    active = list(test_models)
+    while active:
+        batch = []
+        for model in active:
+            batch.extend((model, *start) for start in queued[model][:starts_per_round])
+            del queued[model][:starts_per_round]
+
+        with phase('fit', models=sorted({start[0] for start in batch}), starts=len(batch)):
+            batch_fits = fit_start_points(batch)
+        for (model, *_), (current_model, runtime) in zip(batch, batch_fits):
+            if current_model is None:
+                continue
+            start_lnLs[model].append(current_model.lnL)
+            start_fits[model].append((current_model, runtime))
+            if current_model.lnL > best_lnL[model]:
+                best_lnL[model] = current_model.lnL
+                best_model[model] = current_model
+
+        active = [model for model in active
+                  if queued[model] and not starts_agree(start_lnLs[model], agree, tolerance)]
+        if active:
+            print(f"Start points of {', '.join(active)} on: {alignment_name} disagree, fitting more start points\n")
+            starts_per_round = max(1, jobs // len(active))
+
+    unfitted = [model for model in test_models if best_model[model] is None]
+    if unfitted:
+        typer.echo(f"Error: No start point of {', '.join(unfitted)} on {alignment_name} could be fitted")
+        raise typer.Exit(code=1)
+
+    # Number of start points fitted, and whether enough of them agreed on the best lnL
+    convergence = {
+        model: (len(lnLs), starts_agree(lnLs, agree, tolerance))
+        for model, lnLs in start_lnLs.items()
+    }
+
+    if fit_cache is not None:
+        fit_cache.prune(max_bytes=int(cache_max_mb * 1e6))
+
+    def parameters(model, current_model):
+        return model_parameters(model, current_model, marked_taxon_id, marked_taxon_ids, list_of_node_ids)
+
+    # Store every start point in the results database, or the best of each model in a CSV
+    if db is not None:
+        with phase('write_results'):
+            # WAL needs memory shared by every writer, which a queue's shared filesystem doesn't give
+            connection = connect(db, journal_mode='DELETE' if queue is not None else 'WAL')
+            try:
+                write_alignment(connection, clade_name, gene_name, codons, taxa)
+                for model in test_models:
+                    starts, converged = convergence[model]
+                    fits = [
+                        (current_model.name, current_model.lnL, getattr(current_model, 'np', None), runtime,
+                         parameters(model, current_model))
+                        for current_model, runtime in start_fits[model]
+                    ]
+                    write_fits(connection, clade_name, gene_name, model, fits, best_model[model].name, starts, converged)
+            finally:
+                connection.close()
+        print(f"Results for {', '.join(test_models)} written to {db}")
+        return
 
-        elif model == 'bsA1':
-            classes = current_model.classes
-            proportions = classes.get('proportions')
-            background_omegas = classes.get('background w')
-            foreground_omegas = classes.get('foreground w')
-            results = f"{clade_name},{gene_name},{model_name},{lnL}," \
-                    f"{proportions[0]},{background_omegas[0]},{foreground_omegas[0]}," \
-                    f"{proportions[1]},{background_omegas[1]},{foreground_omegas[1]}," \
-                    f"{proportions[2]},{background_omegas[2]},{foreground_omegas[2]}," \
-                    f"{proportions[3]},{background_omegas[3]},{foreground_omegas[3]}\n"
+    with phase('write_results'):
+        for model in test_models:
+            current_model = best_model[model]
+            values = [current_model.name, current_model.lnL, *parameters(model, current_model).values(), *convergence[model]]
+            results = f"{clade_name},{gene_name}," + ','.join(f"{value}" for value in values) + "\n"
             out_filename = f"{clade_name}_{gene_name}_{model}.csv"
             with open(out_filename, 'w') as out_results:
                 out_results.write(results)
@@ -1,205 +1,184 @@
 #!/usr/bin/env python3
-
-from scipy.stats import chi2
-import os
-from sys import argv
-
-
-class TestResults:
-    """results from individual tests of paml"""
-    def __init__(self, clade='', gene='', model='', lnL=0, *args):
-        self.clade = clade
-        self.gene = gene
-        self.model = model
-        self.model_name = model.split('.')[0]
-        self.lnL = float(lnL)
-
-        tests = {'M0': 'branch',
-                 'b_free': 'branch',
-                 'bsA1': 'bsA',
-                 'bsA': 'bsA',
-                 'M3': 'cmD',
-                 'bsD': 'cmD',
-                 'XX': 'cmC',
-                 'bsC': 'cmC'
-                 }
-        self.test = tests[self.model_name]
-
-        extra_parameters = [float(a) for a in args]
-        model_types = {'M3': lambda l:
-                       {'Proportions': l[0::2], 'Omegas': l[1::2]},
-                       'M0': lambda l:
-                       {'Omegas': l},
-                       'bsD': lambda l:
-                       {'Proportions': l[0::3], 'Background_omegas': l[1::3],
-                        'Foreground_omegas': l[2::3]},
-                       'b_free': lambda l:
-                       {'Foreground_omegas': l[0::2], 'Background_omegas': l[1::2]},
-                       'XX': lambda l:
-                       {'Proportions': l[0::2], 'Omegas': l[1::2]},
-                       'bsC': lambda l:
-                       {'Proportions': l[0::3], 'Background_omegas': l[1::3],
-                        'Foreground_omegas': l[2::3]},
-                        'bsA1': lambda l:
-                       {'Proportions': l[0::3], 'Background_omegas': l[1::3],
-                        'Foreground_omegas': l[2::3]},
-                        'bsA': lambda l:
-                       {'Proportions': l[0::3], 'Background_omegas': l[1::3],
-                        'Foreground_omegas': l[2::3]}
-                       }
-        # this is where the omegas are stored
-        self.parameters = model_types[self.model_name](extra_parameters)
-
-    def __str__(self):
-        return str(self.clade + '_' + self.gene + '_' + self.model)
-
-    def __repr__(self):
-        return str(self.clade + '_' + self.gene + '_' + self.model)
-
-    def __lt__(self, other):
-        return self.lnL < other.lnL
-
-    def __le__(self, other):
-        return self.lnL <= other.lnL
-
-    def __eq__(self, other):
-        return self.lnL == other.lnL
-
-    def __ne__(self, other):
-        return self.lnL != other.lnL
-
-    def __gt__(self, other):
-        return self.lnL > other.lnL
-
-    def __ge__(self, other):
-        return self.lnL >= other.lnL
-
-
-class PamlResults:
-    '''encapsulate all the different paml tests run for a clade+gene combo'''
-
-    def likelihood_ratio(self, llmin, llmax):
-        ''' returns the likelihood ratio of the two log likelihoods'''
-        return (2*abs(llmax-llmin))
-
-    def chi_dist(self, LRT):
-        ''' returns the p-value based on the chi squared distribution on the likelihood ratio test
-            with one degree of freedom'''
-        return chi2.sf(LRT, 1)
-
-    def __init__(self, clade, gene, *args):
-        self.clade = clade
-        self.gene = gene
-
-        # args is going to be a series of lists, each with two elements
-        # these are dependent upon what kinds of models are being tested - each kind of test will
-        # have two models
-        # one model for the null and one for the test
-
-        self.tests = {}  # key will be the kind of test it was, item will be [H0, H1] models
-        for modelPair in args:
-            testName = modelPair[0].test
-            self.tests[testName] = modelPair
-
-        # next, make a dictionary of the likelihood ratio tests
-
-        self.LRTs = {}
-        for testName, modelPair in list(self.tests.items()):
-            self.LRTs[testName] = self.likelihood_ratio(modelPair[0].lnL, modelPair[1].lnL)
-
-        # next, make a dictionary of the p-values
-
-        self.p_values = {}
-        for testName, likelihood in list(self.LRTs.items()):
-            self.p_values[testName] = self.chi_dist(likelihood)
-
-        # initialize all of the fdr values to -1
-        self.fdr_values = {}
-        for testName in list(self.tests.keys()):
-            self.fdr_values[testName] = -1
-
-        self.significance = {}
-        for testName in list(self.tests.keys()):
-            self.significance[testName] = None
-
-    def __str__(self):
-        values = [self.clade, self.gene]
-        for testName in list(self.tests.keys()):
-            values.extend([self.LRTs[testName], self.p_values[testName], self.fdr_values[testName],
-                           self.significance[testName]])
-        return ','.join([str(x) for x in values])
-
-    def __repr__(self):
-        values = [self.clade, self.gene]
-        for testName in list(self.tests.keys()):
-            values.extend([self.LRTs[testName], self.p_values[testName], self.fdr_values[testName],
-                           self.significance[testName]])
-        return ','.join([str(x) for x in values])
-
-
-def fdr_correction(results):
-    ''' does false discovery rate correction with Benjamin-Hochberg procedure on a list of PamlResults
-        returns a dictionary where the name is the key and the value is a boolean
-        (True if significant)'''
-    for testName in list(results[0].tests.keys()):
-        sorted_results = sorted(results, key=lambda x: x.p_values[testName])
-        for i in range(len(sorted_results)):
-            fdr_p = 0.05*(float(i+1)/len(sorted_results))
-            sorted_results[i].fdr_values[testName] = fdr_p
-            sorted_results[i].significance[testName] = sorted_results[i].p_values[testName] \
-                < sorted_results[i].fdr_values[testName]
-
-
-def file_reader(resultsFile):
-    all_results = []
-    with open(resultsFile, 'r') as csvfile:
+"""Likelihood ratio tests and false discovery rate correction for the PAML results.
+
+Reads the best fit of each model from the results database 2a_paml.py
+writes with --db, or from its concatenated per-model CSV rows (clade,
+gene, model, lnL, parameters, start points, converged). Pairs each test's
+null and alternative models per clade and gene, and writes
+<results>_corrected.csv with one row per clade and gene.
+
+Everything is computed on arrays: one column of null and one of
+alternative log likelihoods per test, and one sort of the p-values for the
+whole correction, however it is scoped.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import numpy as np  # Columns of results
+from scipy.stats import chi2  # Null distributions of the LRTs
+import typer  # CLI argument handler
+from results_db import best_fits, connect  # Results stored by 2a_paml.py --db
+from fdr import fdr_adjust  # Shared false discovery rate correction
+from instrument import phase  # Timing records
+
+# null model, alternative model, degrees of freedom, and whether the null
+# fixes a parameter on the boundary of the alternative's parameter space
+TESTS = {'branch': ('M0', 'b_free', 1, False),
+         'bsA': ('bsA1', 'bsA', 1, True),  # foreground w2 = 1 in bsA1
+         'cmD': ('M3', 'bsD', 1, False),
+         'cmC': ('XX', 'bsC', 1, False)
+         }
+
+# number of model parameters 2a_paml.py writes after the lnL
+N_PARAMETERS = {'M0': 1, 'b_free': 2, 'M3': 6, 'XX': 6,
+                'bsD': 9, 'bsC': 9, 'bsA1': 12, 'bsA': 12}
+
+SCOPES = ('clade', 'test', 'global')
+NULLS = ('chi2', 'mixture')
+DB_SUFFIXES = ('.sqlite', '.db')
+
+
+def read_csv_results(results_file):
+    '''yields (clade, gene, model, lnL, converged) for each row of the concatenated 2a_paml.py CSVs.
+       Rows written before start points were recorded count as converged.'''
+    with open(results_file, 'r') as csvfile:
         for line in csvfile:
             # get rid of all of the empty cells
-            row = [x for x in [x for x in line.rstrip().split(',') if x != '']]
-            if 'gene' not in row:  # make it skip the first row only if it's a title row
-                all_results.append(TestResults(*row))
-    return all_results
-
-
-def main():
-
-    resultsFile = argv[1]
-
-    all_results = file_reader(resultsFile)  # list of results
-
-    cladeDict = {}
-    for result in all_results:
-        if result.clade not in list(cladeDict.keys()):
-            cladeDict[result.clade] = {result.gene: {}}
-        if result.gene not in list(cladeDict[result.clade].keys()):
-            cladeDict[result.clade][result.gene] = {}
-        if result.test not in list(cladeDict[result.clade][result.gene].keys()):
-            cladeDict[result.clade][result.gene][result.test] = []
-        cladeDict[result.clade][result.gene][result.test].append(result)
-
-    all_PamlResults = {}
-
-    for clade in list(cladeDict.keys()):
-        all_PamlResults[clade] = []
-        for gene in list(cladeDict[clade].keys()):
-            #TODO make it so that it puts all of the tests together
-            listOfTests = [v for v in list(cladeDict[clade][gene].values())]
-
-            pResult = PamlResults(clade, gene, *listOfTests)
-            all_PamlResults[clade].append(pResult)
-        fdr_correction(all_PamlResults[clade])
-
-    with open(os.path.splitext(resultsFile)[0]+'_corrected.csv', 'w+') as outFile:
+            row = [x for x in line.rstrip().split(',') if x != '']
+            if not row or 'gene' in row:  # skip blank lines and title rows
+                continue
+            clade, gene, model, lnL, *extra = row
+            model_name = model.split('.')[0]
+            convergence = extra[N_PARAMETERS[model_name]:]
+            yield clade, gene, model_name, float(lnL), len(convergence) < 2 or convergence[1] == 'True'
+
+
+def read_db_results(db_file):
+    '''returns (clade, gene, model, lnL, converged) for the best fit of each model in a results database'''
+    connection = connect(db_file)
+    try:
+        return best_fits(connection)
+    finally:
+        connection.close()
+
+
+def read_results(rows):
+    '''
+    Read the results into columns.
+
+    Args:
+        rows (iterable): (clade, gene, model, lnL, converged) for each fitted model.
+
+    Returns:
+        tuple: (pairs, lnL, converged). pairs lists each (clade, gene) in order of
+            first appearance. lnL[pair, test, 0 or 1] holds the null and alternative
+            log likelihoods, nan if missing; duplicated rows keep the best lnL.
+            converged[pair, test] is False if either model's start points never agreed.
+    '''
+    # Each model fills one (test, null or alternative) slot
+    slots = {}
+    for test, (null_model, alt_model, _, _) in enumerate(TESTS.values()):
+        slots[null_model] = 2 * test
+        slots[alt_model] = 2 * test + 1
+
+    pairs = {}
+    pair_column, slot_column, lnL_column, converged_column = [], [], [], []
+    for clade, gene, model, lnL, converged in rows:
+        pair_column.append(pairs.setdefault((clade, gene), len(pairs)))
+        slot_column.append(slots[model.split('.')[0]])
+        lnL_column.append(np.nan if lnL is None else lnL)
+        converged_column.append(converged is None or bool(converged))
+
+    lnL = np.full((len(pairs), 2 * len(TESTS)), np.nan)
+    np.fmax.at(lnL, (pair_column, slot_column), lnL_column)
+    converged = np.ones((len(pairs), 2 * len(TESTS)), dtype=bool)
+    np.logical_and.at(converged, (pair_column, slot_column), converged_column)
+    return (list(pairs), lnL.reshape(len(pairs), len(TESTS), 2),
+            converged.reshape(len(pairs), len(TESTS), 2).all(axis=2))
+
+
+def likelihood_ratios(lnL):
+    '''returns the likelihood ratio statistic of every pair and test, from lnL[pair, test, null/alternative].
+       An alternative model fitted worse than its null gives 0, not a spurious positive statistic'''
+    return np.maximum(2 * (lnL[..., 1] - lnL[..., 0]), 0)
+
+
+def p_values(LRT, df, boundary=False):
+    '''returns the p-values of LRT statistics under a chi-squared null with df degrees of freedom.
+       With boundary, the null is the 50:50 mixture of chi-squared with df - 1 and df degrees of
+       freedom (a point mass at 0 for df = 1) that holds when the null fixes a parameter on the boundary.'''
+    upper = chi2.sf(LRT, df)
+    if not boundary:
+        return upper
+    lower = (LRT <= 0).astype(float) if df == 1 else chi2.sf(LRT, df - 1)
+    return 0.5 * lower + 0.5 * upper
+
+
+def correction_groups(pairs, n_tests, scope):
+    '''returns the correction group of every (pair, test), flattened in pair-major order'''
+    tests = np.tile(np.arange(n_tests), len(pairs))
+    if scope == 'global':
+        return np.zeros(len(pairs) * n_tests, dtype=int)
+    if scope == 'test':
+        return tests
+    _, clades = np.unique([clade for clade, _ in pairs], return_inverse=True)
+    return np.repeat(clades, n_tests) * n_tests + tests
+
+
+def main(
+    results_file: Path = typer.Argument(..., help="Path to the combined CSV results of 2a_paml.py, or its "
+                                                  "results database (.sqlite or .db)"),
+    scope: str = typer.Option('clade', help=f"Correct each test's p-values per: {', '.join(SCOPES)}"),
+    null: str = typer.Option('chi2', help="Null distribution for tests whose null is on a parameter boundary "
+                                          "(bsA): chi2, or the 50:50 chi-squared mixture"),
+    alpha: float = typer.Option(0.05, help="False discovery rate at which a test is significant"),
+    storey_lambda: float = typer.Option(0.5, help="Tuning parameter of the Storey q-value estimate of pi0")
+):
+    if scope not in SCOPES or null not in NULLS:
+        typer.echo(f"Error: --scope must be one of {', '.join(SCOPES)} and --null one of {', '.join(NULLS)}")
+        raise typer.Exit(code=1)
+
+    with phase('read_results'):
+        if results_file.suffix in DB_SUFFIXES:
+            rows = read_db_results(results_file)
+        else:
+            rows = read_csv_results(results_file)
+        pairs, lnL, converged = read_results(rows)
+    if not pairs:
+        typer.echo(f"Error: No results found in {results_file}")
+        raise typer.Exit(code=1)
+
+    with phase('tests'):
+        LRT = likelihood_ratios(lnL)
+        p = np.column_stack([
+            p_values(LRT[:, test], df, boundary and null == 'mixture')
+            for test, (_, _, df, boundary) in enumerate(TESTS.values())
+        ])
+        adjusted, qvalues = fdr_adjust(p.ravel(), correction_groups(pairs, len(TESTS), scope), storey_lambda)
+    adjusted = adjusted.reshape(p.shape)
+    qvalues = qvalues.reshape(p.shape)
+
+    # Only report the tests that were run
+    reported = [test for test in range(len(TESTS)) if not np.isnan(LRT[:, test]).all()]
+    test_names = list(TESTS)
+
+    out_file = results_file.with_name(results_file.stem + '_corrected.csv')
+    with open(out_file, 'w') as outFile:
         header = "clade,gene"
-        # look at the first result
-        for testName in list(list(all_PamlResults.values())[0][0].tests.keys()):
-            header += ",{0} LRT, {0} p-value, {0} FDR, {0} significant?".format(testName)
-        header += "\n"
-        outFile.write(header)
-        for genes in list(all_PamlResults.values()):
-            for gene in genes:
-                outFile.write(str(gene)+'\n')
+        for test in reported:
+            header += ",{0} LRT, {0} p-value, {0} BH p-value, {0} q-value, {0} significant?, {0} converged?" \
+                .format(test_names[test])
+        outFile.write(header + "\n")
+        for pair, (clade, gene) in enumerate(pairs):
+            values = [clade, gene]
+            for test in reported:
+                if np.isnan(LRT[pair, test]):
+                    values.extend([''] * 6)  # one of the test's models is missing for this gene
+                    continue
+                values.extend([LRT[pair, test], p[pair, test], adjusted[pair, test], qvalues[pair, test],
+                               bool(adjusted[pair, test] < alpha), bool(converged[pair, test])])
+            outFile.write(','.join(str(x) for x in values) + '\n')
+    typer.echo(f"Corrected results written to {out_file}")
 
 
 if __name__ == '__main__':
-    main()
+    typer.run(main)
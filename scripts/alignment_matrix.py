@@ -0,0 +1,334 @@
+"""Shared alignment representation used by the pipeline scripts.
+
+An alignment is held as a uint8 (taxa x sites) matrix of ASCII codes with an
+id table, so checks such as "is this record only gaps/N" or "is this column
+all gaps" run as vectorised NumPy operations instead of per-record string
+handling.
+
+AlignmentMatrix.open() reads an alignment through a binary sidecar next to
+it, <alignment>.amx: a JSON header with the id table, the matrix shape and
+the sha256 of the FASTA it was made from, followed by the raw matrix. The
+matrix is opened with numpy.memmap, so opening costs the same for any
+alignment size and a large supermatrix is only paged in as it is used. The
+sidecar is trusted while the FASTA's size and modification time match its
+header; otherwise the FASTA is hashed, and the sidecar is rebuilt if the
+contents changed. Stages that write an alignment can write its sidecar
+at the same time, so the next stage never parses the FASTA.
+"""
+
+from io import StringIO  # Parsing FASTA text that was already read
+from pathlib import Path  # Manipulating filenames
+import hashlib  # Content hashes of FASTA files
+import json  # Sidecar headers
+import os  # Atomic sidecar writes
+import struct  # Sidecar header length
+import numpy as np  # Sequence matrix
+from Bio.SeqIO.FastaIO import SimpleFastaParser  # Fast FASTA reading
+
+GAP = ord('-')
+FASTA_FORMATS = ('fasta', 'fa', 'fas')
+SIDECAR_SUFFIX = '.amx'
+_SIDECAR_MAGIC = b'AMX1'
+_SIDECAR_VERSION = 1
+_SIDECAR_ALIGN = 64  # byte boundary the matrix starts on
+
+# Characters that count as "no data" when deciding whether a record is empty
+_MISSING = np.zeros(256, dtype=bool)
+_MISSING[[GAP, ord('N'), ord('n')]] = True
+
+
+def sidecar_path(alignment_file):
+    '''returns the path of an alignment's binary sidecar'''
+    alignment_file = Path(alignment_file)
+    return alignment_file.with_name(alignment_file.name + SIDECAR_SUFFIX)
+
+
+def remove_sidecar(alignment_file):
+    '''deletes an alignment's sidecar, if it has one'''
+    sidecar_path(alignment_file).unlink(missing_ok=True)
+
+
+def _read_sidecar_header(sidecar):
+    '''returns the header of a sidecar, with the offset of its matrix, or None if it is
+       missing, of another version or cut short'''
+    try:
+        with open(sidecar, 'rb') as handle:
+            if handle.read(len(_SIDECAR_MAGIC)) != _SIDECAR_MAGIC:
+                return None
+            (length,) = struct.unpack('<I', handle.read(4))
+            header = json.loads(handle.read(length))
+            size = os.fstat(handle.fileno()).st_size
+    except (OSError, ValueError, struct.error):
+        return None
+    if header.get('version') != _SIDECAR_VERSION:
+        return None
+    n_taxa, n_sites = header['shape']
+    if size != header['offset'] + n_taxa * n_sites:
+        return None
+    return header
+
+
+def _fresh_sidecar_header(alignment_file):
+    '''returns the header of an alignment's sidecar if the sidecar is up to date, else None'''
+    header = _read_sidecar_header(sidecar_path(alignment_file))
+    stat = Path(alignment_file).stat()
+    if header is not None and (header['size'], header['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        return header
+    return None
+
+
+def alignment_ids(alignment_file):
+    '''returns the ids of a FASTA alignment's records, from its sidecar if that is up to date,
+       otherwise by reading only its title lines'''
+    header = _fresh_sidecar_header(alignment_file)
+    if header is not None:
+        return list(header['ids'])
+    with open(alignment_file, 'r') as handle:
+        return [(line[1:].split(None, 1) or [''])[0] for line in handle if line.startswith('>')]
+
+
+def alignment_shape(alignment_file):
+    '''returns (taxa, sites) of a FASTA alignment, from its sidecar if that is up to date,
+       otherwise by reading the file without building the matrix'''
+    header = _fresh_sidecar_header(alignment_file)
+    if header is not None:
+        return tuple(header['shape'])
+    taxa, sites = 0, 0
+    with open(alignment_file, 'r') as handle:
+        for line in handle:
+            if line.startswith('>'):
+                taxa += 1
+            elif taxa == 1:
+                sites += len(line.strip())
+    return taxa, sites
+
+
+def _check_format(alignment_file, alignment_format):
+    '''returns the format of an alignment file, which must be FASTA'''
+    if alignment_format is None:
+        alignment_format = Path(alignment_file).suffix.lstrip('.')
+    if alignment_format not in FASTA_FORMATS:
+        raise ValueError(f"Unsupported alignment format: {alignment_format}")
+    return alignment_format
+
+
+class AlignmentMatrix:
+    """a multiple sequence alignment stored as a uint8 taxa x sites matrix"""
+
+    def __init__(self, ids, matrix, descriptions=None, digest=None):
+        self.ids = list(ids)
+        self.matrix = matrix
+        # full FASTA title lines, kept so written files match the input headers
+        self.descriptions = list(descriptions) if descriptions is not None else list(self.ids)
+        # row of each id; an id that several records share maps to its first record
+        self.index = {}
+        for row, taxon in enumerate(self.ids):
+            self.index.setdefault(taxon, row)
+        # sha256 of the FASTA file the alignment was opened from, if it is known
+        self.digest = digest
+
+    @classmethod
+    def from_strings(cls, ids, sequences, descriptions=None):
+        '''builds an alignment from equal-length sequence strings'''
+        sequences = list(sequences)
+        length = len(sequences[0]) if sequences else 0
+        if any(len(seq) != length for seq in sequences):
+            raise ValueError("Sequences must all be the same length")
+        buffer = ''.join(sequences).encode('ascii')
+        matrix = np.frombuffer(buffer, dtype=np.uint8).reshape(len(sequences), length).copy()
+        return cls(ids, matrix, descriptions)
+
+    @classmethod
+    def parse(cls, handle):
+        '''reads FASTA records from an open text handle'''
+        ids, descriptions, sequences = [], [], []
+        for title, sequence in SimpleFastaParser(handle):
+            ids.append(title.split(None, 1)[0] if title else '')
+            descriptions.append(title)
+            sequences.append(sequence)
+        return cls.from_strings(ids, sequences, descriptions)
+
+    @classmethod
+    def read(cls, alignment_file, alignment_format=None):
+        '''reads a FASTA alignment file'''
+        _check_format(alignment_file, alignment_format)
+        with Path(alignment_file).open('r') as handle:
+            return cls.parse(handle)
+
+    @classmethod
+    def open(cls, alignment_file, alignment_format=None):
+        '''
+        Open a FASTA alignment file through its sidecar, building the sidecar if it is
+        missing or stale.
+
+        Args:
+            alignment_file (Path): The FASTA alignment.
+            alignment_format (str): Its format, by default its extension; must be FASTA.
+
+        Returns:
+            AlignmentMatrix: The alignment, whose matrix is a copy-on-write memory map of
+            the sidecar, so changes to it are never written back.
+        '''
+        alignment_file = Path(alignment_file)
+        _check_format(alignment_file, alignment_format)
+        sidecar = sidecar_path(alignment_file)
+        header = _read_sidecar_header(sidecar)
+        stat = alignment_file.stat()
+        if header is not None and (header['size'], header['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return cls._from_sidecar(sidecar, header)
+
+        data = alignment_file.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        if header is not None and header['sha256'] == digest:
+            # Same contents, only touched or copied: the matrix is reused as it is
+            alignment = cls._from_sidecar(sidecar, header)
+        else:
+            handle = StringIO(data.decode(), newline=None)
+            del data
+            alignment = cls.parse(handle)
+            alignment.digest = digest
+        # Don't record a file that changed while it was read, and work without a
+        # sidecar where the directory can't be written to
+        if alignment_file.stat().st_mtime_ns == stat.st_mtime_ns:
+            try:
+                alignment.write_sidecar(sidecar, digest, stat)
+            except OSError:
+                pass
+        return alignment
+
+    @classmethod
+    def _from_sidecar(cls, sidecar, header):
+        '''returns the alignment stored in a sidecar, with its matrix memory-mapped'''
+        shape = tuple(header['shape'])
+        if shape[0] * shape[1] == 0:
+            matrix = np.zeros(shape, dtype=np.uint8)  # empty files can't be memory-mapped
+        else:
+            matrix = np.memmap(sidecar, dtype=np.uint8, mode='c', offset=header['offset'], shape=shape)
+        return cls(header['ids'], matrix, header['descriptions'], header['sha256'])
+
+    def write_sidecar(self, sidecar, digest, stat):
+        '''
+        Write the alignment's sidecar, through a temporary file.
+
+        Args:
+            sidecar (Path): Where to write it, normally sidecar_path(the FASTA file).
+            digest (str): The sha256 hex digest of the FASTA file.
+            stat (os.stat_result): The FASTA file's stat, whose size and modification
+                time mark the sidecar as current.
+        '''
+        header = {'version': _SIDECAR_VERSION, 'sha256': digest, 'size': stat.st_size,
+                  'mtime_ns': stat.st_mtime_ns, 'shape': list(self.matrix.shape),
+                  'ids': self.ids, 'descriptions': self.descriptions, 'offset': 0}
+        # The offset is part of the header, so it is found for a header length that includes it
+        prefix_length = len(_SIDECAR_MAGIC) + 4
+        offset = 0
+        while True:
+            header['offset'] = offset
+            encoded = json.dumps(header).encode()
+            needed = -(-(prefix_length + len(encoded)) // _SIDECAR_ALIGN) * _SIDECAR_ALIGN
+            if needed == offset:
+                break
+            offset = needed
+        encoded = encoded.ljust(offset - prefix_length)
+        tmp_file = f"{sidecar}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as handle:
+                handle.write(_SIDECAR_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+                handle.write(memoryview(np.ascontiguousarray(self.matrix, dtype=np.uint8)))
+            os.replace(tmp_file, sidecar)
+        except BaseException:
+            Path(tmp_file).unlink(missing_ok=True)
+            raise
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, taxon):
+        return taxon in self.index
+
+    @property
+    def n_sites(self):
+        return self.matrix.shape[1]
+
+    def row(self, taxon):
+        '''returns the sequence row of a taxon as a uint8 array'''
+        return self.matrix[self.index[taxon]]
+
+    def sequence(self, taxon):
+        '''returns the sequence of a taxon as a string'''
+        return self.row(taxon).tobytes().decode('ascii')
+
+    def sequences(self):
+        '''yields (id, sequence string) pairs in row order'''
+        for taxon, row in zip(self.ids, self.matrix):
+            yield taxon, row.tobytes().decode('ascii')
+
+    def duplicate_ids(self):
+        '''returns the ids that more than one record has, in the order they first appear'''
+        counts = {}
+        for taxon in self.ids:
+            counts[taxon] = counts.get(taxon, 0) + 1
+        return [taxon for taxon, count in counts.items() if count > 1]
+
+    def empty_rows(self):
+        '''returns a boolean array, True for records made only of gaps and N's'''
+        if self.n_sites == 0:
+            return np.ones(len(self), dtype=bool)
+        return _MISSING[self.matrix].all(axis=1)
+
+    def empty_ids(self):
+        '''returns the ids of records made only of gaps and N's'''
+        return [self.ids[i] for i in np.flatnonzero(self.empty_rows())]
+
+    def gap_mask(self):
+        '''returns a boolean taxa x sites array, True where there is a gap'''
+        return self.matrix == GAP
+
+    def gap_columns(self):
+        '''returns a boolean array, True for columns that are gaps in every record'''
+        return self.gap_mask().all(axis=0)
+
+    def subset_rows(self, rows):
+        '''returns a new alignment with only the given rows.
+           rows can be a boolean mask, row indices or a list of ids'''
+        rows = list(rows)
+        if rows and isinstance(rows[0], str):
+            rows = np.array([self.index[taxon] for taxon in rows], dtype=int)
+        elif rows and isinstance(rows[0], (bool, np.bool_)):
+            rows = np.flatnonzero(rows)
+        else:
+            rows = np.asarray(rows, dtype=int)
+        return AlignmentMatrix([self.ids[i] for i in rows], self.matrix[rows],
+                               [self.descriptions[i] for i in rows])
+
+    def subset_columns(self, columns):
+        '''returns a new alignment with only the given columns.
+           columns can be a boolean mask, column indices or a slice'''
+        return AlignmentMatrix(self.ids, self.matrix[:, columns], self.descriptions)
+
+    def add_empty_rows(self, ids):
+        '''returns a new alignment with an all-gap row appended for each id'''
+        ids = list(ids)
+        gaps = np.full((len(ids), self.n_sites), GAP, dtype=np.uint8)
+        return AlignmentMatrix(self.ids + ids, np.vstack([self.matrix, gaps]),
+                               self.descriptions + ids)
+
+    def codons(self):
+        '''returns a taxa x codons x 3 view of the matrix'''
+        if self.n_sites % 3 != 0:
+            raise ValueError("Alignment length is not a multiple of 3")
+        return self.matrix.reshape(len(self), self.n_sites // 3, 3)
+
+    def write(self, out_file, line_width=60, sidecar=False):
+        '''writes the alignment as FASTA, wrapping sequences like Biopython, and with
+           sidecar=True its sidecar too, so the next stage to open it doesn't parse it'''
+        digest = hashlib.sha256()
+        with open(out_file, 'w') as handle:
+            for title, row in zip(self.descriptions, self.matrix):
+                sequence = row.tobytes().decode('ascii')
+                record = f">{title}\n" + ''.join(sequence[start:start + line_width] + '\n'
+                                                 for start in range(0, len(sequence), line_width))
+                handle.write(record)
+                digest.update(record.encode())
+        if sidecar:
+            self.write_sidecar(sidecar_path(out_file), digest.hexdigest(), os.stat(out_file))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Runs codeml directly, several fits at a time, with time limits and retries.
+
+Every fit gets a directory of its own with the three files codeml reads,
+written as ete3's EvolTree.run_model() writes them: `tmp.ctl` (ete3's
+default options, the model's own and the start point's), `algn` (the
+sequences of the tree's leaves in PAML format, sorted by name, which is the
+order codeml numbers them in) and `tree` (with the foreground marks for the
+models that take them). XX is M2a_rel: codeml's user-defined model with
+NSsites = 22 and ncatG = 3, given as start point options.
+
+codeml runs as an asyncio subprocess, at most `jobs` at a time. A fit that
+runs longer than the time limit is killed and started again from a
+perturbed start point (initial omega and kappa moved by up to a factor of
+1.6, and random initial branch lengths), as is a fit codeml fails on, up to
+`retries` times. Any program that reads tmp.ctl and writes codeml's out and
+rst files can stand in for codeml, such as benchmarks/fake_bin/codeml.
+
+Run this file directly to run codeml in fit directories that already hold
+the three files.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, NamedTuple, Optional  # Fits and their outcomes
+import asyncio  # Running codeml side by side
+import ctypes  # Tying codeml's lifetime to its parent's
+import math  # Perturbing start points
+import os  # Killing timed out fits
+import random  # Perturbing start points
+import re  # Removing foreground marks
+import signal  # Killing timed out fits
+import sys  # Platform
+import time  # Timing fits
+import typer  # CLI argument handler
+
+CONTROL_FILE = 'tmp.ctl'
+
+# ete3's default codeml options, in ete3's order, which decides the order of options that sort alike
+DEFAULT_OPTIONS = {
+    'seqfile': 'algn', 'treefile': 'tree', 'outfile': 'out', 'noisy': 0, 'verbose': 2, 'runmode': 0,
+    'seqtype': 1, 'CodonFreq': 2, 'clock': 0, 'aaDist': 0, 'model': 0, 'NSsites': 2, 'icode': 0,
+    'Mgene': 0, 'fix_kappa': 0, 'kappa': 2, 'ndata': '*10', 'fix_omega': 0, 'omega': 0.7,
+    'fix_alpha': 1, 'alpha': 0., 'Malpha': 0, 'ncatG': 8, 'getSE': 0, 'RateAncestor': 0,
+    'fix_blength': 0, 'Small_Diff': '1e-6', 'cleandata': 0, 'method': 0,
+}
+
+# The options of each model, as ete3 sets them, and whether it takes foreground marks.
+# An option set to '*' is left out of the control file.
+_SITE_MODEL = {'alpha': '*', 'method': '*', 'Malpha': '*', 'fix_alpha': '*'}
+MODELS = {
+    'M0': ({'NSsites': 0, **_SITE_MODEL}, False),
+    'b_free': ({'model': 2, 'NSsites': 0}, True),
+    'bsA1': ({'model': 2, 'NSsites': 2, 'fix_omega': 1, 'omega': 1, 'ncatG': '*'}, True),
+    'bsA': ({'model': 2, 'NSsites': 2, 'omega': 1.7, 'ncatG': '*'}, True),
+    'M3': ({'NSsites': 3, 'omega': .7, 'ncatG': 3, **_SITE_MODEL}, False),
+    'bsD': ({'model': 3, 'NSsites': 3, 'ncatG': 3}, True),
+    'XX': ({}, True),  # user-defined; M2a_rel's NSsites = 22 and ncatG = 3 come with the start point
+    'bsC': ({'model': 3, 'NSsites': 2, 'ncatG': 3}, True),
+}
+
+_MARK = re.compile(r' #\d+')
+
+
+class CodemlFit(NamedTuple):
+    """one codeml run: the directory it runs in, under the work directory, its model and
+       its start point's options"""
+    name: str
+    model: str
+    options: dict
+
+
+class FitOutcome(NamedTuple):
+    """the outcome of a fit: done, failed or timeout, after one or more attempts"""
+    fit: CodemlFit
+    status: str
+    seconds: float
+    attempts: int
+    options: dict
+    error: str = ''
+
+
+def control_file(model, options):
+    '''returns the text of the control file of a model with the given start point options,
+       laid out as ete3 writes it'''
+    model_options, _ = MODELS[model]
+    values = {**DEFAULT_OPTIONS, **model_options, **options}
+    lines = [f"{key:>15} = {values[key]}" for key in ['seqfile', 'treefile', 'outfile']]
+    lines.append('')
+    for key in sorted(values, key=lambda key: key.lower().replace('fix_', '')):
+        if key in ('seqfile', 'treefile', 'outfile') or str(values[key]).startswith('*'):
+            continue
+        lines.append(f"{key:>15} = {values[key]}")
+    return '\n'.join(lines) + '\n'
+
+
+def paml_alignment(alignment, names, line_width=80):
+    '''returns the sequences of the given taxa of an AlignmentMatrix in PAML format, sorted
+       by name as codeml numbers them'''
+    records = []
+    for name in sorted(names):
+        sequence = alignment.sequence(name)
+        records.append(name + '\n' + ''.join(sequence[start:start + line_width] + '\n'
+                                             for start in range(0, len(sequence), line_width)))
+    return f" {len(records)} {alignment.n_sites}\n" + '\n'.join(records)
+
+
+def codeml_tree(marked_newick, model):
+    '''returns the tree codeml gets for a model: the marked tree, without its marks if the
+       model takes none'''
+    _, takes_marks = MODELS[model]
+    return marked_newick if takes_marks else _MARK.sub('', marked_newick)
+
+
+def write_control(fit_dir, model, options):
+    '''writes the control file of one attempt at a fit, and removes the results of an
+       earlier attempt'''
+    fit_dir = Path(fit_dir)
+    for result in ('out', 'rst'):
+        (fit_dir / result).unlink(missing_ok=True)
+    (fit_dir / CONTROL_FILE).write_text(control_file(model, options))
+
+
+def prepare_fit(fit_dir, model, options, alignment_text, marked_newick):
+    '''writes the control file, alignment and tree of one fit into fit_dir'''
+    fit_dir = Path(fit_dir)
+    fit_dir.mkdir(parents=True, exist_ok=True)
+    (fit_dir / 'algn').write_text(alignment_text)
+    (fit_dir / 'tree').write_text(codeml_tree(marked_newick, model))
+    write_control(fit_dir, model, options)
+
+
+def perturbed_options(fit, attempt):
+    '''returns the options of a fit's retry: its initial omega (unless the model fixes it) and
+       kappa moved by up to a factor of 1.6 either way, and random initial branch lengths.
+       The perturbation depends only on the fit's name and the attempt, so reruns repeat it'''
+    rng = random.Random(f"{fit.name}/{attempt}")
+    options = dict(fit.options, fix_blength=-1)
+    if MODELS[fit.model][0].get('fix_omega') != 1:
+        omega = options.get('omega', MODELS[fit.model][0].get('omega', DEFAULT_OPTIONS['omega']))
+        options['omega'] = round(float(omega) * math.exp(rng.uniform(-0.5, 0.5)), 4)
+    options['kappa'] = round(DEFAULT_OPTIONS['kappa'] * math.exp(rng.uniform(-0.5, 0.5)), 4)
+    return options
+
+
+def _die_with_parent():
+    '''asks Linux to kill codeml if the process that started it dies, so a killed worker or
+       driver leaves no codeml writing into a fit directory that is run again elsewhere'''
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(1, signal.SIGKILL)  # PR_SET_PDEATHSIG
+    except (AttributeError, OSError):
+        pass
+
+
+def _kill(process):
+    '''stops a codeml run and anything it started'''
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_codeml(codeml, fit_dir, timeout=None):
+    '''
+    Run codeml once in a fit directory.
+
+    Args:
+        codeml (str): The codeml executable.
+        fit_dir (Path): Directory with the control file, alignment and tree.
+        timeout (float): Seconds after which codeml is killed, or None.
+
+    Returns:
+        tuple: (done, failed or timeout, seconds, error message).
+    '''
+    if os.sep in codeml:
+        codeml = os.path.abspath(codeml)  # codeml runs in the fit directory
+    started = time.perf_counter()
+    try:
+        # A session of its own, so a timed out run is killed with anything it started
+        process = await asyncio.create_subprocess_exec(
+            codeml, CONTROL_FILE, cwd=fit_dir, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE, start_new_session=True,
+            preexec_fn=_die_with_parent if sys.platform.startswith('linux') else None)
+    except OSError as e:
+        return 'failed', 0.0, f"can't run {codeml}: {e.strerror}"
+    try:
+        # codeml may ask for a key press, so it gets a newline on stdin, as ete3 sends it
+        _, stderr = await asyncio.wait_for(process.communicate(b'\n'), timeout)
+    except asyncio.TimeoutError:
+        _kill(process)
+        await process.wait()
+        return 'timeout', time.perf_counter() - started, f"no result after {timeout:g} s"
+    except BaseException:
+        # Cancelled: the run is stopped with the rest of the driver
+        _kill(process)
+        raise
+    seconds = time.perf_counter() - started
+    if process.returncode != 0 or not (Path(fit_dir) / 'out').is_file():
+        error = stderr.decode(errors='replace').strip().splitlines()
+        return 'failed', seconds, f"exit code {process.returncode}" + (f": {error[-1]}" if error else '')
+    return 'done', seconds, ''
+
+
+async def run_prepared_fit(fit, fit_dir, codeml, timeout=None, retries=2):
+    '''runs a fit in a directory prepare_fit() wrote, retrying it from perturbed start points,
+       and returns its FitOutcome'''
+    options = fit.options
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            options = perturbed_options(fit, attempt)
+            write_control(fit_dir, fit.model, options)
+        status, seconds, error = await run_codeml(codeml, fit_dir, timeout)
+        if status == 'done':
+            break
+    return FitOutcome(fit, status, seconds, attempt, options, error)
+
+
+async def _run_fit(fit, codeml, workdir, alignment_text, marked_newick, limit, timeout, retries):
+    '''prepares and runs one fit, once a place under the limit is free'''
+    fit_dir = Path(workdir) / fit.name
+    async with limit:
+        prepare_fit(fit_dir, fit.model, fit.options, alignment_text, marked_newick)
+        return await run_prepared_fit(fit, fit_dir, codeml, timeout, retries)
+
+
+async def run_fits_async(fits, codeml, workdir, alignment_text, marked_newick, jobs=1, timeout=None, retries=2):
+    '''runs fits, at most jobs at a time, and returns their FitOutcomes in the order of fits'''
+    limit = asyncio.Semaphore(jobs)
+    return await asyncio.gather(*(
+        _run_fit(fit, codeml, workdir, alignment_text, marked_newick, limit, timeout, retries) for fit in fits))
+
+
+def run_fits(fits, codeml, workdir, alignment_text, marked_newick, jobs=1, timeout=None, retries=2):
+    '''
+    Run codeml fits of one alignment and tree.
+
+    Args:
+        fits (list): CodemlFit of every fit; each runs in workdir/name.
+        codeml (str): The codeml executable.
+        workdir (Path): Directory to make the fit directories in.
+        alignment_text (str): The alignment in PAML format (see paml_alignment).
+        marked_newick (str): The tree with the foreground marked ' #1', as
+            EvolTree.write(format=10) writes it.
+        jobs (int): Most fits run at once.
+        timeout (float): Seconds after which a run is killed and retried, or None.
+        retries (int): Times a timed out or failed fit is retried from a perturbed start point.
+
+    Returns:
+        list: The FitOutcome of every fit, in the order of fits.
+    '''
+    return asyncio.run(run_fits_async(fits, codeml, workdir, alignment_text, marked_newick, jobs, timeout, retries))
+
+
+def main(
+    fit_dirs: List[Path] = typer.Argument(..., help=f"Fit directories, each with its {CONTROL_FILE}, algn and tree"),
+    codeml: str = typer.Option('codeml', help="codeml executable"),
+    jobs: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j", help="Most fits to run at once"),
+    timeout: Optional[float] = typer.Option(None, help="Minutes after which a fit is killed")
+):
+    async def run_all():
+        limit = asyncio.Semaphore(jobs)
+
+        async def run_one(fit_dir):
+            async with limit:
+                return await run_codeml(codeml, fit_dir, timeout * 60 if timeout else None)
+        return await asyncio.gather(*(run_one(fit_dir) for fit_dir in fit_dirs))
+
+    failed = 0
+    for fit_dir, (status, seconds, error) in zip(fit_dirs, asyncio.run(run_all())):
+        failed += status != 'done'
+        typer.echo(f"{status}: {fit_dir} in {seconds:.1f} s" + (f" ({error})" if error else ''))
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Streaming parser of codeml's out and rst files.
+
+Reads just what 2a_paml.py writes out of a fit, line by line and without
+ete3: the lnL and number of parameters, kappa, the w of every branch from
+the dN/dS table of `out`, and the site-class table of `rst` (proportions,
+w, background and foreground w, or branch type 0 and 1 w). rst is only read
+up to its per-site tables. Branches are keyed by the node numbers codeml
+gives them, which are the node_ids ete3 gives the nodes of an EvolTree.
+
+The result is a fit record as the fit cache stores it, so it can be cached
+as is and read with fit_cache.CachedFit. Run this file directly to
+print the record of a fit directory.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import json  # Printing records
+import re  # Parsing codeml's tables
+import typer  # CLI argument handler
+
+_NUMBER = r'-?\d+\.\d+'
+_LNL = re.compile(r'^lnL.*np:\s*(\d+)\):\s+(' + _NUMBER + r'|nan)')
+_KAPPA = re.compile(r'^kappa .*?(\d+\.\d+)')
+_BRANCH = re.compile(r'^\s+(\d+)\.\.(\d+)\s+(' + _NUMBER + r')\s')
+_BRANCH_VALUES = re.compile(r'^\s+(' + _NUMBER + r'\s+){7}' + _NUMBER)
+_SITE_CLASSES = re.compile(r'\(K=(\d+)\)')
+_CLASS_VALUE = re.compile(r'\d+\.\d{5}')
+
+
+def parse_out(out_file):
+    '''
+    Read the lnL, number of parameters, kappa and branch w of a codeml out file.
+
+    Returns:
+        dict: lnL (-inf if codeml reported nan), np and kappa (None if missing), and
+            branches, {node number as str: {'w': w}} from the dN/dS table.
+    '''
+    lnL, n_parameters, kappa = None, None, None
+    branches = {}
+    label = None  # a branch label whose values are wrapped onto the next line
+    with open(out_file, 'r') as out:
+        for line in out:
+            if label is not None:
+                if _BRANCH_VALUES.match(line):
+                    branches[label] = {'w': float(line.split()[3])}
+                label = None
+                continue
+            if line.startswith('lnL'):
+                match = _LNL.match(line)
+                if match:
+                    n_parameters = int(match.group(1))
+                    lnL = float('-inf') if match.group(2) == 'nan' else float(match.group(2))
+            elif line.startswith('kappa '):
+                match = _KAPPA.match(line)
+                kappa = float(match.group(1)) if match else None
+            elif line.startswith(' ') and line.count('..') == 1:
+                match = _BRANCH.match(line)
+                if match:
+                    branches[match.group(2)] = {'w': float(line.split()[4])}
+                elif re.match(r'^\s+\d+\.\.\d+\s*$', line):
+                    label = line.split('..')[1].strip()
+    return {'lnL': lnL, 'np': n_parameters, 'kappa': kappa, 'branches': branches}
+
+
+def parse_rst(rst_file):
+    '''
+    Read the site-class table of a codeml rst file.
+
+    Returns:
+        dict: {'proportions': [...], 'w' or 'background w' and 'foreground w' or
+            'branch type 0' and 'branch type 1': [...]}, empty for models without site classes.
+    '''
+    classes = {}
+    n_classes = 0
+    try:
+        rst = open(rst_file, 'r')
+    except FileNotFoundError:
+        return classes
+    with rst:
+        for line in rst:
+            if line.startswith('dN/dS '):
+                match = _SITE_CLASSES.search(line)
+                n_classes = int(match.group(1)) if match else 0
+                continue
+            if '(BEB)' in line or '(NEB)' in line:
+                break  # per-site tables follow; the classes are all read
+            if not n_classes or not line[:1].islower():
+                continue
+            values = _CLASS_VALUE.findall(line)
+            if len(values) >= n_classes:
+                name = line.split('  ')[0].replace(':', '')
+                if name.startswith('p'):
+                    name = 'proportions'
+                classes[name] = [float(value) for value in values]
+    return classes
+
+
+def parse_fit(fit_dir, name=None, marked_ids=(), runtime=None):
+    '''
+    Read a codeml fit from the directory it ran in.
+
+    Args:
+        fit_dir (Path): Directory with codeml's out and rst files.
+        name (str): Name of the fit, e.g. M0.bl_0.7w. Defaults to the directory name.
+        marked_ids (iterable): Node ids marked as foreground; their branches get the
+            mark ' #1' and the other branches ' #0', as ete3 marks them.
+        runtime (float): Seconds codeml took, stored with the record.
+
+    Returns:
+        dict: The fit record: name, runtime, lnL, np, kappa, branches and classes.
+    '''
+    fit_dir = Path(fit_dir)
+    record = parse_out(fit_dir / 'out')
+    marked = {str(node_id) for node_id in marked_ids}
+    for node_id, branch in record['branches'].items():
+        branch['mark'] = ' #1' if node_id in marked else ' #0'
+    return {'name': name or fit_dir.resolve().name, 'runtime': runtime, **record, 'classes': parse_rst(fit_dir / 'rst')}
+
+
+def main(
+    fit_dir: Path = typer.Argument(..., help="Directory codeml ran in, with its out and rst files")
+):
+    typer.echo(json.dumps(parse_fit(fit_dir), indent=1))
+
+
+if __name__ == "__main__":
+    typer.run(main)
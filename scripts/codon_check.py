@@ -0,0 +1,134 @@
+"""Vectorised reading-frame and stop-codon checks for codon alignments.
+
+Each codon of an AlignmentMatrix is encoded as an integer index: 0-63 for
+unambiguous A/C/G/T codons, MISSING for codons with gaps or N's, AMBIGUOUS
+for codons with other IUPAC ambiguity codes and INVALID for codons with any
+other character. A precomputed table over those indices flags stop codons, so
+a whole alignment is checked with a handful of array operations. The rare
+ambiguous codons are translated individually, as Biopython would.
+"""
+
+from typing import NamedTuple  # Structured issue records
+import numpy as np  # Codon index arrays
+from Bio.Seq import Seq  # Translating ambiguous codons
+from Bio.Data import CodonTable  # Stop codons of the genetic code
+
+MISSING = 64
+INVALID = 65
+AMBIGUOUS = 66
+
+# Per-character codes: 0-3 for A/C/G/T(U), 4 for gaps/N, 5 for anything invalid,
+# 6 for the other IUPAC ambiguity codes
+_BASE_CODES = np.full(256, 5, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for _base in _bases:
+        _BASE_CODES[ord(_base)] = _code
+for _base in '-Nn':
+    _BASE_CODES[ord(_base)] = 4
+for _base in 'RrYySsWwKkMmBbDdHhVv':
+    _BASE_CODES[ord(_base)] = 6
+
+
+class CodonIssue(NamedTuple):
+    """one problem found in an alignment, at alignment, record or codon level"""
+    alignment: str
+    record: str  # empty for whole-alignment issues
+    issue: str  # out_of_frame, record_out_of_frame, stop_codon or invalid_character
+    codon: int  # 1-based codon number, 0 if not codon-level
+    position: int  # 1-based nucleotide position of the codon, or the length for frame issues
+    sequence: str  # the offending codon as written in the alignment
+
+
+def stop_table(table_id=1):
+    '''returns a boolean array over codon indices, True for stop codons of the given genetic code'''
+    stops = np.zeros(AMBIGUOUS + 1, dtype=bool)
+    for codon in CodonTable.unambiguous_dna_by_id[table_id].stop_codons:
+        codes = [{'A': 0, 'C': 1, 'G': 2, 'T': 3}[base] for base in codon]
+        stops[codes[0] * 16 + codes[1] * 4 + codes[2]] = True
+    return stops
+
+
+def codon_indices(alignment):
+    '''returns a taxa x codons array of codon indices (0-63, MISSING, AMBIGUOUS or INVALID)'''
+    codes = _BASE_CODES[alignment.codons()]
+    indices = (codes[..., 0].astype(np.int16) * 16 + codes[..., 1] * 4 + codes[..., 2])
+    indices[(codes == 6).any(axis=-1)] = AMBIGUOUS
+    indices[(codes == 4).any(axis=-1)] = MISSING
+    indices[(codes == 5).any(axis=-1)] = INVALID
+    return indices
+
+
+def find_codon_issues(alignment, alignment_name, table_id=1):
+    '''
+    Check an alignment for out-of-frame lengths, stop codons and invalid characters.
+
+    Args:
+        alignment (AlignmentMatrix): The alignment to check.
+        alignment_name (str): Name reported in each issue.
+        table_id (int): NCBI genetic code used to find stop codons.
+
+    Returns:
+        list: CodonIssue records, ordered by record and codon.
+    '''
+    issues = []
+    if not len(alignment):
+        return issues
+
+    # An alignment that isn't a whole number of codons has no reliable frame
+    if alignment.n_sites % 3 != 0:
+        issues.append(CodonIssue(alignment_name, '', 'out_of_frame', 0, alignment.n_sites, ''))
+        return issues
+
+    ungapped_lengths = (~alignment.gap_mask()).sum(axis=1)
+    for row in np.flatnonzero(ungapped_lengths % 3):
+        issues.append(CodonIssue(alignment_name, alignment.ids[row], 'record_out_of_frame',
+                                 0, int(ungapped_lengths[row]), ''))
+
+    indices = codon_indices(alignment)
+    flagged = stop_table(table_id)[indices] | (indices == INVALID)
+    codons = alignment.codons()
+
+    # Ambiguous codons are stops only if every reading of them is a stop
+    ambiguous_stops = {}
+    for row, codon in zip(*np.nonzero(indices == AMBIGUOUS)):
+        sequence = codons[row, codon].tobytes().decode('ascii')
+        if sequence not in ambiguous_stops:
+            ambiguous_stops[sequence] = Seq(sequence).translate(table=table_id) == '*'
+        flagged[row, codon] = ambiguous_stops[sequence]
+    for row, codon in zip(*np.nonzero(flagged)):
+        issue = 'invalid_character' if indices[row, codon] == INVALID else 'stop_codon'
+        issues.append(CodonIssue(alignment_name, alignment.ids[row], issue, int(codon) + 1,
+                                 int(codon) * 3 + 1, codons[row, codon].tobytes().decode('ascii')))
+    return sorted(issues, key=lambda issue: (alignment.index[issue.record], issue.codon))
+
+
+def summarise_issues(issues):
+    '''returns one line per alignment or record, in the wording of the original 1a_check-frame.py'''
+    lines = []
+    first_invalid = {}
+    has_stop = []
+    for issue in issues:
+        if issue.issue == 'out_of_frame':
+            lines.append(f"{issue.alignment} is out of frame.")
+        elif issue.issue == 'record_out_of_frame':
+            lines.append(f"{issue.alignment} {issue.record} is out of frame.")
+        elif issue.issue == 'invalid_character':
+            first_invalid.setdefault((issue.alignment, issue.record), issue.sequence)
+        elif issue.issue == 'stop_codon':
+            has_stop.append((issue.alignment, issue.record))
+
+    # A translation error stops translation, so those records report only the error
+    for alignment_name, record in dict.fromkeys(has_stop):
+        if (alignment_name, record) not in first_invalid:
+            lines.append(f"{alignment_name} contains at least one stop codon in {record}.")
+    for (alignment_name, record), codon in first_invalid.items():
+        lines.append(f"{alignment_name} {record} has a Translation Error: Codon '{codon}' is invalid")
+    return lines
+
+
+def write_report(issues, report_file):
+    '''writes issues as a tab-separated table with a header row'''
+    with open(report_file, 'w') as report:
+        report.write('\t'.join(CodonIssue._fields) + '\n')
+        for issue in issues:
+            report.write('\t'.join(str(value) for value in issue) + '\n')
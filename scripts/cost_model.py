@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Predicted codeml runtimes, for starting the longest PAML jobs first.
+
+A codeml fit takes longer the more codons and taxa its alignment has, and
+much longer for the models with more site classes. The time of one start
+point is modelled as
+
+    log(seconds) = log(scale[model]) + a * log(codons / 300) + b * log(taxa / 20)
+
+and a gene's codeml time as the sum over its models of that time multiplied
+by the number of start points the model takes. The coefficients are fitted by
+least squares to recorded runs: the runtimes in the fits table of the
+results database, whose alignments table gives each gene's codons and taxa,
+and the 'fit' records of trace files. Each coefficient is pulled towards a
+prior value as if by PRIOR_WEIGHT extra runs, so a few runs of a few models
+give a usable model, and with no runs at all the prior ranks jobs by size.
+
+The Snakefile uses a gene's prediction as the priority of its run_paml job,
+so the most expensive genes start first instead of last. `calibrate` writes
+the fitted coefficients to a JSON file; `predict` shows the predicted time of
+alignments.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several trace files and alignments
+import json  # Calibrated coefficients
+import math  # Priorities and runtimes
+import sqlite3  # Unreadable results databases
+import numpy as np  # Least squares
+import typer  # CLI argument handler
+from alignment_matrix import alignment_shape  # Alignment sizes
+from results_db import connect, fit_runtimes, model_starts  # Recorded runtimes
+
+app = typer.Typer()
+
+COST_MODEL_FILE = 'paml_cost_model.json'
+REFERENCE_CODONS = 300
+REFERENCE_TAXA = 20
+
+# Prior seconds per start point at the reference size, and size exponents:
+# a likelihood evaluation is linear in codons, and the number of evaluations
+# grows with the number of branch lengths to optimise
+PRIOR_SECONDS = {'M0': 10.0, 'b_free': 15.0, 'bsA1': 60.0, 'bsA': 80.0, 'M3': 50.0, 'bsD': 80.0,
+                 'XX': 40.0, 'bsC': 80.0}  # XX is M2a_rel, as in 2a_paml.py
+PRIOR_CODONS = 1.0
+PRIOR_TAXA = 1.5
+PRIOR_WEIGHT = 3.0
+# Start points per model of the grid in 2a_paml.start_points()
+GRID_STARTS = {model: 2 if model == 'bsA1' else 6 for model in PRIOR_SECONDS}
+# Factor the predicted wall time is multiplied by to give a job's time limit
+RUNTIME_MARGIN = 3.0
+
+
+class CostModel:
+    """predicted codeml seconds per start point of each model, by alignment size"""
+
+    def __init__(self, log_scale=None, codons=PRIOR_CODONS, taxa=PRIOR_TAXA, starts=None, records=0):
+        self.log_scale = dict(log_scale or {model: math.log(seconds) for model, seconds in PRIOR_SECONDS.items()})
+        self.codons = codons
+        self.taxa = taxa
+        self.starts = dict(GRID_STARTS, **(starts or {}))
+        self.records = records  # runs the model was calibrated on
+
+    @classmethod
+    def calibrate(cls, runs, starts=None, prior_weight=PRIOR_WEIGHT):
+        '''
+        Fit the model to recorded runs.
+
+        Args:
+            runs (list): (model, codons, taxa, seconds) of every start point; runs of models
+                the cost model doesn't know are left out.
+            starts (dict): {model: mean number of start points per gene}, if known.
+            prior_weight (float): Number of runs the prior value of each coefficient counts as.
+
+        Returns:
+            CostModel: The calibrated model.
+        '''
+        models = list(PRIOR_SECONDS)
+        runs = [run for run in runs if run[0] in PRIOR_SECONDS and run[1] > 0 and run[2] > 0 and run[3] > 0]
+        n_coefficients = len(models) + 2
+        prior = np.array([math.log(PRIOR_SECONDS[model]) for model in models] + [PRIOR_CODONS, PRIOR_TAXA])
+        design = np.zeros((len(runs) + n_coefficients, n_coefficients))
+        target = np.zeros(len(runs) + n_coefficients)
+        for row, (model, codons, taxa, seconds) in enumerate(runs):
+            design[row, models.index(model)] = 1.0
+            design[row, -2] = math.log(codons / REFERENCE_CODONS)
+            design[row, -1] = math.log(taxa / REFERENCE_TAXA)
+            target[row] = math.log(seconds)
+        # The prior, as extra rows pulling each coefficient towards its prior value
+        design[len(runs):] = math.sqrt(prior_weight) * np.eye(n_coefficients)
+        target[len(runs):] = math.sqrt(prior_weight) * prior
+        coefficients = np.linalg.lstsq(design, target, rcond=None)[0]
+        return cls(dict(zip(models, coefficients[:-2].tolist())), float(coefficients[-2]), float(coefficients[-1]),
+                   starts, len(runs))
+
+    @classmethod
+    def load(cls, model_file):
+        '''returns the cost model saved in a JSON file'''
+        with open(model_file, 'r') as handle:
+            saved = json.load(handle)
+        return cls(saved['log_scale'], saved['codons'], saved['taxa'], saved['starts'], saved['records'])
+
+    def save(self, model_file):
+        '''saves the cost model to a JSON file'''
+        with open(model_file, 'w') as handle:
+            json.dump({'log_scale': self.log_scale, 'codons': self.codons, 'taxa': self.taxa,
+                       'starts': self.starts, 'records': self.records}, handle, indent=1)
+
+    def seconds(self, model, codons, taxa):
+        '''returns the predicted seconds codeml takes to fit one start point of a model'''
+        return math.exp(self.log_scale[model] + self.codons * math.log(max(codons, 1) / REFERENCE_CODONS)
+                        + self.taxa * math.log(max(taxa, 1) / REFERENCE_TAXA))
+
+    def job_seconds(self, models, codons, taxa):
+        '''returns the predicted codeml seconds of fitting every start point of the models'''
+        return sum(self.seconds(model, codons, taxa) * self.starts[model] for model in models)
+
+    def wall_seconds(self, models, codons, taxa, jobs):
+        '''returns the predicted seconds fitting the models takes with jobs start points fitted at once'''
+        return self.job_seconds(models, codons, taxa) / max(1, min(jobs, sum(self.starts[model] for model in models)))
+
+
+def db_runs(db_file):
+    '''returns the recorded runs and the mean start points per model of a results database'''
+    connection = connect(db_file)
+    try:
+        return fit_runtimes(connection), model_starts(connection)
+    finally:
+        connection.close()
+
+
+def trace_runs(trace_paths):
+    '''returns (model, codons, taxa, seconds) of the codeml fits recorded in trace files'''
+    # Imported here, as importing instrument makes the Snakefile record itself when tracing
+    from instrument import read_records
+    return [(entry['model'], entry['codons'], entry['taxa'], entry['seconds'])
+            for entry in read_records(trace_paths)
+            if entry['kind'] == 'fit' and not entry.get('cached') and entry.get('status', 'done') == 'done'
+            and entry.get('codons') and entry.get('taxa') and entry.get('seconds')]
+
+
+def load_cost_model(model_file=COST_MODEL_FILE, db_file=None):
+    '''returns the cost model saved in model_file if there is one, else one calibrated on the
+       fits in db_file if that exists, else the prior'''
+    if model_file is not None and Path(model_file).exists():
+        return CostModel.load(model_file)
+    if db_file is not None and Path(db_file).exists():
+        try:
+            runs, starts = db_runs(db_file)
+        except sqlite3.DatabaseError:
+            return CostModel()
+        return CostModel.calibrate(runs, starts)
+    return CostModel()
+
+
+def alignments_cost(cost_model, alignment_files, models, jobs):
+    '''returns the predicted codeml seconds of fitting the models to the alignments, and the
+       predicted wall seconds with jobs start points fitted at once'''
+    seconds, wall = 0.0, 0.0
+    for alignment_file in alignment_files:
+        taxa, sites = alignment_shape(alignment_file)
+        seconds += cost_model.job_seconds(models, sites // 3, taxa)
+        wall += cost_model.wall_seconds(models, sites // 3, taxa, jobs)
+    return seconds, wall
+
+
+def job_priority(seconds):
+    '''returns a Snakemake priority that orders jobs by their predicted seconds, longest first'''
+    return int(round(20 * math.log10(1 + seconds)))
+
+
+def runtime_minutes(seconds, margin=RUNTIME_MARGIN):
+    '''returns a time limit in minutes for a job predicted to take seconds'''
+    return max(1, math.ceil(seconds * margin / 60))
+
+
+@app.command()
+def calibrate(
+    db: Optional[Path] = typer.Option(None, help="Results database whose fits to calibrate on"),
+    trace: Optional[List[Path]] = typer.Option(None, help="Trace files or directories whose fits to calibrate on, "
+                                                          "e.g. of runs not stored in the database"),
+    out: Path = typer.Option(Path(COST_MODEL_FILE), help="JSON file to save the cost model to")
+):
+    """Fit the cost model to recorded codeml runs."""
+    runs, starts = db_runs(db) if db is not None else ([], {})
+    if trace:
+        runs = list(runs) + trace_runs(trace)
+    if not runs:
+        typer.echo("Error: No recorded codeml runs with alignment sizes found")
+        raise typer.Exit(code=1)
+    cost_model = CostModel.calibrate(runs, starts)
+    cost_model.save(out)
+
+    known = [run for run in runs if run[0] in cost_model.log_scale]
+    errors = [abs(math.log(seconds / cost_model.seconds(model, codons, taxa))) for model, codons, taxa, seconds in known]
+    typer.echo(f"Calibrated on {cost_model.records} start points; seconds ~ codons^{cost_model.codons:.2f} "
+               f"* taxa^{cost_model.taxa:.2f}, typically off by a factor of {math.exp(np.median(errors)):.2f}")
+    for model, log_scale in cost_model.log_scale.items():
+        typer.echo(f"{model}: {math.exp(log_scale):.1f} s per start point at {REFERENCE_CODONS} codons and "
+                   f"{REFERENCE_TAXA} taxa, {cost_model.starts[model]:.1f} start points")
+    typer.echo(f"Cost model written to {out}")
+
+
+@app.command()
+def predict(
+    alignments: List[Path] = typer.Argument(..., help="FASTA alignments to predict the codeml time of"),
+    model: List[str] = typer.Option(['M0', 'b_free'], help="Models to be fitted"),
+    model_file: Path = typer.Option(Path(COST_MODEL_FILE), help="Cost model from calibrate, if it exists"),
+    db: Optional[Path] = typer.Option(None, help="Results database to calibrate on if there is no cost model file"),
+    jobs: int = typer.Option(12, "--jobs", "-j", help="Start points fitted at once")
+):
+    """Show the predicted codeml time of alignments, longest first."""
+    unknown = [name for name in model if name not in PRIOR_SECONDS]
+    if unknown:
+        typer.echo(f"Error: Unknown models {', '.join(unknown)}; known are {', '.join(PRIOR_SECONDS)}")
+        raise typer.Exit(code=1)
+    cost_model = load_cost_model(model_file, db)
+    rows = []
+    for alignment_file in alignments:
+        taxa, sites = alignment_shape(alignment_file)
+        rows.append((cost_model.job_seconds(model, sites // 3, taxa),
+                     cost_model.wall_seconds(model, sites // 3, taxa, jobs), alignment_file, sites // 3, taxa))
+    for seconds, wall, alignment_file, codons, taxa in sorted(rows, key=lambda row: -row[0]):
+        typer.echo(f"{alignment_file}: {codons} codons, {taxa} taxa, {seconds / 3600:.3g} codeml hours, "
+                   f"{wall / 3600:.3g} h with {jobs} jobs, priority {job_priority(seconds)}")
+
+
+if __name__ == "__main__":
+    app()
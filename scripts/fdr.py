@@ -0,0 +1,47 @@
+"""False discovery rate correction shared by the PAML and RELAX results.
+
+fdr_adjust() corrects p-values within groups (per clade, per test, or all
+at once) with the Benjamini-Hochberg step-up procedure and Storey's q-value,
+from one sort of all the p-values however many groups there are.
+"""
+
+import numpy as np  # Columns of p-values
+
+
+def fdr_adjust(p, groups, storey_lambda=0.5):
+    '''
+    Correct p-values for multiple testing within each group, from a single sort.
+
+    Args:
+        p (array): p-values; nan entries are left out and stay nan.
+        groups (array): Integer group of each p-value.
+        storey_lambda (float): p-value above which tests are counted as null when estimating pi0.
+
+    Returns:
+        tuple: (Benjamini-Hochberg adjusted p-values, Storey q-values), in the order of p.
+    '''
+    adjusted = np.full(p.shape, np.nan)
+    qvalues = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    if not len(valid):
+        return adjusted, qvalues
+
+    order = valid[np.lexsort((p[valid], groups[valid]))]
+    sorted_p = p[order]
+    _, group, group_size = np.unique(groups[order], return_inverse=True, return_counts=True)
+    group_start = np.cumsum(group_size) - group_size
+    rank = np.arange(len(order)) - group_start[group] + 1
+    size = group_size[group]
+
+    # Step-up: running minimum of p * m / rank from each group's largest p-value down,
+    # with one row per group padded by inf so the minimum never crosses groups
+    ranked = np.full((len(group_size), group_size.max()), np.inf)
+    ranked[group, rank - 1] = np.minimum(sorted_p * size / rank, 1)
+    ranked = np.minimum.accumulate(ranked[:, ::-1], axis=1)[:, ::-1]
+    adjusted[order] = ranked[group, rank - 1]
+
+    # Proportion of true nulls per group (Storey, Taylor & Siegmund 2004)
+    above = np.bincount(group, weights=sorted_p > storey_lambda, minlength=len(group_size))
+    pi0 = np.minimum((above + 1) / (group_size * (1 - storey_lambda)), 1)
+    qvalues[order] = pi0[group] * adjusted[order]
+    return adjusted, qvalues
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Content-addressed cache of codeml fits.
+
+Each fit is stored as a small JSON record keyed by a hash of everything that
+determines its result: the alignment contents, the tree file (topology and
+branch lengths), the marked node ids, the model specification, the codeml
+options (fix_blength, omega, ...) and the codeml binary. 2a_paml.py looks up
+every start point here before running codeml, so re-running a gene whose
+inputs are unchanged does not refit anything.
+
+The cache is bounded by size: looking an entry up refreshes its modification
+time, and pruning removes the least recently used entries first. Run this
+file directly to inspect or prune a cache directory.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import hashlib  # Cache keys
+import json  # Cache records
+import os  # Atomic writes and access times
+import shutil  # Finding the codeml binary
+import time  # Ages of cache entries
+import typer  # CLI argument handler
+
+app = typer.Typer()
+
+
+def file_digest(path):
+    '''returns the sha256 hex digest of a file's contents'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def codeml_version(execpath=''):
+    '''returns a digest of the codeml binary, so a new codeml build invalidates old fits'''
+    binary = os.path.join(execpath, 'codeml') if execpath else shutil.which('codeml')
+    if not binary or not os.path.isfile(binary):
+        return 'unknown'
+    return file_digest(binary)
+
+
+def fit_key(alignment_digest, tree_digest, marked_ids, model_specifications, options, codeml):
+    '''returns the cache key of one codeml fit'''
+    # The part after the model name ('bl_0.2w') is only a label; the options carry the start point
+    model_name = model_specifications.split('.')[0]
+    parts = {
+        'alignment': alignment_digest,
+        'tree': tree_digest,
+        'marks': sorted(int(node_id) for node_id in set(marked_ids)),
+        'model': model_name,
+        'options': {key: options[key] for key in sorted(options)},
+        'codeml': codeml,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class CachedFit:
+    """a codeml fit record, from the cache or from codeml_parser.parse_fit(), with the
+       attributes 2a_paml.py reads from a model"""
+
+    def __init__(self, record):
+        self.name = record['name']
+        self.lnL = record['lnL']
+        self.np = record.get('np')
+        self.branches = {int(node_id): branch for node_id, branch in record['branches'].items()}
+        self.classes = record['classes']
+        self.runtime = record.get('runtime')
+
+
+class FitCache:
+    """directory of JSON fit records, two-level fan-out by key prefix"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        '''returns the cached record for a key, or None'''
+        path = self._path(key)
+        try:
+            with path.open('r') as handle:
+                record = json.load(handle)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass
+        return record
+
+    def put(self, key, record):
+        '''stores a record, replacing the file atomically so concurrent jobs never see partial writes'''
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with tmp_path.open('w') as handle:
+            json.dump(record, handle)
+        os.replace(tmp_path, path)
+
+    def entries(self):
+        '''returns (path, size, last used) for every entry, least recently used first'''
+        entries = []
+        for path in self.cache_dir.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # removed by another job
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def prune(self, max_bytes=None, max_age_days=None):
+        '''removes entries older than max_age_days, then least recently used ones until the
+           cache is at most max_bytes. Returns the number of entries removed.'''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+        removed = 0
+        for path, size, last_used in entries:
+            too_old = cutoff is not None and last_used < cutoff
+            too_big = max_bytes is not None and total > max_bytes
+            if not (too_old or too_big):
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+@app.command()
+def info(
+    cache_dir: Path = typer.Argument(..., help="Path to the fit cache directory")
+):
+    """Show the number of cached fits, their total size and their ages."""
+    entries = FitCache(cache_dir).entries()
+    total = sum(size for _, size, _ in entries)
+    typer.echo(f"{len(entries)} cached fits, {total / 1e6:.1f} MB in {cache_dir}")
+    if entries:
+        now = time.time()
+        typer.echo(f"Least recently used: {(now - entries[0][2]) / 86400:.1f} days ago")
+        typer.echo(f"Most recently used: {(now - entries[-1][2]) / 86400:.1f} days ago")
+
+
+@app.command()
+def prune(
+    cache_dir: Path = typer.Argument(..., help="Path to the fit cache directory"),
+    max_mb: float = typer.Option(None, help="Remove least recently used fits until the cache is at most this size"),
+    max_age_days: float = typer.Option(None, help="Remove fits not used for this many days")
+):
+    """Remove old or least recently used fits from the cache."""
+    max_bytes = int(max_mb * 1e6) if max_mb is not None else None
+    removed = FitCache(cache_dir).prune(max_bytes=max_bytes, max_age_days=max_age_days)
+    typer.echo(f"Removed {removed} cached fits from {cache_dir}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Work queue of codeml fits on a shared filesystem.
+
+Spreads the fits of 2a_paml.py over several machines that share a
+filesystem (e.g. an NFS mount) but no scheduler. The queue is a directory:
+
+    pending/<task>.json            fits waiting for a worker
+    claimed/<task>@<worker>.json   fits a worker is running
+    done/<task>.json               outcomes, until the coordinator collects them
+    workers/<worker>.json          each worker's heartbeat
+
+`2a_paml.py --queue <dir>` is the coordinator: it writes each fit's
+directory under its --workdir, which must be on the shared filesystem at the
+same path on every machine, queues the fits, waits for their outcomes and
+writes the gene's results as usual. `worker` runs on any machine: it claims
+fits by renaming them from pending/ to claimed/, which only one worker can
+do, and runs them with codeml_driver, several at a time, with the time
+limit and retries the coordinator asked for.
+
+Workers rewrite their heartbeat file every few seconds. Fits claimed by a
+worker whose heartbeat is older than --dead-after seconds, by the
+filesystem's clock, are moved back to pending/ by the coordinators (or by
+`requeue`). A worker that is only slow to write its heartbeat, as happens on
+a busy NFS server, may still be running such a fit when another worker
+claims it, so every claim runs codeml in a directory of its own under the
+fit's, and only the worker that still holds the claim when it finishes
+moves its out and rst files into the fit's directory. Workers look at their
+claims with every heartbeat and kill the codeml runs of claims that were
+taken back. A worker that is stopped with SIGTERM or Ctrl-C kills its
+codeml runs and puts its fits back itself.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import Optional  # Optional arguments
+import asyncio  # Running several fits per worker
+import json  # Tasks and outcomes
+import os  # Atomic renames
+import shutil  # Claim directories
+import signal  # Stopping workers
+import socket  # Worker names
+import time  # Heartbeats and polling
+import uuid  # Task ids
+import typer  # CLI argument handler
+from codeml_driver import CONTROL_FILE, CodemlFit, FitOutcome, prepare_fit, run_prepared_fit  # Running codeml
+
+app = typer.Typer()
+
+HEARTBEAT_SECONDS = 15
+DEAD_AFTER_SECONDS = 120
+
+
+def worker_name():
+    '''returns a name for a worker process that is unique across machines'''
+    return f"{socket.gethostname()}-{os.getpid()}".replace('@', '_').replace('/', '_')
+
+
+class FitQueue:
+    """directory of queued, claimed and finished codeml fits, shared by coordinators and workers"""
+
+    def __init__(self, queue_dir):
+        self.queue_dir = Path(queue_dir)
+        self.pending = self.queue_dir / 'pending'
+        self.claimed = self.queue_dir / 'claimed'
+        self.done = self.queue_dir / 'done'
+        self.workers = self.queue_dir / 'workers'
+        for directory in (self.pending, self.claimed, self.done, self.workers):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _write(path, record):
+        '''writes a JSON file through a hidden temporary file, so it appears whole or not at all'''
+        tmp_path = path.with_name(f".{path.name}.{worker_name()}.tmp")
+        with tmp_path.open('w') as handle:
+            json.dump(record, handle)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _names(directory, suffix='.json'):
+        '''returns the names of the files in a queue directory, oldest task first'''
+        return sorted(name for name in os.listdir(directory) if name.endswith(suffix) and not name.startswith('.'))
+
+    def now(self):
+        '''returns the filesystem's time, which heartbeats written from other machines are compared to'''
+        clock = self.queue_dir / 'clock'
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def submit(self, task):
+        '''queues a task and returns its id; ids sort in the order tasks were queued'''
+        task_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self._write(self.pending / f"{task_id}.json", task)
+        return task_id
+
+    def claim(self, worker):
+        '''claims the oldest pending task for a worker; returns (task id, task), or None if
+           there is none'''
+        for name in self._names(self.pending):
+            task_id = name[:-len('.json')]
+            claim = self.claimed / f"{task_id}@{worker}.json"
+            try:
+                os.rename(self.pending / name, claim)
+            except FileNotFoundError:
+                continue  # claimed by another worker first
+            with claim.open('r') as handle:
+                return task_id, json.load(handle)
+        return None
+
+    def holds(self, task_id, worker):
+        '''returns True if a worker still holds its claim on a task'''
+        return (self.claimed / f"{task_id}@{worker}.json").exists()
+
+    def finish(self, task_id, worker, outcome, results=None):
+        '''records the outcome of a claimed task, first moving the files in results, a
+           {path: destination} dict, into place; returns False, dropping the outcome and
+           leaving the files, if the claim was taken back because the worker was thought dead'''
+        claim = self.claimed / f"{task_id}@{worker}.json"
+        finishing = claim.with_suffix('.finishing')
+        try:
+            os.rename(claim, finishing)  # out of reach of requeue_dead()
+        except FileNotFoundError:
+            return False
+        for path, destination in (results or {}).items():
+            os.replace(path, destination)
+        self._write(self.done / f"{task_id}.json", outcome)
+        finishing.unlink()
+        return True
+
+    def release(self, worker):
+        '''puts every task a worker has claimed back in the queue; returns how many'''
+        released = 0
+        for name in self._names(self.claimed):
+            task_id, claimant = name[:-len('.json')].rsplit('@', 1)
+            if claimant == worker:
+                try:
+                    os.rename(self.claimed / name, self.pending / f"{task_id}.json")
+                    released += 1
+                except FileNotFoundError:
+                    pass
+        return released
+
+    def heartbeat(self, worker, info):
+        '''marks a worker as alive'''
+        self._write(self.workers / f"{worker}.json", dict(info, worker=worker))
+
+    def retire(self, worker):
+        '''removes the heartbeat of a worker that stopped'''
+        (self.workers / f"{worker}.json").unlink(missing_ok=True)
+
+    def worker_ages(self):
+        '''returns {worker: seconds since its last heartbeat}'''
+        now = self.now()
+        ages = {}
+        for name in self._names(self.workers):
+            try:
+                ages[name[:-len('.json')]] = now - (self.workers / name).stat().st_mtime
+            except FileNotFoundError:
+                pass
+        return ages
+
+    def requeue_dead(self, dead_after=DEAD_AFTER_SECONDS):
+        '''puts the tasks claimed by workers without a heartbeat in dead_after seconds back in
+           the queue, and forgets those workers; returns how many tasks were put back'''
+        ages = self.worker_ages()
+        requeued = 0
+        for name in self._names(self.claimed):
+            task_id, claimant = name[:-len('.json')].rsplit('@', 1)
+            if ages.get(claimant, float('inf')) > dead_after:
+                try:
+                    os.rename(self.claimed / name, self.pending / f"{task_id}.json")
+                    requeued += 1
+                except FileNotFoundError:
+                    pass
+        for worker, age in ages.items():
+            if age > dead_after:
+                self.retire(worker)
+        return requeued
+
+    def take_outcome(self, task_id):
+        '''returns and removes the outcome of a finished task, or None if it isn't finished'''
+        path = self.done / f"{task_id}.json"
+        try:
+            with path.open('r') as handle:
+                outcome = json.load(handle)
+        except FileNotFoundError:
+            return None
+        path.unlink(missing_ok=True)
+        return outcome
+
+    def withdraw(self, task_id):
+        '''removes a task that is still pending, and the outcome of one that finished'''
+        (self.pending / f"{task_id}.json").unlink(missing_ok=True)
+        (self.done / f"{task_id}.json").unlink(missing_ok=True)
+
+    def counts(self):
+        '''returns the number of pending, claimed and done tasks'''
+        return {'pending': len(self._names(self.pending)),
+                'claimed': len(self._names(self.claimed)) + len(self._names(self.claimed, '.finishing')),
+                'done': len(self._names(self.done))}
+
+    def run_fits(self, fits, workdir, alignment_text, marked_newick, timeout=None, retries=2, poll=1.0,
+                 dead_after=DEAD_AFTER_SECONDS):
+        '''
+        Run codeml fits of one alignment and tree on the queue's workers, as
+        codeml_driver.run_fits() runs them locally.
+
+        Args:
+            fits (list): CodemlFit of every fit; each runs in workdir/name.
+            workdir (Path): Directory to make the fit directories in, which workers must see
+                at the same path.
+            alignment_text (str): The alignment in PAML format.
+            marked_newick (str): The tree with the foreground marked.
+            timeout (float): Seconds after which a run is killed and retried, or None.
+            retries (int): Times a timed out or failed fit is retried from a perturbed start point.
+            poll (float): Seconds between checks for finished fits.
+            dead_after (float): Seconds without a heartbeat after which a worker's fits are requeued.
+
+        Returns:
+            list: The FitOutcome of every fit, in the order of fits.
+        '''
+        workdir = Path(workdir).resolve()
+        tasks = {}
+        for fit in fits:
+            fit_dir = workdir / fit.name
+            prepare_fit(fit_dir, fit.model, fit.options, alignment_text, marked_newick)
+            task = {'fit': fit._asdict(), 'fit_dir': str(fit_dir), 'timeout': timeout, 'retries': retries,
+                    'coordinator': worker_name()}
+            tasks[self.submit(task)] = fit
+        outcomes = {}
+        try:
+            while True:
+                for task_id in [task_id for task_id in tasks if task_id not in outcomes]:
+                    outcome = self.take_outcome(task_id)
+                    if outcome is not None:
+                        outcomes[task_id] = FitOutcome(tasks[task_id], outcome['status'], outcome['seconds'],
+                                                       outcome['attempts'], outcome['options'], outcome['error'])
+                if len(outcomes) == len(tasks):
+                    break
+                self.requeue_dead(dead_after)
+                time.sleep(poll)
+        except BaseException:
+            # Interrupted: fits no worker has started are taken off the queue
+            for task_id in tasks:
+                self.withdraw(task_id)
+            raise
+        return [outcomes[task_id] for task_id in tasks]
+
+
+async def work(queue, worker, codeml='codeml', jobs=1, heartbeat=HEARTBEAT_SECONDS, idle_exit=None, poll=2.0):
+    '''claims and runs tasks, jobs at a time, until cancelled, or until no task was found for
+       idle_exit seconds; returns the number of tasks run'''
+    running = set()
+    claims = {}  # task id -> the asyncio task running it
+    finished = 0
+    started = time.time()
+
+    def beat():
+        queue.heartbeat(worker, {'host': socket.gethostname(), 'pid': os.getpid(), 'started': started,
+                                 'running': len(running), 'finished': finished, 'jobs': jobs})
+
+    async def beat_forever():
+        while True:
+            await asyncio.sleep(heartbeat)
+            beat()
+            for task_id, running_task in list(claims.items()):
+                if not queue.holds(task_id, worker):
+                    print(f"Stopping {task_id}: it was requeued while running here", flush=True)
+                    running_task.cancel()  # kills its codeml run
+
+    async def run(task_id, task):
+        nonlocal finished
+        fit = CodemlFit(**task['fit'])
+        fit_dir = Path(task['fit_dir'])
+        # codeml runs in a directory of this claim's own, so it never writes into a run of
+        # the same fit that another worker claimed after this one was thought dead
+        claim_dir = fit_dir / f".{worker}"
+        try:
+            claim_dir.mkdir(exist_ok=True)
+            for name in ('algn', 'tree', CONTROL_FILE):
+                shutil.copyfile(fit_dir / name, claim_dir / name)
+            outcome = await run_prepared_fit(fit, claim_dir, codeml, task['timeout'], task['retries'])
+            record = {'status': outcome.status, 'seconds': outcome.seconds, 'attempts': outcome.attempts,
+                      'options': outcome.options, 'error': outcome.error}
+        except asyncio.CancelledError:
+            shutil.rmtree(claim_dir, ignore_errors=True)
+            raise
+        except Exception as e:
+            record = {'status': 'failed', 'seconds': 0.0, 'attempts': 1, 'options': fit.options, 'error': repr(e)}
+        record['worker'] = worker
+        results = {claim_dir / name: fit_dir / name for name in ('out', 'rst', CONTROL_FILE)
+                   if (claim_dir / name).exists()}
+        if queue.finish(task_id, worker, record, results):
+            finished += 1
+            print(f"{record['status']}: {fit_dir} in {record['seconds']:.1f} s", flush=True)
+        else:
+            print(f"Dropped {fit_dir}: it was requeued while running here", flush=True)
+        shutil.rmtree(claim_dir, ignore_errors=True)
+
+    beat()
+    beat_task = asyncio.create_task(beat_forever())
+    idle_since = time.monotonic()
+    try:
+        while True:
+            while len(running) < jobs:
+                claimed = queue.claim(worker)
+                if claimed is None:
+                    break
+                task = asyncio.create_task(run(*claimed))
+                running.add(task)
+                claims[claimed[0]] = task
+                task.add_done_callback(running.discard)
+                task.add_done_callback(lambda _, task_id=claimed[0]: claims.pop(task_id, None))
+            if running:
+                idle_since = time.monotonic()
+            elif idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                break
+            await asyncio.sleep(poll)
+    finally:
+        beat_task.cancel()
+        for task in running:
+            task.cancel()  # kills their codeml runs
+        await asyncio.gather(*running, return_exceptions=True)
+        released = queue.release(worker)
+        if released:
+            print(f"Put {released} unfinished fits back in the queue", flush=True)
+        queue.retire(worker)
+    return finished
+
+
+@app.command()
+def worker(
+    queue_dir: Path = typer.Argument(..., help="Path to the queue directory on the shared filesystem"),
+    jobs: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j", help="Fits to run at once"),
+    codeml: str = typer.Option('codeml', help="codeml executable on this machine"),
+    heartbeat: float = typer.Option(HEARTBEAT_SECONDS, help="Seconds between heartbeats"),
+    idle_exit: Optional[float] = typer.Option(None, help="Stop after this many minutes without a fit to run"),
+    poll: float = typer.Option(2.0, help="Seconds between looks for new fits")
+):
+    """Claim and run fits from the queue until stopped."""
+    queue = FitQueue(queue_dir)
+    name = worker_name()
+    typer.echo(f"Worker {name} running up to {jobs} fits from {queue_dir}")
+
+    async def main():
+        # SIGTERM stops the worker as Ctrl-C does, putting its unfinished fits back
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        return await work(queue, name, codeml, jobs, heartbeat, idle_exit * 60 if idle_exit else None, poll)
+
+    try:
+        finished = asyncio.run(main())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        typer.echo(f"Worker {name} stopped")
+        raise typer.Exit(code=130)
+    typer.echo(f"Worker {name} ran {finished} fits and found no more")
+
+
+@app.command()
+def status(
+    queue_dir: Path = typer.Argument(..., help="Path to the queue directory"),
+    dead_after: float = typer.Option(DEAD_AFTER_SECONDS, help="Seconds without a heartbeat after which a worker is dead")
+):
+    """Show the number of queued, running and finished fits, and the workers."""
+    queue = FitQueue(queue_dir)
+    counts = queue.counts()
+    typer.echo(f"{counts['pending']} pending, {counts['claimed']} running, {counts['done']} finished and not collected")
+    for name, age in sorted(queue.worker_ages().items()):
+        try:
+            with (queue.workers / f"{name}.json").open('r') as handle:
+                info = json.load(handle)
+        except (FileNotFoundError, json.JSONDecodeError):
+            info = {}
+        state = 'dead' if age > dead_after else 'alive'
+        typer.echo(f"{name}: {state}, last heartbeat {age:.0f} s ago, running {info.get('running', '?')} "
+                   f"of {info.get('jobs', '?')}, {info.get('finished', '?')} fits finished")
+
+
+@app.command()
+def requeue(
+    queue_dir: Path = typer.Argument(..., help="Path to the queue directory"),
+    dead_after: float = typer.Option(DEAD_AFTER_SECONDS, help="Seconds without a heartbeat after which a worker is dead")
+):
+    """Put the fits of dead workers back in the queue now."""
+    requeued = FitQueue(queue_dir).requeue_dead(dead_after)
+    typer.echo(f"Put {requeued} fits of dead workers back in {queue_dir}")
+
+
+if __name__ == "__main__":
+    app()
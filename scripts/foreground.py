@@ -0,0 +1,78 @@
+"""Foreground branch selection for the PAML and RELAX trees.
+
+Marking a node labels the branch leading to it. Given the test taxa, the
+foreground is one of:
+
+- induced: the test taxa and every common ancestor of two or more of them,
+  i.e. every branch of the subtree that connects the test taxa. This is the
+  node set the original scripts found by taking get_common_ancestor of every
+  combination of test taxa.
+- clade: every node whose descendant taxa are all test taxa, i.e. all
+  branches within the test clades.
+- stem: only the root node of each test clade, i.e. the branch leading to
+  the clade.
+
+All three are found in one post-order traversal, so marking is linear in the
+size of the tree instead of exponential in the number of test taxa.
+"""
+
+FOREGROUND_MODES = ('induced', 'clade', 'stem')
+
+
+def foreground_nodes(tree, test_taxa, mode='induced'):
+    '''
+    Find the foreground nodes of a tree for a set of test taxa.
+
+    Args:
+        tree (TreeNode): The tree, or an EvolTree.
+        test_taxa (iterable): Names of the test taxa.
+        mode (str): One of FOREGROUND_MODES.
+
+    Returns:
+        list: The foreground nodes in post-order, so every node comes after its descendants.
+    '''
+    if mode not in FOREGROUND_MODES:
+        raise ValueError(f"Unknown foreground mode {mode!r}, expected one of {', '.join(FOREGROUND_MODES)}")
+    test_taxa = set(test_taxa)
+    if not test_taxa:
+        raise ValueError("No test taxa given")
+
+    found = set()
+    test_leaves = {}  # node -> number of descendant test taxa
+    all_leaves = {}  # node -> number of descendant taxa
+    foreground = []
+    for node in tree.traverse('postorder'):
+        if node.is_leaf():
+            is_test = node.name in test_taxa
+            if is_test:
+                found.add(node.name)
+            test_leaves[node] = int(is_test)
+            all_leaves[node] = 1
+            in_foreground = is_test
+        else:
+            test_leaves[node] = sum(test_leaves[child] for child in node.children)
+            all_leaves[node] = sum(all_leaves[child] for child in node.children)
+            if mode == 'induced':
+                in_foreground = sum(1 for child in node.children if test_leaves[child]) >= 2
+            else:
+                in_foreground = test_leaves[node] == all_leaves[node]
+        if in_foreground:
+            foreground.append(node)
+
+    missing = test_taxa - found
+    if missing:
+        raise ValueError(f"Test taxa not found in the tree: {', '.join(sorted(missing))}")
+
+    if mode == 'stem':
+        # A clade node whose parent is also in a test clade isn't a clade root
+        in_clade = set(foreground)
+        foreground = [node for node in foreground if node.up is None or node.up not in in_clade]
+    return foreground
+
+
+def mark_foreground(tree, test_taxa, mode='induced'):
+    '''marks the foreground branches of an EvolTree with #1 in a single mark_tree call,
+       and returns the marked node ids in post-order'''
+    marked_ids = [node.node_id for node in foreground_nodes(tree, test_taxa, mode)]
+    tree.mark_tree(marked_ids)
+    return marked_ids
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Timing and memory records of pipeline runs.
+
+Tracing is off unless SELECTION_PIPELINE_TRACE is set to a file or an
+existing directory. Then every script that imports this module appends
+JSON lines to the file (or to <directory>/<script>.<pid>.jsonl) when it
+exits:
+
+- a "phase" record for every `with phase(name):` block or `@timed` call:
+  wall seconds, resident set at its end and the peak resident set sampled
+  while it ran, in MB
+- a "fit" record for every codeml start point 2a_paml.py fits or takes
+  from the cache: model, start point, codeml seconds, lnL and np, and the
+  alignment's codons and taxa
+- one "job" record: the script, its arguments, wall seconds and peak
+  resident set
+
+Every record carries the script name, pid, host and SELECTION_PIPELINE_RUN
+if it is set, so records of a whole Snakemake run can go into one file.
+Aggregate them into per-stage and per-model hot spots with
+`python scripts/instrument.py summary <file or directory>...`.
+
+When tracing is off, phase() returns a shared no-op context manager,
+@timed returns the function unchanged and record() returns at once, so
+the instrumentation costs one function call per phase.
+"""
+
+from contextlib import nullcontext  # No-op phases when tracing is off
+from pathlib import Path  # Manipulating filenames
+from typing import List  # Several trace files
+import atexit  # Writing records when a script exits
+import fcntl  # Appending to a shared trace file
+import functools  # Decorated functions keep their names
+import json  # Records
+import os  # Environment and pids
+import resource  # Peak resident set
+import socket  # Host name
+import sys  # Script name and arguments
+import threading  # Sampling the resident set
+import time  # Timing
+import typer  # CLI argument handler
+
+TRACE = os.environ.get('SELECTION_PIPELINE_TRACE') or None
+RUN = os.environ.get('SELECTION_PIPELINE_RUN') or None
+SAMPLE_INTERVAL = float(os.environ.get('SELECTION_PIPELINE_TRACE_INTERVAL', '0.05'))
+
+_NULL_PHASE = nullcontext()
+_records = []
+_open_peaks = {}  # id of each running phase -> largest resident set sampled in it, in MB
+_sampler = None
+_started = time.perf_counter()
+_script = Path(sys.argv[0]).stem if sys.argv and sys.argv[0] else 'python'
+
+app = typer.Typer()
+
+
+def enabled():
+    '''returns True if records are being collected'''
+    return TRACE is not None
+
+
+def rss_mb():
+    '''returns the current resident set in MB, or the peak one where /proc is unavailable'''
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    '''returns the peak resident set of this process so far in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def process_seconds():
+    '''returns the wall seconds since this process started, or since this module was imported
+       where /proc is unavailable'''
+    try:
+        with open('/proc/self/stat', 'rb') as stat:
+            start_ticks = int(stat.read().rsplit(b')', 1)[1].split()[19])
+        with open('/proc/uptime', 'rb') as uptime:
+            return float(uptime.read().split()[0]) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _started
+
+
+def _sample():
+    while True:
+        current = rss_mb()
+        for key, peak in list(_open_peaks.items()):
+            if current > peak:
+                _open_peaks[key] = current
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _start_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = threading.Thread(target=_sample, name='rss-sampler', daemon=True)
+        _sampler.start()
+
+
+def record(kind, name, **fields):
+    '''adds a record of the given kind; does nothing when tracing is off'''
+    if TRACE is None:
+        return
+    _records.append({'kind': kind, 'name': name, 'script': _script, 'pid': os.getpid(),
+                     'run': RUN, 'time': time.time(), **fields})
+    if len(_records) >= 1000:
+        flush()
+
+
+class _Phase:
+    """times a block and samples its peak resident set"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        _start_sampler()
+        self.rss = rss_mb()
+        _open_peaks[id(self)] = self.rss
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.started
+        end_rss = rss_mb()
+        peak = max(_open_peaks.pop(id(self), end_rss), end_rss)
+        record('phase', self.name, seconds=seconds, rss_mb=end_rss, peak_rss_mb=peak,
+               failed=exc_type is not None, **self.fields)
+        return False
+
+
+def phase(name, **fields):
+    '''context manager recording the wall time and peak resident set of a named phase'''
+    if TRACE is None:
+        return _NULL_PHASE
+    return _Phase(name, fields)
+
+
+def timed(name=None):
+    '''decorator recording every call of a function as a phase, named after the function by default'''
+    def decorate(function):
+        if TRACE is None:
+            return function
+        phase_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Phase(phase_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _trace_file():
+    path = Path(TRACE)
+    if path.is_dir():
+        return path / f"{_script}.{os.getpid()}.jsonl"
+    return path
+
+
+def flush():
+    '''appends the collected records to the trace file'''
+    if TRACE is None or not _records:
+        return
+    lines = ''.join(json.dumps(entry, default=str) + '\n' for entry in _records)
+    _records.clear()
+    with open(_trace_file(), 'a') as trace:
+        fcntl.flock(trace, fcntl.LOCK_EX)
+        trace.write(lines)
+
+
+def _finish():
+    record('job', _script, seconds=process_seconds(), peak_rss_mb=peak_rss_mb(),
+           argv=sys.argv[1:], host=socket.gethostname())
+    flush()
+
+
+if TRACE is not None:
+    atexit.register(_finish)
+
+
+def read_records(paths):
+    '''yields the records of trace files, and of the .jsonl files in trace directories'''
+    for path in paths:
+        files = sorted(path.glob('*.jsonl')) if path.is_dir() else [path]
+        for trace_file in files:
+            with trace_file.open('r') as trace:
+                for line in trace:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def _table(title, header, rows):
+    typer.echo(f"\n{title}")
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        typer.echo('  '.join(str(value).rjust(width) if i else str(value).ljust(width)
+                             for i, (value, width) in enumerate(zip(row, widths))))
+
+
+@app.callback()
+def cli():
+    """Read the timing and memory records of pipeline runs."""
+
+
+@app.command()
+def summary(
+    paths: List[Path] = typer.Argument(..., help="Trace files, or directories of them"),
+    run: str = typer.Option(None, help="Only summarise records of this SELECTION_PIPELINE_RUN"),
+    top: int = typer.Option(10, help="Number of slowest start points to list")
+):
+    """Aggregate trace records into per-stage and per-model hot spots."""
+    jobs, phases, models, fits = {}, {}, {}, []
+    for entry in read_records(paths):
+        if run is not None and entry.get('run') != run:
+            continue
+        if entry['kind'] == 'job':
+            stats = jobs.setdefault(entry['script'], [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += entry['seconds']
+            stats[2] = max(stats[2], entry['peak_rss_mb'])
+        elif entry['kind'] == 'phase':
+            stats = phases.setdefault((entry['script'], entry['name']), [0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += entry['seconds']
+            stats[2] = max(stats[2], entry['seconds'])
+            stats[3] = max(stats[3], entry['peak_rss_mb'])
+        elif entry['kind'] == 'fit':
+            stats = models.setdefault(entry['model'], [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += bool(entry.get('cached'))
+            if not entry.get('cached'):
+                stats[2] += entry.get('seconds') or 0.0
+                stats[3] = max(stats[3], entry.get('seconds') or 0.0)
+                fits.append(entry)
+
+    if not jobs and not phases and not models:
+        typer.echo("Error: No trace records found")
+        raise typer.Exit(code=1)
+
+    _table("Jobs per script", ['script', 'jobs', 'total s', 'mean s', 'peak MB'],
+           [[script, n, f"{total:.2f}", f"{total / n:.3f}", f"{peak:.0f}"]
+            for script, (n, total, peak) in sorted(jobs.items(), key=lambda item: -item[1][1])])
+    script_time = {script: stats[1] for script, stats in jobs.items()}
+    _table("Phases", ['script', 'phase', 'calls', 'total s', 'max s', '% of script', 'peak MB'],
+           [[script, name, n, f"{total:.2f}", f"{longest:.3f}",
+             f"{100 * total / script_time[script]:.1f}" if script_time.get(script) else '-', f"{peak:.0f}"]
+            for (script, name), (n, total, longest, peak) in sorted(phases.items(), key=lambda item: -item[1][1])])
+    if models:
+        _table("codeml fits per model", ['model', 'fits', 'cached', 'codeml s', 'mean s', 'max s'],
+               [[model, n, cached, f"{total:.2f}", f"{total / (n - cached):.3f}" if n > cached else '-', f"{longest:.3f}"]
+                for model, (n, cached, total, longest) in sorted(models.items(), key=lambda item: -item[1][2])])
+    if fits:
+        slowest = sorted(fits, key=lambda entry: -(entry.get('seconds') or 0.0))[:top]
+        _table(f"Slowest {len(slowest)} start points", ['alignment', 'start point', 'codeml s', 'lnL'],
+               [[entry.get('alignment', ''), entry['name'], f"{entry['seconds']:.3f}", entry.get('lnL')]
+                for entry in slowest])
+
+
+if __name__ == "__main__":
+    app()
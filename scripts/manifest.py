@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Index of the alignment files the pipeline has made.
+
+One tab-separated file lists every alignment with its lineage, gene, stage,
+size and sha256 checksum, so the Snakefile can work out which stage the
+alignments are at, and which gene groups each lineage has, by reading one
+small file instead of globbing the alignment directories. Each Snakemake
+rule adds the files it writes and removes the files it deletes.
+
+Stages follow the directory layout:
+
+- source: original_files/<alignment>.fasta
+- original, filtered, stops_trimmed:
+  alignments/<lineage>/<alignment>[_<stage>].fasta
+- gaps_trimmed: alignments/<lineage>/<alignment>_<lineage>_gaps_trimmed.fasta
+- concatenated: alignments/<lineage>/<gene group>/<alignment>.fasta
+- paml: paml/<lineage>/<gene group>/<alignment>.fasta
+
+Paths are stored relative to the directory of the manifest. Updates hold
+an exclusive lock on <manifest>.lock, so parallel jobs can update it. The
+first update builds the whole index by scanning once. If files are added or
+removed outside the pipeline, rebuild it with `python scripts/manifest.py
+rebuild`.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, NamedTuple  # Index entries
+import fcntl  # Locking the manifest while it is updated
+import os  # Atomic writes and relative paths
+import typer  # CLI argument handler
+from fit_cache import file_digest  # Checksums
+
+app = typer.Typer()
+
+MANIFEST = 'alignment_manifest.tsv'
+ALIGNMENT_STAGES = ('original', 'filtered', 'stops_trimmed', 'gaps_trimmed')
+STAGES = ('source',) + ALIGNMENT_STAGES + ('concatenated', 'paml')
+
+# Stage suffixes of alignments/<lineage>/<alignment>_<stage>.fasta, most processed first
+_STAGE_SUFFIXES = [('_gaps_trimmed', 'gaps_trimmed'), ('_stops_trimmed', 'stops_trimmed'), ('_filtered', 'filtered')]
+
+# Alignment files the manifest indexes, relative to its directory
+_PATTERNS = ['original_files/*.fasta', 'alignments/*/*.fasta', 'alignments/*/*/*.fasta', 'paml/*/*/*.fasta']
+
+
+class ManifestEntry(NamedTuple):
+    """one alignment file of the pipeline"""
+    path: str  # relative to the manifest's directory
+    lineage: str  # empty for source alignments
+    gene: str  # alignment name without its stage suffix, or the gene group
+    stage: str  # one of STAGES
+    size: int  # bytes
+    sha256: str
+
+
+def describe(path):
+    '''returns (lineage, gene, stage) of an alignment from its path relative to the manifest, or None
+       if the path is not one the pipeline writes'''
+    parts = Path(path).parts
+    if len(parts) == 2 and parts[0] == 'original_files':
+        return '', Path(parts[1]).stem, 'source'
+    if len(parts) == 3 and parts[0] == 'alignments':
+        stem = Path(parts[2]).stem
+        for suffix, stage in _STAGE_SUFFIXES:
+            if stem.endswith(suffix):
+                gene = stem[: -len(suffix)]
+                if stage == 'gaps_trimmed' and gene.endswith('_' + parts[1]):
+                    gene = gene[: -len(parts[1]) - 1]
+                return parts[1], gene, stage
+        return parts[1], stem, 'original'
+    if len(parts) == 4 and parts[0] == 'alignments':
+        return parts[1], parts[2], 'concatenated'
+    if len(parts) == 4 and parts[0] == 'paml':
+        return parts[1], parts[2], 'paml'
+    return None
+
+
+def make_entry(root, path):
+    '''returns the ManifestEntry of an alignment file, or None if the manifest doesn't index it'''
+    relative = os.path.relpath(os.path.abspath(path), root)
+    described = describe(relative)
+    if described is None:
+        return None
+    return ManifestEntry(relative, *described, os.path.getsize(path), file_digest(path))
+
+
+def read_manifest(manifest_file=MANIFEST):
+    '''returns the entries of a manifest, or an empty list if there is none'''
+    entries = []
+    try:
+        with open(manifest_file, 'r') as manifest:
+            next(manifest, None)  # header
+            for line in manifest:
+                path, lineage, gene, stage, size, sha256 = line.rstrip('\n').split('\t')
+                entries.append(ManifestEntry(path, lineage, gene, stage, int(size), sha256))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def write_manifest(entries, manifest_file=MANIFEST):
+    '''writes entries sorted by path, replacing the manifest atomically'''
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as manifest:
+        manifest.write('\t'.join(ManifestEntry._fields) + '\n')
+        for entry in sorted(entries):
+            manifest.write('\t'.join(str(value) for value in entry) + '\n')
+    os.replace(tmp_file, manifest_file)
+
+
+def scan(root):
+    '''returns the entries of every alignment file under root'''
+    entries = []
+    for pattern in _PATTERNS:
+        for path in Path(root).glob(pattern):
+            entry = make_entry(root, path)
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+
+def update_manifest(manifest_file=MANIFEST, added=(), removed=()):
+    '''
+    Add or refresh the entries of some alignment files and drop others, under a lock.
+
+    Args:
+        manifest_file (str): Path to the manifest; it is built by scanning if it doesn't exist yet.
+        added (iterable): Paths of alignment files written, relative to the working directory.
+        removed (iterable): Paths of alignment files deleted, relative to the working directory.
+    '''
+    root = os.path.dirname(os.path.abspath(manifest_file))
+    with open(f"{manifest_file}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(manifest_file):
+            entries = {entry.path: entry for entry in read_manifest(manifest_file)}
+        else:
+            entries = {entry.path: entry for entry in scan(root)}
+        for path in removed:
+            entries.pop(os.path.relpath(os.path.abspath(path), root), None)
+        for path in added:
+            entry = make_entry(root, path)
+            if entry is not None:
+                entries[entry.path] = entry
+        write_manifest(entries.values(), manifest_file)
+
+
+@app.command()
+def add(
+    paths: List[Path] = typer.Argument(..., help="Alignment files that were written"),
+    manifest: Path = typer.Option(Path(MANIFEST), help="Path to the manifest")
+):
+    """Add alignment files to the manifest, or refresh their size and checksum."""
+    update_manifest(manifest, added=[path for path in paths if path.is_file()])
+
+
+@app.command()
+def remove(
+    paths: List[Path] = typer.Argument(..., help="Alignment files that were deleted"),
+    manifest: Path = typer.Option(Path(MANIFEST), help="Path to the manifest")
+):
+    """Remove alignment files from the manifest."""
+    update_manifest(manifest, removed=paths)
+
+
+@app.command()
+def rebuild(
+    manifest: Path = typer.Option(Path(MANIFEST), help="Path to the manifest")
+):
+    """Rebuild the manifest by scanning every alignment directory next to it."""
+    root = os.path.dirname(os.path.abspath(manifest))
+    with open(f"{manifest}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = scan(root)
+        write_manifest(entries, manifest)
+    typer.echo(f"Indexed {len(entries)} alignments in {manifest}")
+
+
+@app.command()
+def show(
+    manifest: Path = typer.Option(Path(MANIFEST), help="Path to the manifest")
+):
+    """Show the number of alignments of each lineage at each stage."""
+    counts = {}
+    for entry in read_manifest(manifest):
+        counts[(entry.lineage, entry.stage)] = counts.get((entry.lineage, entry.stage), 0) + 1
+    for (lineage, stage), count in sorted(counts.items(), key=lambda item: (item[0][0], STAGES.index(item[0][1]))):
+        typer.echo(f"{lineage or '-'}\t{stage}\t{count}")
+
+
+if __name__ == "__main__":
+    app()
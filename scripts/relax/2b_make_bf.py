@@ -1,40 +1,70 @@
-'''Usage: make_bf.py <alignment>'''
-
-
-# Check if running interactively in an iPython console, or in a script from the
-# command line
-def in_ipython():
-    try:
-        __IPYTHON__
-        return True
-    except NameError:
-        return False
-# Run in a script from the command line
-if in_ipython() is False:
-    from docopt import docopt  # Command line argument handler
-    cmdln_args = docopt(__doc__)
-    alignment_file = cmdln_args.get('<alignment>')
-# Run interactively in an iPython console
-if in_ipython() is True:
-    alignment_file = 'cemA_petrosaviid_1_2018-09-29.fasta'
-
-gene_name = alignment_file.split('_')[0]  # Retrieve gene name
-lineage_name = alignment_file.split('_')[1]
-
-start_string = '''fileToExe = "/usr/lib/hyphy/TemplateBatchFiles/RELAX.bf";
-inputRedirect = {};
-inputRedirect["01"]="Universal";
-inputRedirect["02"]= "/home/wesley/ownCloud/research/mycoheterotroph-selection/relax/'''
-
-middle_string = lineage_name + '/' + gene_name + '/' + alignment_file
-
-end_string = '''";
-inputRedirect["03"]="Y";
-inputRedirect["04"]="test";
-inputRedirect["05"]="Minimal";
-ExecuteAFile( fileToExe, inputRedirect);'''
-
-final_string = start_string + middle_string + end_string
-
-with open('relax_run.bf', 'w') as outfile:
-    outfile.write(final_string)
+#!/usr/bin/env python3
+"""Write the HyPhy batch file that runs RELAX on one gene.
+
+The batch file answers RELAX.bf's prompts: the genetic code, the alignment,
+the tree (the labelled tree 2c_make_relax_tree.py writes next to the
+alignment, or the one in the alignment file if there is none), the test
+branch label and the analysis type. Paths are written absolute, so HyPhy
+can run the batch file from any directory.
+
+RELAX.bf is looked up in --relax-bf, then $HYPHY_RELAX_BF, then the
+template directory of a system-wide HyPhy install.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several alignments per run
+import os  # Configured paths
+import typer  # CLI argument handler
+
+DEFAULT_RELAX_BF = '/usr/lib/hyphy/TemplateBatchFiles/RELAX.bf'
+BATCH_FILE_NAME = 'relax_run.bf'
+
+
+def relax_bf_path(relax_bf=None):
+    '''returns the RELAX.bf to run: the given one, $HYPHY_RELAX_BF, or the system-wide one'''
+    return str(relax_bf or os.environ.get('HYPHY_RELAX_BF') or DEFAULT_RELAX_BF)
+
+
+def marked_tree(alignment_file):
+    '''returns the one labelled tree next to an alignment, or None'''
+    trees = sorted(Path(alignment_file).parent.glob('*.tre'))
+    return trees[0] if len(trees) == 1 else None
+
+
+def batch_file(alignment_file, tree_file=None, relax_bf=None, genetic_code='Universal', test_label='test',
+               analysis='Minimal'):
+    '''returns the text of a batch file running RELAX on an alignment, with the tree in
+       tree_file or, if it is None, the tree in the alignment file'''
+    tree_answer = str(Path(tree_file).resolve()) if tree_file is not None else 'Y'
+    return (f'fileToExe = "{relax_bf_path(relax_bf)}";\n'
+            'inputRedirect = {};\n'
+            f'inputRedirect["01"]="{genetic_code}";\n'
+            f'inputRedirect["02"]= "{Path(alignment_file).resolve()}";\n'
+            f'inputRedirect["03"]="{tree_answer}";\n'
+            f'inputRedirect["04"]="{test_label}";\n'
+            f'inputRedirect["05"]="{analysis}";\n'
+            'ExecuteAFile( fileToExe, inputRedirect);')
+
+
+def main(
+    alignments: List[Path] = typer.Argument(..., help="Alignments to write batch files for, one gene each"),
+    tree: Optional[Path] = typer.Option(None, help="With one alignment, its labelled tree. Defaults to the one "
+                                                   ".tre file next to each alignment, if there is one"),
+    relax_bf: Optional[str] = typer.Option(None, help=f"Path to RELAX.bf [default: $HYPHY_RELAX_BF or {DEFAULT_RELAX_BF}]"),
+    test_label: str = typer.Option('test', help="Label of the foreground branches in the tree"),
+    out: Optional[Path] = typer.Option(None, help=f"With one alignment, where to write its batch file. "
+                                                  f"Defaults to {BATCH_FILE_NAME} next to each alignment")
+):
+    if len(alignments) > 1 and (tree is not None or out is not None):
+        typer.echo("Error: --tree and --out need a single alignment")
+        raise typer.Exit(code=1)
+
+    for alignment_file in alignments:
+        out_file = out or alignment_file.parent / BATCH_FILE_NAME
+        out_file.write_text(batch_file(alignment_file, tree or marked_tree(alignment_file), relax_bf,
+                                       test_label=test_label))
+        typer.echo(f"RELAX batch file written to {out_file}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,11 +1,5 @@
+#!/bin/bash
 
-for dir in relax/*/; do
-    cd $dir
-    for subdir in */; do
-        cd $subdir
-        echo "Making a bf for" *.fasta "in dir" $subdir
-        python ../../../scripts/make_bf.py *.fasta
-        cd ..
-    done
-    cd ../../
-done
\ No newline at end of file
+# One batch file per gene, next to its alignment and labelled tree. Set
+# HYPHY_RELAX_BF to the RELAX.bf of your HyPhy install if it isn't in /usr/lib/hyphy
+python scripts/relax/2b_make_bf.py relax/*/*/*.fasta
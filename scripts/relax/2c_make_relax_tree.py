@@ -1,103 +1,112 @@
-'''Usage: make_relax_tree.py <tree> <alignment> <test_taxa>'''
+#!/usr/bin/env python3
 
-from Bio import SeqIO
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several alignments per run
 from ete3 import EvolTree  # Manipulating trees
-import os  # Manipulating filenames
-from itertools import combinations
-
-# Check if running interactively in an iPython console, or in a script from the
-# command line
-def in_ipython():
-    try:
-        __IPYTHON__
-        return True
-    except NameError:
-        return False
-# Run in a script from the command line
-if in_ipython() is False:
-    from docopt import docopt  # Command line argument handler
-    cmdln_args = docopt(__doc__)
-    tree_file = cmdln_args.get('<tree>')
-    alignment_file = cmdln_args.get('<alignment>')
-    test_taxa_file = cmdln_args.get('<test_taxa>')
-# Run interactively in an iPython console
-if in_ipython() is True:
-    tree_file = 'petrosaviids_aphyllorchis.tre'
-    alignment_file = 'accD_aphyllorchis_2018-10-02.fasta'
-    test_taxa_file = 'test_taxa_aphyllorchis.txt'
-
-
-alignment_name = os.path.basename(alignment_file)  # Retrieve filename
-gene_name = alignment_name.split('_')[0]  # Retrieve gene name
-alignment_format = os.path.splitext(alignment_file)[1]  # Retrieve filetype
-alignment_format = alignment_format[1:]  # Remove '.' character from filetype
-
-
-# Check if the alignment contains any empty sequences
-empty_seq_count = 0
-for record in SeqIO.parse(alignment_file, format=alignment_format):
-    gapSeq = '-'*len(record.seq)
-    if (str(record.seq).upper().replace("N", "-")) == gapSeq:  # if it's just gaps
-        empty_seq_count += 1
-
-# If there were empty sequences found in the alignment, make a new alignment
-# with empty sequences removed and record the names of the taxa in the new 
-# alignment for pruning the tree
-if empty_seq_count >= 1:
-    trimmed_alignment = []
+import os  # Replacing alignments atomically
+import sys  # Finding the shared modules in scripts/
+import typer  # CLI argument handler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from foreground import FOREGROUND_MODES, foreground_nodes  # Shared foreground branch selection
+from instrument import phase  # Timing records
+
+
+def write_alignment(alignment, out_file):
+    '''writes an alignment through a temporary file, so a staged link to another
+       alignment is replaced rather than written through'''
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    alignment.write(tmp_file)
+    os.replace(tmp_file, out_file)
+
+
+def make_relax_tree(newick, alignment_file, test_taxa, foreground_mode='induced', out_tree=None, out_alignment=None):
+    '''
+    Label the foreground branches of a tree for RELAX, pruned to the taxa with sequences in an alignment.
+
+    Args:
+        newick (str): The tree, or the path of its file.
+        alignment_file (Path): The alignment of one gene.
+        test_taxa (list): Names of the test taxa.
+        foreground_mode (str): One of foreground.FOREGROUND_MODES.
+        out_tree (Path): Where to write the labelled tree.
+        out_alignment (Path): Where to write the alignment without its empty sequences.
+            Defaults to rewriting alignment_file, if it has any.
+
+    Returns:
+        int: The number of empty sequences removed from the alignment.
+    '''
+    alignment_format = Path(alignment_file).suffix[1:]  # Remove '.' character from filetype
+
+    # Check if the alignment contains any empty sequences (just gaps or N's)
+    with phase('read_alignment'):
+        alignment = AlignmentMatrix.open(alignment_file, alignment_format)
+    empty_rows = alignment.empty_rows()
+    empty_seq_count = int(empty_rows.sum())
+
+    # If there were empty sequences found in the alignment, make a new alignment
+    # with empty sequences removed and record the names of the taxa in the new
+    # alignment for pruning the tree
     taxa_in_alignment = []
-    for record in SeqIO.parse(alignment_file, format=alignment_format):
-        gapSeq = '-'*len(record.seq)
-        if (str(record.seq).upper().replace("N", "-")) == gapSeq:  # if it's just gaps
-            pass
-        else:
-            trimmed_alignment.append(record)
-            taxa_in_alignment.append(record.id)
-
-# Only write a new alignment if there is a new alignment
-if empty_seq_count >= 1:
-    if len(trimmed_alignment) >= 1:
-        SeqIO.write(trimmed_alignment, handle=alignment_file, \
-                    format=alignment_format)
-
-
-tree = EvolTree(tree_file)
-out_tree_name = os.path.basename(tree_file)
-out_tree_name = os.path.splitext(out_tree_name)[0]
-out_tree_name = out_tree_name + '_' + gene_name + '.tre'
-
-# If there is a new alignment, prune the tree down to the taxa that remain in
-# the new alignment
-if empty_seq_count >= 1:
+    if empty_seq_count >= 1:
+        trimmed_alignment = alignment.subset_rows(~empty_rows)
+        taxa_in_alignment = trimmed_alignment.ids
+        # Only write a new alignment if there is a new alignment
+        if len(trimmed_alignment) >= 1:
+            write_alignment(trimmed_alignment, out_alignment or alignment_file)
+    if out_alignment is not None and (empty_seq_count == 0 or not taxa_in_alignment):
+        write_alignment(alignment, out_alignment)
+
+    with phase('load_tree'):
+        tree = EvolTree(newick)
+
+    # If there is a new alignment, prune the tree down to the taxa that remain in
+    # the new alignment
     if len(taxa_in_alignment) >= 1:
-        tree.prune(taxa_in_alignment, preserve_branch_length=True)
-
-test_taxa = []
-with open(test_taxa_file, 'r') as test_taxa_list:
-    for taxon in test_taxa_list:
-        taxon = taxon.rstrip()
-        test_taxa.append(taxon)
-
-
-nodes_to_mark = set() # set since we want it to be all unique ids
-
-# Mark the test taxa
-for taxon in test_taxa:
-    taxon_node = tree&taxon # ete3 notation for finding a node within a tree
-    taxon_id = taxon_node.node_id # mark_tree only takes node_ids, not labels
-    nodes_to_mark.add(taxon_id)
-
-# Find internal nodes below the test taxa and mark them
-for i in range(len(test_taxa), 1,-1):
-    taxa_groups = [x for x in combinations(test_taxa, i)]
-    for group in taxa_groups:
-        common_node = tree.get_common_ancestor(*group)
-        taxon_id = common_node.node_id
-        nodes_to_mark.add(taxon_id)
-
-#TODO change the names of the nodes
-for mark_id in nodes_to_mark:
-    test_node = tree.search_nodes(node_id=mark_id)[0]
-    test_node.name += '{test}'
-
-tree.write(outfile=out_tree_name, format=1)
+        with phase('prune_tree'):
+            tree.prune(taxa_in_alignment, preserve_branch_length=True)
+
+    # Find the test taxa and the internal nodes below them, and label them
+    for test_node in foreground_nodes(tree, test_taxa, foreground_mode):
+        test_node.name += '{test}'
+
+    tree.write(outfile=str(out_tree), format=1)
+    return empty_seq_count
+
+
+def main(
+    tree_file: Path = typer.Argument(..., help="Path to the tree of the lineage"),
+    alignments: List[Path] = typer.Argument(..., help="Alignments to make RELAX trees for, one gene each"),
+    test_taxa_file: Path = typer.Argument(..., help="Path to the test_taxa file"),
+    foreground: str = typer.Option('induced', help=f"Foreground branches to label: {', '.join(FOREGROUND_MODES)}"),
+    out_tree: Optional[Path] = typer.Option(None, help="With one alignment, where to write its tree. Defaults to "
+                                                       "<tree>_<gene>.tre in the alignment's directory"),
+    out_alignment: Optional[Path] = typer.Option(None, help="With one alignment, where to write it without its empty "
+                                                            "sequences. Defaults to rewriting it if it has any")
+):
+    if len(alignments) > 1 and (out_tree is not None or out_alignment is not None):
+        typer.echo("Error: --out-tree and --out-alignment need a single alignment")
+        raise typer.Exit(code=1)
+
+    test_taxa = []
+    with open(test_taxa_file, 'r') as test_taxa_list:
+        for taxon in test_taxa_list:
+            taxon = taxon.rstrip()
+            test_taxa.append(taxon)
+
+    # The tree is read once and parsed again for every gene, which is cheaper than copying it
+    newick = tree_file.read_text()
+    for alignment_file in alignments:
+        gene_name = alignment_file.name.split('_')[0]  # Retrieve gene name
+        gene_tree = out_tree or alignment_file.parent / f"{tree_file.stem}_{gene_name}.tre"
+        try:
+            make_relax_tree(newick, alignment_file, test_taxa, foreground, gene_tree, out_alignment)
+        except ValueError as e:
+            typer.echo(f"Error labelling the tree of {alignment_file}: {e}")
+            raise typer.Exit(code=1)
+        typer.echo(f"RELAX tree written to {gene_tree}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
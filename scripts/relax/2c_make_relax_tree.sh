@@ -1,13 +1,8 @@
 #!/bin/bash
 
-cd relax/
-for clade in */; do
-	cd $clade
-	for gene in */; do
-		cd $gene
-		echo "Creating a tree for" "${gene:0:-1}" in $clade
-		python ../../../scripts/make_relax_tree.py ../petrosaviids_"${clade:0:-1}".tre "${gene:0:-1}"_"${clade:0:-1}"_2018-*.fasta ../test_taxa_"${clade:0:-1}".txt
-		cd ../
-	done
-	cd ../
-done
\ No newline at end of file
+# The tree of each clade is read once for all of its genes
+for clade in relax/*/; do
+	clade=$(basename $clade)
+	echo "Creating trees for the genes in" $clade
+	python scripts/relax/2c_make_relax_tree.py relax/$clade/petrosaviids_$clade.tre relax/$clade/*/*_"$clade"_2018-*.fasta relax/$clade/test_taxa_$clade.txt
+done
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Run HyPhy RELAX on every gene of every lineage.
+
+Finds the relax_run.bf batch files 2b_make_bf.py wrote under the given
+directories (e.g. relax/, relax/<lineage> or one gene directory) and runs
+HyPhy on each of them in its directory, several at a time:
+
+- every job gets a budget of --cpus-per-job CPUs, passed to HyPhy as CPU=n
+  and OMP_NUM_THREADS, and at most --cpus CPUs are used in total
+- a job that runs longer than --timeout minutes is killed, with every
+  process it started, and reported as timed out
+- genes whose RELAX JSON is newer than their batch file are skipped,
+  unless --force is given, so an interrupted run can be resumed
+
+HyPhy's output goes to relax.log in each gene directory. The hyphy
+executable is --hyphy, then $HYPHY, then hyphymp; any program that accepts
+`CPU=n <batch file>` and writes the JSON RELAX writes can stand in for it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed  # Running jobs side by side
+from pathlib import Path  # Manipulating filenames
+from typing import List, NamedTuple, Optional  # Jobs and their outcomes
+import os  # CPU counts and environment
+import re  # Reading batch files
+import signal  # Killing timed out jobs
+import subprocess  # Running HyPhy
+import sys  # Finding the shared modules in scripts/
+import threading  # Tracking running jobs
+import time  # Timing jobs
+import typer  # CLI argument handler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrument import record as trace_record  # Timing records
+
+BATCH_FILE_NAME = 'relax_run.bf'
+_ALIGNMENT = re.compile(r'inputRedirect\["02"\]\s*=\s*"([^"]*)"')
+_running = {}  # batch file -> Popen of every running job
+_running_lock = threading.Lock()
+
+
+class RelaxJob(NamedTuple):
+    """a batch file and the RELAX JSON it writes"""
+    batch_file: Path
+    json_file: Path
+
+    @property
+    def gene_dir(self):
+        return self.batch_file.parent
+
+    def is_done(self, since=None):
+        '''returns True if the JSON exists and is newer than the batch file, and was
+           written at or after the time since'''
+        try:
+            written = self.json_file.stat().st_mtime
+            return written >= self.batch_file.stat().st_mtime and (since is None or written >= since)
+        except FileNotFoundError:
+            return False
+
+
+class RelaxRun(NamedTuple):
+    """the outcome of one job: done, skipped, failed or timeout"""
+    job: RelaxJob
+    status: str
+    seconds: float
+    returncode: Optional[int] = None
+
+
+def find_jobs(paths):
+    '''returns a RelaxJob for every batch file in or under the given directories, or given directly'''
+    batch_files = []
+    for path in paths:
+        if path.is_file():
+            batch_files.append(path)
+        else:
+            batch_files.extend(sorted(path.rglob(BATCH_FILE_NAME)))
+    jobs = []
+    for batch_file in dict.fromkeys(batch_files):
+        match = _ALIGNMENT.search(batch_file.read_text())
+        if match is None:
+            raise ValueError(f"{batch_file} names no alignment")
+        alignment = Path(match.group(1))
+        if not alignment.is_absolute():
+            alignment = batch_file.parent / alignment
+        jobs.append(RelaxJob(batch_file, alignment.with_name(alignment.name + '.RELAX.json')))
+    return jobs
+
+
+def _kill(process):
+    '''stops a job and everything it started, forcefully if it does not stop within 10 s'''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def run_job(job, hyphy, cpus, timeout=None):
+    '''
+    Run HyPhy on one batch file, in its directory.
+
+    Args:
+        job (RelaxJob): The batch file and its JSON.
+        hyphy (str): The HyPhy executable.
+        cpus (int): CPUs the job may use.
+        timeout (float): Seconds after which the job is killed, or None.
+
+    Returns:
+        RelaxRun: done, failed (HyPhy couldn't be started, failed or wrote no JSON) or timeout.
+    '''
+    env = dict(os.environ, OMP_NUM_THREADS=str(cpus))
+    started = time.perf_counter()
+    started_at = time.time()
+    with open(job.gene_dir / 'relax.log', 'w') as log:
+        # A session of its own, so a timed out job is killed with every process it started
+        try:
+            process = subprocess.Popen([hyphy, f"CPU={cpus}", job.batch_file.name], cwd=job.gene_dir, env=env,
+                                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+        except OSError as e:
+            log.write(f"Could not run {hyphy}: {e}\n")
+            seconds = time.perf_counter() - started
+            trace_record('relax', str(job.gene_dir), seconds=seconds, status='failed', cpus=cpus)
+            return RelaxRun(job, 'failed', seconds)
+        with _running_lock:
+            _running[job.batch_file] = process
+        try:
+            process.wait(timeout=timeout)
+            status = 'done' if process.returncode == 0 and job.is_done(since=started_at - 1) else 'failed'
+        except subprocess.TimeoutExpired:
+            _kill(process)
+            status = 'timeout'
+        finally:
+            with _running_lock:
+                _running.pop(job.batch_file, None)
+    seconds = time.perf_counter() - started
+    trace_record('relax', str(job.gene_dir), seconds=seconds, status=status, cpus=cpus)
+    return RelaxRun(job, status, seconds, process.returncode)
+
+
+def run_jobs(jobs, hyphy, cpus_per_job=1, max_jobs=1, timeout=None, force=False):
+    '''runs jobs, max_jobs at a time, and yields a RelaxRun for each as it finishes'''
+    pending = []
+    for job in jobs:
+        if not force and job.is_done():
+            yield RelaxRun(job, 'skipped', 0.0)
+        else:
+            pending.append(job)
+    if not pending:
+        return
+    with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+        futures = [pool.submit(run_job, job, hyphy, cpus_per_job, timeout) for job in pending]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BaseException:
+            # Interrupted: don't start queued jobs, and stop the running ones
+            for future in futures:
+                future.cancel()
+            with _running_lock:
+                running = list(_running.values())
+            for process in running:
+                _kill(process)
+            raise
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def main(
+    paths: List[Path] = typer.Argument(..., help="Directories to find relax_run.bf files in, e.g. relax/, or batch files"),
+    hyphy: Optional[str] = typer.Option(None, help="HyPhy executable [default: $HYPHY or hyphymp]"),
+    cpus: int = typer.Option(os.cpu_count() or 1, help="CPUs to use in total"),
+    cpus_per_job: int = typer.Option(1, help="CPUs each HyPhy job may use"),
+    jobs: Optional[int] = typer.Option(None, "--jobs", "-j", help="Jobs to run at once [default: cpus // cpus-per-job]"),
+    timeout: Optional[float] = typer.Option(None, help="Minutes after which a job is killed"),
+    force: bool = typer.Option(False, help="Rerun genes whose RELAX JSON is up to date")
+):
+    hyphy = hyphy or os.environ.get('HYPHY') or 'hyphymp'
+    if cpus_per_job < 1 or cpus < cpus_per_job:
+        typer.echo("Error: Need at least one CPU per job, and no more CPUs per job than in total")
+        raise typer.Exit(code=1)
+    max_jobs = min(jobs or cpus // cpus_per_job, cpus // cpus_per_job)
+
+    try:
+        relax_jobs = find_jobs(paths)
+    except (OSError, ValueError) as e:
+        typer.echo(f"Error: {e}")
+        raise typer.Exit(code=1)
+    if not relax_jobs:
+        typer.echo(f"Error: No {BATCH_FILE_NAME} files found in {', '.join(map(str, paths))}")
+        raise typer.Exit(code=1)
+
+    # Jobs run in sessions of their own, so they are stopped here when this run is terminated
+    signal.signal(signal.SIGTERM, _terminate)
+    typer.echo(f"Running RELAX on {len(relax_jobs)} genes, {max_jobs} at a time with {cpus_per_job} CPUs each")
+    counts = {'done': 0, 'skipped': 0, 'failed': 0, 'timeout': 0}
+    for run in run_jobs(relax_jobs, hyphy, cpus_per_job, max_jobs, timeout * 60 if timeout else None, force):
+        counts[run.status] += 1
+        if run.status == 'skipped':
+            continue
+        exit_code = f"exit code {run.returncode}, " if run.returncode is not None else ''
+        detail = f" ({exit_code}see {run.job.gene_dir / 'relax.log'})" if run.status == 'failed' else ''
+        typer.echo(f"{run.status}: {run.job.gene_dir} in {run.seconds:.1f} s{detail}")
+
+    typer.echo(', '.join(f"{n} {status}" for status, n in counts.items()))
+    if counts['failed'] or counts['timeout']:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,11 +1,5 @@
 #!/bin/bash
 
-for dir in relax/*/; do
-    cd $dir;
-    for subdir in */; do
-        cd $subdir
-        hyphymp relax_run.bf
-        cd ..
-    done
-    cd ../../
-done
\ No newline at end of file
+# Runs every gene of every clade, as many at a time as there are CPUs; pass
+# e.g. --cpus-per-job 4 --timeout 120 to give each job more CPUs and a time limit
+python scripts/relax/2d_relax.py relax/ "$@"
@@ -1,44 +1,240 @@
-'''Usage: retrieve_results.py <json_file>'''
+#!/usr/bin/env python3
+"""Collect the RELAX results of every gene into one table.
 
-# Modules
-import json
+Finds the *.RELAX.json files under the given directories and reads from
+each only the values the table needs: the p-value, K, the likelihood ratio
+and the log likelihoods of the null and alternative fits. The file is
+memory-mapped and scanned key by key; values that aren't needed, such as the
+branch attributes and site tables, are skipped over without being decoded,
+and scanning stops once every value has been found. Both the layout of
+HyPhy 2.3 (relaxation-test, fits/Alternative/K) and of HyPhy 2.5 (test
+results, fits/RELAX alternative) are read.
 
+Files are read in parallel, and the results are written to one CSV with a
+row per clade and gene, adjusted for multiple testing per clade (or over
+all clades) like the PAML results, and optionally to the relax table of the
+results database. Clade and gene come from the file name,
+<gene>_<clade>[_...].fasta.RELAX.json.
+"""
 
-# Check if running interactively in an iPython console, or in a script from the
-# command line
-def in_ipython():
+from concurrent.futures import ProcessPoolExecutor  # Reading files in parallel
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several result directories
+import json  # Decoding the values that are needed
+import mmap  # Scanning files without reading them into memory
+import os  # CPU count
+import re  # Skipping over values
+import sys  # Finding the shared modules in scripts/
+import numpy as np  # Columns of p-values
+import typer  # CLI argument handler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fdr import fdr_adjust  # Shared false discovery rate correction
+from results_db import connect, write_relax  # Results database
+from instrument import phase  # Timing records
+
+# Columns of the table, and the paths of each in the JSON, in order of preference
+FIELDS = {
+    'p': [('relaxation-test', 'p'), ('test results', 'p-value')],
+    'K': [('fits', 'Alternative', 'K'), ('test results', 'relaxation or intensification parameter')],
+    'LR': [('relaxation-test', 'LR'), ('test results', 'LRT')],
+    'null_lnL': [('fits', 'Null', 'log-likelihood'), ('fits', 'RELAX null', 'Log Likelihood')],
+    'alt_lnL': [('fits', 'Alternative', 'log-likelihood'), ('fits', 'RELAX alternative', 'Log Likelihood')],
+}
+SCOPES = ('clade', 'global')
+
+_WHITESPACE = re.compile(rb'\s*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_NEXT_BRACKET = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*[\[\]{}]', re.S)  # skips strings whole
+_SCALAR = re.compile(rb'[^,\]}\s]+')
+
+
+def _wanted_tree(fields):
+    '''returns the paths of fields as nested dicts of keys, with True at their ends'''
+    tree = {}
+    for paths in fields.values():
+        for path in paths:
+            node = tree
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = True
+    return tree
+
+
+_WANTED = _wanted_tree(FIELDS)
+
+
+class _AllFound(Exception):
+    pass
+
+
+def _skip(buffer, position):
+    '''returns the position after the JSON value starting at position, without decoding it'''
+    first = buffer[position]
+    if first == ord('"'):
+        return _STRING.match(buffer, position).end()
+    if first not in b'[{':
+        return _SCALAR.match(buffer, position).end()
+    depth = 0
+    for match in _NEXT_BRACKET.finditer(buffer, position):
+        depth += 1 if buffer[match.end() - 1] in b'[{' else -1
+        if depth == 0:
+            return match.end()
+    raise ValueError("unterminated JSON value")
+
+
+def _scan_object(buffer, position, wanted, path, found, done):
+    '''decodes the wanted values of the JSON object starting at position into found, keyed by
+       path; returns the position after the object, or raises _AllFound once done(found)'''
+    position = _WHITESPACE.match(buffer, position + 1).end()
+    if buffer[position] == ord('}'):
+        return position + 1
+    while True:
+        key_match = _STRING.match(buffer, position)
+        if key_match is None:
+            raise ValueError(f"expected a key at byte {position}")
+        key = json.loads(key_match.group())
+        position = _WHITESPACE.match(buffer, key_match.end()).end()
+        if buffer[position] != ord(':'):
+            raise ValueError(f"expected ':' at byte {position}")
+        position = _WHITESPACE.match(buffer, position + 1).end()
+        below = wanted.get(key)
+        if below is True:
+            end = _skip(buffer, position)
+            found[path + (key,)] = json.loads(buffer[position:end])
+            position = end
+            if done(found):
+                raise _AllFound
+        elif below is not None and buffer[position] == ord('{'):
+            position = _scan_object(buffer, position, below, path + (key,), found, done)
+        else:
+            position = _skip(buffer, position)
+        position = _WHITESPACE.match(buffer, position).end()
+        if buffer[position] == ord(','):
+            position = _WHITESPACE.match(buffer, position + 1).end()
+        elif buffer[position] == ord('}'):
+            return position + 1
+        else:
+            raise ValueError(f"expected ',' or '}}' at byte {position}")
+
+
+def read_fields(json_file, fields=FIELDS):
+    '''
+    Read some values of a JSON document without decoding the rest of it.
+
+    Args:
+        json_file (Path): The JSON file, whose top level is an object.
+        fields (dict): {field: [path of keys, ...]}; the first path found gives the value.
+
+    Returns:
+        dict: {field: value}, None for fields none of whose paths were found.
+    '''
+    wanted = _WANTED if fields is FIELDS else _wanted_tree(fields)
+
+    def value(found, paths):
+        return next((found[path] for path in paths if path in found), None)
+
+    def done(found):
+        return all(any(path in found for path in paths) for paths in fields.values())
+
+    found = {}
+    with open(json_file, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            raise ValueError("empty file")
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            position = _WHITESPACE.match(buffer, 0).end()
+            if buffer[position] != ord('{'):
+                raise ValueError("not a JSON object")
+            try:
+                _scan_object(buffer, position, wanted, (), found, done)
+            except _AllFound:
+                pass
+            except IndexError:
+                raise ValueError("truncated JSON") from None
+    return {field: value(found, paths) for field, paths in fields.items()}
+
+
+def clade_and_gene(json_file):
+    '''returns the clade and gene of a <gene>_<clade>[_...].fasta.RELAX.json file'''
+    alignment_name = Path(json_file).name.split('.')[0]
+    gene_name, clade_name = (alignment_name.split('_') + [''])[:2]
+    return clade_name, gene_name
+
+
+def read_result(json_file):
+    '''returns (clade, gene, p, K, LR, null_lnL, alt_lnL, json_file) of one RELAX result,
+       or (json_file, error message) if it can't be read'''
     try:
-        __IPYTHON__
-        return True
-    except NameError:
-        return False
-# Run in a script from the command line
-if in_ipython() is False:
-    from docopt import docopt  # Command line argument handler
-    cmdln_args = docopt(__doc__)
-    json_file = cmdln_args.get('<json_file>')
-# Run interactively in an iPython console
-if in_ipython() is True:
-    json_file = 'accD_gymnoApter_2018-10-02.fasta.RELAX.json'
-    
-
-alignment_name = json_file.split('.')[0]
-gene_name = alignment_name.split('_')[0]
-clade_name = alignment_name.split('_')[1]
-date = alignment_name.split('_')[2]
-
-with open(json_file, "r") as JSON:
-    results = json.load(JSON)
-
-LRT_results = results.get('relaxation-test')
-p_value = LRT_results.get('p')
-
-fits_results = results.get('fits')
-alternative_results = fits_results.get('Alternative')
-K_value = alternative_results.get('K')
-
-final_results = clade_name + ',' + gene_name + ',' + str(p_value) + ',' + \
-                str(K_value) + '\n'
-
-with open('results.csv', 'w') as results:
-    results.write(final_results)
+        values = read_fields(json_file)
+    except (OSError, ValueError) as e:
+        return json_file, str(e)
+    return (*clade_and_gene(json_file), *values.values(), str(json_file))
+
+
+def find_results(paths):
+    '''returns the RELAX JSON files in or under the given directories, or given directly, sorted'''
+    files = []
+    for path in paths:
+        files.extend([path] if path.is_file() else path.rglob('*.RELAX.json'))
+    return sorted(set(files))
+
+
+def main(
+    paths: List[Path] = typer.Argument(..., help="Directories to find *.RELAX.json files in, e.g. relax/, or JSON files"),
+    out: Path = typer.Option(Path('relax/combined_results.csv'), help="CSV file to write the table to"),
+    db: Optional[Path] = typer.Option(None, help="Results database to store the table in as well"),
+    jobs: int = typer.Option(os.cpu_count() or 1, "--jobs", "-j", help="Number of files to read in parallel"),
+    scope: str = typer.Option('clade', help=f"Correct the p-values per: {', '.join(SCOPES)}"),
+    alpha: float = typer.Option(0.05, help="False discovery rate at which a gene is significant"),
+    storey_lambda: float = typer.Option(0.5, help="Tuning parameter of the Storey q-value estimate of pi0")
+):
+    if scope not in SCOPES:
+        typer.echo(f"Error: --scope must be one of {', '.join(SCOPES)}")
+        raise typer.Exit(code=1)
+    json_files = find_results(paths)
+    if not json_files:
+        typer.echo(f"Error: No *.RELAX.json files found in {', '.join(map(str, paths))}")
+        raise typer.Exit(code=1)
+
+    with phase('read_results', files=len(json_files)):
+        if jobs > 1 and len(json_files) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(read_result, json_files, chunksize=max(1, len(json_files) // (4 * jobs))))
+        else:
+            results = [read_result(json_file) for json_file in json_files]
+    rows = [result for result in results if len(result) > 2]
+    for json_file, error in (result for result in results if len(result) == 2):
+        typer.echo(f"Warning: Skipping {json_file}: {error}")
+    if not rows:
+        typer.echo("Error: None of the RELAX results could be read")
+        raise typer.Exit(code=1)
+
+    p = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=float)
+    if scope == 'clade':
+        _, groups = np.unique([row[0] for row in rows], return_inverse=True)
+    else:
+        groups = np.zeros(len(rows), dtype=int)
+    adjusted, qvalues = fdr_adjust(p, groups, storey_lambda)
+
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, 'w') as out_file:
+        out_file.write('clade,gene,p-value,K-value,LR,null lnL,alternative lnL,BH p-value,q-value,significant?\n')
+        for row, row_adjusted, row_q in zip(rows, adjusted, qvalues):
+            clade, gene, *values, _ = row
+            significant = '' if np.isnan(row_adjusted) else bool(row_adjusted < alpha)
+            cells = [clade, gene, *('' if value is None else value for value in values),
+                     '' if np.isnan(row_adjusted) else row_adjusted, '' if np.isnan(row_q) else row_q, significant]
+            out_file.write(','.join(str(cell) for cell in cells) + '\n')
+    typer.echo(f"RELAX results of {len(rows)} genes written to {out}")
+
+    if db is not None:
+        connection = connect(db)
+        try:
+            write_relax(connection, rows)
+        finally:
+            connection.close()
+        typer.echo(f"RELAX results stored in {db}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
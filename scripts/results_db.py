@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""SQLite store of codeml fits.
+
+2a_paml.py writes every start point it fits into one database: the clade,
+gene, model, start point, lnL, number of parameters, codeml runtime, how
+many start points the model used and whether they agreed, plus the model's
+named parameters (w, proportion_0, foreground_w_2, ...) in a second table.
+The best start point of each model is flagged, and the best_fits and
+best_parameters views select those, so 3b_paml_stats.py reads all the
+results it needs with one query. The size of each gene's alignment, in
+codons and taxa, is kept in an alignments table, so cost_model.py can relate
+runtimes to alignment sizes. RELAX results collected by
+relax/3c_retrieve_relax_results.py go into a relax table of their own, one
+row per clade and gene: p, K, the likelihood ratio and the null and
+alternative log likelihoods.
+
+Writers wait a generous busy timeout for each other, so parallel Snakemake
+jobs can write to it at the same time. 2a_paml.py puts the database in WAL
+mode, unless it hands its fits to a fit_queue.py queue: the project is then on
+a shared filesystem, where WAL's shared memory index doesn't work, so it uses
+a rollback journal. The other scripts keep whatever mode the database is in.
+Run this file directly to see what is in a database, or to export the best
+fits in the comma-separated layout of the old per-model CSVs.
+"""
+
+from itertools import groupby  # Grouping parameters by fit
+from pathlib import Path  # Manipulating filenames
+import sqlite3  # Results database
+import typer  # CLI argument handler
+
+app = typer.Typer()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY,
+    clade TEXT NOT NULL,
+    gene TEXT NOT NULL,
+    model TEXT NOT NULL,
+    start_spec TEXT NOT NULL,
+    lnL REAL,
+    np INTEGER,
+    runtime REAL,
+    starts INTEGER,
+    converged INTEGER,
+    best INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (clade, gene, model, start_spec)
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    fit_id INTEGER NOT NULL REFERENCES fits (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (fit_id, position)
+);
+CREATE TABLE IF NOT EXISTS alignments (
+    clade TEXT NOT NULL,
+    gene TEXT NOT NULL,
+    codons INTEGER NOT NULL,
+    taxa INTEGER NOT NULL,
+    PRIMARY KEY (clade, gene)
+);
+CREATE TABLE IF NOT EXISTS relax (
+    clade TEXT NOT NULL,
+    gene TEXT NOT NULL,
+    p REAL,
+    K REAL,
+    LR REAL,
+    null_lnL REAL,
+    alt_lnL REAL,
+    json_file TEXT,
+    PRIMARY KEY (clade, gene)
+);
+CREATE INDEX IF NOT EXISTS fits_best ON fits (best, clade, gene, model);
+CREATE VIEW IF NOT EXISTS best_fits AS
+    SELECT id, clade, gene, model, start_spec, lnL, np, runtime, starts, converged
+    FROM fits WHERE best = 1;
+CREATE VIEW IF NOT EXISTS best_parameters AS
+    SELECT fits.id AS fit_id, clade, gene, model, position, name, value
+    FROM fits JOIN parameters ON parameters.fit_id = fits.id
+    WHERE best = 1;
+'''
+
+
+def connect(db_file, journal_mode=None):
+    '''returns a connection to a results database, creating its tables if needed, and
+       switching it to journal_mode (e.g. WAL, or DELETE on a network filesystem) if given'''
+    connection = sqlite3.connect(str(db_file), timeout=600)
+    if journal_mode is not None:
+        connection.execute(f'PRAGMA journal_mode={journal_mode}')
+    connection.execute('PRAGMA foreign_keys=ON')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _real(value):
+    '''returns a parameter as a float, or None if codeml didn't report it'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_fits(connection, clade, gene, model, fits, best_spec, starts, converged):
+    '''
+    Replace the stored fits of one model of a gene in a single transaction.
+
+    Args:
+        connection (sqlite3.Connection): Connection from connect().
+        clade (str): Clade the gene was tested in.
+        gene (str): Gene or gene group name.
+        model (str): Model name, e.g. M0 or bsA.
+        fits (list): (start_spec, lnL, np, runtime, parameters dict) for every start point.
+        best_spec (str): start_spec of the best start point.
+        starts (int): Number of start points fitted.
+        converged (bool): Whether enough start points agreed on the best lnL.
+    '''
+    with connection:
+        connection.execute('DELETE FROM fits WHERE clade = ? AND gene = ? AND model = ?', (clade, gene, model))
+        for start_spec, lnL, n_parameters, runtime, parameters in fits:
+            fit_id = connection.execute(
+                'INSERT INTO fits (clade, gene, model, start_spec, lnL, np, runtime, starts, converged, best) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (clade, gene, model, start_spec, _real(lnL), n_parameters, runtime, starts, int(converged),
+                 int(start_spec == best_spec))
+            ).lastrowid
+            connection.executemany(
+                'INSERT INTO parameters (fit_id, position, name, value) VALUES (?, ?, ?, ?)',
+                [(fit_id, position, name, _real(value)) for position, (name, value) in enumerate(parameters.items())]
+            )
+
+
+def write_alignment(connection, clade, gene, codons, taxa):
+    '''records the size of the alignment a gene's models were fitted to'''
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO alignments (clade, gene, codons, taxa) VALUES (?, ?, ?, ?)',
+                           (clade, gene, codons, taxa))
+
+
+def fit_runtimes(connection):
+    '''returns (model, codons, taxa, runtime) of every start point with a recorded runtime
+       whose alignment size is known'''
+    return connection.execute(
+        'SELECT model, codons, taxa, runtime FROM fits JOIN alignments USING (clade, gene) '
+        'WHERE runtime > 0'
+    ).fetchall()
+
+
+def model_starts(connection):
+    '''returns {model: mean number of start points fitted per gene}'''
+    return dict(connection.execute('SELECT model, AVG(starts) FROM best_fits GROUP BY model').fetchall())
+
+
+def write_relax(connection, rows):
+    '''replaces the RELAX results of every (clade, gene, p, K, LR, null_lnL, alt_lnL, json_file)
+       row in a single transaction'''
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO relax (clade, gene, p, K, LR, null_lnL, alt_lnL, json_file) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(clade, gene, *(_real(value) for value in values), json_file)
+             for clade, gene, *values, json_file in rows]
+        )
+
+
+def best_fits(connection):
+    '''returns (clade, gene, model, lnL, converged) of the best start point of every model, in the order stored'''
+    return connection.execute('SELECT clade, gene, model, lnL, converged FROM best_fits ORDER BY id').fetchall()
+
+
+def export_rows(connection):
+    '''yields the best fit of every model as a row of the old per-model CSVs:
+       clade, gene, start spec, lnL, parameters..., start points, converged'''
+    fits = connection.execute(
+        'SELECT id, clade, gene, start_spec, lnL, starts, converged FROM best_fits ORDER BY id'
+    ).fetchall()
+    parameters = connection.execute(
+        'SELECT fit_id, value FROM best_parameters ORDER BY fit_id, position'
+    ).fetchall()
+    values = {fit_id: [value for _, value in group] for fit_id, group in groupby(parameters, key=lambda p: p[0])}
+    for fit_id, clade, gene, start_spec, lnL, starts, converged in fits:
+        yield [clade, gene, start_spec, lnL, *values.get(fit_id, []), starts, bool(converged)]
+
+
+@app.command()
+def info(
+    db_file: Path = typer.Argument(..., help="Path to the results database")
+):
+    """Show how many clades, genes, fits and RELAX results are stored."""
+    connection = connect(db_file)
+    clades, genes, fits, unconverged = connection.execute(
+        "SELECT COUNT(DISTINCT clade), COUNT(DISTINCT clade || '/' || gene), COUNT(*), "
+        "SUM(converged = 0) FROM best_fits"
+    ).fetchone()
+    total = connection.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+    relax = connection.execute('SELECT COUNT(*) FROM relax').fetchone()[0]
+    connection.close()
+    typer.echo(f"{clades} clades, {genes} clade/gene combinations, {fits} models from {total} start points")
+    typer.echo(f"{unconverged or 0} models whose start points never agreed")
+    typer.echo(f"{relax} RELAX results")
+
+
+@app.command()
+def export(
+    db_file: Path = typer.Argument(..., help="Path to the results database"),
+    out_file: Path = typer.Argument(..., help="Path to the CSV file to write")
+):
+    """Write the best fit of every model as comma-separated rows, as the per-model CSVs had them."""
+    connection = connect(db_file)
+    with out_file.open('w') as out:
+        for row in export_rows(connection):
+            out.write(','.join(f"{value}" for value in row) + '\n')
+    connection.close()
+    typer.echo(f"Results written to {out_file}")
+
+
+if __name__ == "__main__":
+    app()
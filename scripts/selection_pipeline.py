@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Single entry point for every step of the pipeline.
+
+`python scripts/selection_pipeline.py <step> [arguments]` runs the same
+command as `python scripts/<step script> [arguments]`. Only the script of the
+step being run is imported, so `--help` and light steps such as `manifest`
+don't pay for importing Biopython, ete3 or scipy.
+
+`batch` runs many steps in one process. It reads one task per line from
+files or stdin, each a step and its arguments as on the command line
+(quoted as in a shell; blank lines and lines starting with # are skipped):
+
+    filter alignments/A/atpB.fasta lists/taxa/taxa_A.txt alignments/A/atpB_filtered.fasta
+    manifest remove alignments/A/atpB.fasta
+    manifest add alignments/A/atpB_filtered.fasta
+
+Each step script is imported once per batch, so a worker running hundreds
+of small tasks pays for the imports once instead of once per task.
+"""
+
+from pathlib import Path  # Manipulating filenames
+from typing import List, Optional  # Several task files
+import importlib.util  # Importing step scripts by path
+import os  # Restoring the working directory between tasks
+import shlex  # Splitting task lines
+import sys  # Task lines from stdin, and finding the step scripts' modules
+import time  # Timing tasks
+import typer  # CLI argument handler
+from instrument import phase  # Timing records
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# step name -> (script in scripts/, its typer app or command function, help)
+STEPS = {
+    'filter': ('0a_filter-species.py', 'main', "Filter alignments to the taxa of one or more lineages"),
+    'prune-tree': ('0b_prune-tree.py', 'main', "Prune the master tree to the taxa of one or more lineages"),
+    'preprocess': ('1_preprocess.py', 'main', "Filter, trim and check alignments in a single pass"),
+    'trim-stops': ('1_trim-terminal-stops.py', 'main', "Trim terminal stop codons"),
+    'check-frame': ('1a_check-frame.py', 'check_frame', "Check the reading frame of alignments"),
+    'concatenate': ('1b_alignment_concatenator.py', 'main', "Concatenate alignments by gene group"),
+    'paml-prep': ('1c_paml_prep.py', 'main', "Stage the PAML directory of a lineage"),
+    'paml': ('2a_paml.py', 'app', "Fit the codeml models of a test"),
+    'paml-stats': ('3b_paml_stats.py', 'main', "Likelihood ratio tests of the fitted models"),
+    'relax-tree': ('relax/2c_make_relax_tree.py', 'main', "Label the foreground branches of RELAX trees"),
+    'relax-bf': ('relax/2b_make_bf.py', 'main', "Write the HyPhy batch files that run RELAX"),
+    'relax': ('relax/2d_relax.py', 'main', "Run HyPhy RELAX on every gene"),
+    'relax-results': ('relax/3c_retrieve_relax_results.py', 'main', "Collect the RELAX results into one table"),
+    'manifest': ('manifest.py', 'app', "Index of alignments"),
+    'stage-store': ('stage_store.py', 'app', "Store of preprocessed alignments"),
+    'fit-cache': ('fit_cache.py', 'app', "Cache of codeml fits"),
+    'tree-cache': ('tree_cache.py', 'app', "Cache of pruned trees"),
+    'results-db': ('results_db.py', 'app', "Results database"),
+    'codeml-parse': ('codeml_parser.py', 'main', "Print the record of a codeml fit directory"),
+    'codeml-run': ('codeml_driver.py', 'main', "Run codeml in prepared fit directories"),
+    'fit-queue': ('fit_queue.py', 'app', "Shared work queue of codeml fits"),
+    'cost-model': ('cost_model.py', 'app', "Predicted codeml runtimes of genes"),
+    'trace': ('instrument.py', 'app', "Timing and memory records"),
+}
+
+_commands = {}
+
+
+def load_step(step):
+    '''returns the command of a step, importing its script the first time'''
+    if step not in _commands:
+        script, attribute, _ = STEPS[step]
+        if str(SCRIPTS_DIR) not in sys.path:
+            sys.path.insert(0, str(SCRIPTS_DIR))
+        module_name = 'step_' + step.replace('-', '_')
+        spec = importlib.util.spec_from_file_location(module_name, SCRIPTS_DIR / script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module  # so process pools can pickle the step's functions
+        spec.loader.exec_module(module)
+        target = getattr(module, attribute)
+        if not isinstance(target, typer.Typer):
+            target = typer.Typer()
+            target.command()(getattr(module, attribute))
+        _commands[step] = typer.main.get_command(target)
+    return _commands[step]
+
+
+def run_step(step, args):
+    '''runs a step with command line arguments in this process, as its script would;
+       returns its exit code'''
+    try:
+        load_step(step).main(args=list(args), prog_name=f"selection_pipeline.py {step}")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        typer.echo(e.code, err=True)
+        return 1
+    return 0
+
+
+def read_tasks(task_files):
+    '''yields (line number, step, arguments) of every task in the task files, or in stdin'''
+    sources = task_files or [Path('-')]
+    for task_file in sources:
+        handle = sys.stdin if str(task_file) == '-' else open(task_file, 'r')
+        try:
+            for number, line in enumerate(handle, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                step, *args = shlex.split(line)
+                yield f"{task_file}:{number}", step, args
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+
+
+app = typer.Typer()
+
+
+def _add_step(step, step_help):
+    '''adds a subcommand that hands its arguments, --help included, to the step'''
+    @app.command(name=step, help=step_help, add_help_option=False,
+                 context_settings={'allow_extra_args': True, 'ignore_unknown_options': True})
+    def run(ctx: typer.Context):
+        raise typer.Exit(code=run_step(step, ctx.args))
+
+
+for _step, (_, _, _step_help) in STEPS.items():
+    _add_step(_step, _step_help)
+
+
+@app.callback()
+def cli():
+    """Run any step of the selection pipeline."""
+
+
+@app.command()
+def batch(
+    task_files: Optional[List[Path]] = typer.Argument(None, help="Files of tasks, one per line; '-' or none reads stdin"),
+    keep_going: bool = typer.Option(False, help="Run the remaining tasks after one fails"),
+    quiet: bool = typer.Option(False, help="Only report failed tasks")
+):
+    """Run many steps in this process, one task per line."""
+    cwd = os.getcwd()
+    started = time.perf_counter()
+    done, failed = 0, []
+    for location, step, args in read_tasks(task_files):
+        if step not in STEPS:
+            typer.echo(f"Error: {location}: unknown step {step}", err=True)
+            failed.append(location)
+            if not keep_going:
+                break
+            continue
+        if not quiet:
+            typer.echo(f"[{location}] {step} {shlex.join(args)}")
+        try:
+            with phase('task', step=step):
+                code = run_step(step, args)
+        except Exception as e:
+            typer.echo(f"Error: {location}: {step} failed: {e!r}", err=True)
+            code = 1
+        finally:
+            os.chdir(cwd)  # a step may change directory
+        if code:
+            failed.append(location)
+            if not keep_going:
+                break
+        else:
+            done += 1
+    typer.echo(f"{done} tasks done, {len(failed)} failed in {time.perf_counter() - started:.1f} s",
+               err=bool(failed))
+    if failed:
+        typer.echo(f"Failed tasks: {', '.join(failed)}", err=True)
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
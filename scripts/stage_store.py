@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Content-addressed store of preprocessed alignments.
+
+Each stage output is stored under a key hashed from the stage name, the
+input alignment's contents and the stage parameters (taxa list, trimming
+options, ...). A stage whose key is already stored is skipped and its output
+is copied from the store. Outputs are only rewritten when their contents
+change, so unchanged alignments keep their modification times when the
+outputs are left in place (Snakemake removes a job's outputs before running
+it), and the fit cache reuses the codeml fits of alignments whose contents
+are unchanged. Run this file directly to see how much is stored or to clear
+the store.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import hashlib  # Store keys
+import json  # Store keys and stage metadata
+import os  # Atomic writes
+import shutil  # Copying outputs out of the store
+import typer  # CLI argument handler
+from fit_cache import file_digest  # Hashing inputs and outputs
+
+app = typer.Typer()
+
+
+def stage_key(stage, input_digest, params):
+    '''returns the store key of a stage run on an input with the given parameters'''
+    parts = {'stage': stage, 'input': input_digest, 'params': params}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def materialize(stored_file, out_file):
+    '''copies a stored output to out_file unless out_file already has the same contents.
+       Returns True if out_file was written.'''
+    out_file = Path(out_file)
+    if (out_file.is_file() and out_file.stat().st_size == Path(stored_file).stat().st_size
+            and file_digest(out_file) == file_digest(stored_file)):
+        return False
+    tmp_file = out_file.with_name(f"{out_file.name}.{os.getpid()}.tmp")
+    shutil.copyfile(stored_file, tmp_file)
+    os.replace(tmp_file, out_file)
+    return True
+
+
+class StageStore:
+    """directory of stage outputs and their metadata, two-level fan-out by key prefix"""
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+
+    def output_path(self, key, suffix='.fasta'):
+        '''returns where the output of a stage run is stored'''
+        return self.store_dir / key[:2] / f"{key}{suffix}"
+
+    def get(self, key):
+        '''returns the metadata of a stored stage run, or None if it hasn't been stored.
+           metadata['output'] is False for runs that produced no output'''
+        try:
+            with self.output_path(key, '.json').open('r') as handle:
+                metadata = json.load(handle)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if metadata.get('output') and not self.output_path(key).is_file():
+            return None
+        return metadata
+
+    def put(self, key, output_file, metadata):
+        '''stores the output of a stage run (or None if it produced none) and its metadata.
+           The metadata is written last, so an interrupted put is never read back.'''
+        metadata = dict(metadata, output=output_file is not None)
+        path = self.output_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if output_file is not None:
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            shutil.copyfile(output_file, tmp_path)
+            os.replace(tmp_path, path)
+        metadata_path = self.output_path(key, '.json')
+        tmp_path = metadata_path.with_name(f"{metadata_path.name}.{os.getpid()}.tmp")
+        with tmp_path.open('w') as handle:
+            json.dump(metadata, handle)
+        os.replace(tmp_path, metadata_path)
+
+    def entries(self):
+        '''returns the paths of all stored files'''
+        return sorted(path for path in self.store_dir.glob('*/*') if not path.name.endswith('.tmp'))
+
+
+@app.command()
+def info(
+    store_dir: Path = typer.Argument(..., help="Path to the stage store directory")
+):
+    """Show the number of stored stage runs and their total size."""
+    entries = StageStore(store_dir).entries()
+    runs = sum(1 for path in entries if path.suffix == '.json')
+    total = sum(path.stat().st_size for path in entries)
+    typer.echo(f"{runs} stored stage runs, {total / 1e6:.1f} MB in {store_dir}")
+
+
+@app.command()
+def clear(
+    store_dir: Path = typer.Argument(..., help="Path to the stage store directory")
+):
+    """Remove every stored stage run."""
+    entries = StageStore(store_dir).entries()
+    for path in entries:
+        path.unlink(missing_ok=True)
+    typer.echo(f"Removed {len(entries)} stored files from {store_dir}")
+
+
+if __name__ == "__main__":
+    app()
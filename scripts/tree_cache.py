@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Cache of pruned trees.
+
+Pruning a tree only depends on the tree and the taxa it is pruned down to,
+and many genes of a lineage lack exactly the same taxa. Pruned, unrooted
+Newick trees are stored keyed by a hash of the source tree file and the
+sorted taxon set, so 0b_prune-tree.py and 2a_paml.py only prune a tree to a
+given set of taxa once; after that it is a file lookup. Run this file
+directly to see how many trees are cached or to clear the cache.
+"""
+
+from pathlib import Path  # Manipulating filenames
+import hashlib  # Cache keys
+import json  # Cache keys
+import os  # Atomic writes
+from ete3 import Tree  # Pruning trees
+import typer  # CLI argument handler
+from fit_cache import file_digest  # Hashing the source tree
+
+app = typer.Typer()
+
+
+def tree_key(tree_digest, taxa):
+    '''returns the cache key of a tree pruned down to a set of taxa'''
+    parts = {'tree': tree_digest, 'taxa': sorted(set(taxa))}
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def prune_tree(tree, taxa):
+    '''returns an unrooted copy of a tree pruned down to taxa, keeping branch lengths'''
+    pruned = tree.copy()
+    pruned.prune(list(taxa), preserve_branch_length=True)
+    pruned.unroot()
+    return pruned
+
+
+class TreeCache:
+    """directory of pruned Newick trees, two-level fan-out by key prefix"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.tre"
+
+    def get(self, key):
+        '''returns the cached Newick string for a key, or None'''
+        try:
+            return self._path(key).read_text()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, newick):
+        '''stores a Newick string, replacing the file atomically so concurrent jobs never see partial writes'''
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(newick)
+        os.replace(tmp_path, path)
+
+    def entries(self):
+        '''returns the paths of all cached trees'''
+        return sorted(self.cache_dir.glob('*/*.tre'))
+
+
+def pruned_newick(tree_file, taxa, cache=None, tree=None, tree_digest=None):
+    '''
+    Prune a tree file down to a set of taxa, looking the result up in a cache first.
+
+    Args:
+        tree_file (str): Path to the source tree in Newick format.
+        taxa (iterable): Names of the taxa to keep.
+        cache (TreeCache): Cache to look the pruned tree up in and add it to, or None.
+        tree (Tree): The parsed source tree, for callers that prune it more than once.
+        tree_digest (str): file_digest of tree_file, for callers that prune it more than once.
+
+    Returns:
+        str: The pruned, unrooted tree in Newick format.
+    '''
+    key = None
+    if cache is not None:
+        key = tree_key(tree_digest or file_digest(tree_file), taxa)
+        newick = cache.get(key)
+        if newick is not None:
+            return newick
+
+    if tree is None:
+        tree = Tree(str(tree_file))
+    newick = prune_tree(tree, taxa).write()
+    if cache is not None:
+        cache.put(key, newick)
+    return newick
+
+
+@app.command()
+def info(
+    cache_dir: Path = typer.Argument(..., help="Path to the tree cache directory")
+):
+    """Show the number of cached trees and their total size."""
+    entries = TreeCache(cache_dir).entries()
+    total = sum(path.stat().st_size for path in entries)
+    typer.echo(f"{len(entries)} cached trees, {total / 1e6:.1f} MB in {cache_dir}")
+
+
+@app.command()
+def clear(
+    cache_dir: Path = typer.Argument(..., help="Path to the tree cache directory")
+):
+    """Remove every cached tree."""
+    entries = TreeCache(cache_dir).entries()
+    for path in entries:
+        path.unlink(missing_ok=True)
+    typer.echo(f"Removed {len(entries)} cached trees from {cache_dir}")
+
+
+if __name__ == "__main__":
+    app()
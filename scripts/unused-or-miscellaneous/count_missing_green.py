@@ -1,18 +1,20 @@
-from Bio import AlignIO
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alignment_matrix import AlignmentMatrix
 
 missing = {}
 
 for alignment in [s for s in os.listdir(os.getcwd()) if s.endswith(".fasta")]:
     gene = alignment.split("_")[0]
 
-    # loop through all of the records
-    for record in AlignIO.read(alignment, "fasta"):
-        if(str(record.seq) == '-'*len(record.seq)): # if it's just gaps
-            if(record.name not in missing):
-                missing[record.name] = [gene]
-            else:
-                missing[record.name].append(gene)
+    # loop through all of the records that are just gaps or N's
+    for taxon in AlignmentMatrix.read(alignment, "fasta").empty_ids():
+        if(taxon not in missing):
+            missing[taxon] = [gene]
+        else:
+            missing[taxon].append(gene)
 
 
 
@@ -0,0 +1,42 @@
+"""Shared fixtures: the pipeline's scripts on the import path, and the fake
+codeml and hyphy of benchmarks/fake_bin on the PATH of the scripts run."""
+
+from pathlib import Path  # Manipulating filenames
+import sys  # Import path
+import pytest  # Fixtures
+
+REPO = Path(__file__).resolve().parents[1]
+SCRIPTS = REPO / 'scripts'
+sys.path.insert(0, str(SCRIPTS))
+sys.path.insert(0, str(REPO / 'benchmarks'))
+
+from run_benchmarks import FAKE_BIN, fake_binaries  # noqa: E402  Fake codeml and hyphy
+
+FAKE_CODEML = FAKE_BIN / 'codeml'
+
+CODONS = ['ATG', 'GCT', 'TTA', 'CGA', 'AAA', 'GGG', 'CCC', 'TGG']
+
+
+@pytest.fixture
+def fake_env(tmp_path):
+    '''environment whose PATH finds the fake codeml, hyphy and ete3 first'''
+    return fake_binaries(tmp_path / 'bin')
+
+
+def write_alignment(path, taxa, codons=10):
+    '''writes a FASTA codon alignment of the taxa, with a different sequence for each'''
+    with open(path, 'w') as fasta:
+        for i, taxon in enumerate(taxa):
+            fasta.write(f">{taxon}\n" + ''.join(CODONS[(i * 3 + j) % len(CODONS)] for j in range(codons)) + "\n")
+
+
+@pytest.fixture
+def paml_group(tmp_path):
+    '''a paml/L1/grp directory as the run_paml rule stages it, with six taxa in three pairs
+       around the root and A and C as the test taxa, so the induced foreground reaches the root'''
+    group = tmp_path / 'paml' / 'L1' / 'grp'
+    group.mkdir(parents=True)
+    write_alignment(group / 'grp_L1.fasta', 'ABCDEF')
+    (group.parent / 'tree_L1.tre').write_text('((A,B),(C,D),(E,F));\n')
+    (group.parent / 'test_taxa_L1.txt').write_text('A\nC\n')
+    return group
@@ -0,0 +1,99 @@
+"""1_preprocess.py run on small source alignments, with and without the stage store."""
+
+import json  # Reading traces
+import os  # Environment of the script
+import subprocess  # Running the script
+import sys  # The Python interpreter to run it with
+from conftest import SCRIPTS, write_alignment  # Script locations and test alignments
+
+
+def run_preprocess(project, *alignments, options=(), trace_file=None):
+    '''runs 1_preprocess.py for lineage L1 of a project and returns the finished process'''
+    env = dict(os.environ, SELECTION_PIPELINE_TRACE=str(trace_file)) if trace_file else None
+    finished = subprocess.run([sys.executable, str(SCRIPTS / '1_preprocess.py'), *alignments,
+                               '--taxa', 'lists/taxa/taxa_L1.txt', '--out-dir', 'alignments/L1', *options],
+                              cwd=project, env=env, capture_output=True, text=True)
+    assert finished.returncode == 0, finished.stdout + finished.stderr
+    return finished
+
+
+def make_project(tmp_path):
+    '''a project with atpA and accD source alignments, accD having none of L1's taxa'''
+    (tmp_path / 'original_files').mkdir()
+    (tmp_path / 'lists' / 'taxa').mkdir(parents=True)
+    write_alignment(tmp_path / 'original_files' / 'atpA.fasta', 'ABCD')
+    write_alignment(tmp_path / 'original_files' / 'accD.fasta', 'CD')
+    (tmp_path / 'lists' / 'taxa' / 'taxa_L1.txt').write_text('A\nB\n')
+    return tmp_path
+
+
+def test_alignment_without_the_lineage_taxa_is_skipped(tmp_path):
+    project = make_project(tmp_path)
+    finished = run_preprocess(project, 'original_files/atpA.fasta', 'original_files/accD.fasta')
+    assert "Warning: No matching records found in original_files/accD.fasta" in finished.stdout
+    assert (project / 'alignments' / 'L1' / 'atpA_L1_gaps_trimmed.fasta').is_file()
+    assert not (project / 'alignments' / 'L1' / 'accD_L1_gaps_trimmed.fasta').exists()
+    assert (project / 'alignments' / 'L1' / 'issues.txt').is_file()
+
+
+def processed(trace_file):
+    '''returns how many alignments a traced run preprocessed rather than took from the store'''
+    records = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    return sum(1 for record in records if record['kind'] == 'phase' and record['name'] == 'preprocess')
+
+
+def mtimes(project):
+    return {path.name: path.stat().st_mtime_ns for path in (project / 'alignments' / 'L1').glob('*.fasta')}
+
+
+def stored_runs(project):
+    return len(list((project / '.stage_store').glob('*/*.json')))
+
+
+def test_stage_store_only_processes_changed_alignments(tmp_path):
+    project = make_project(tmp_path)
+    write_alignment(project / 'original_files' / 'atpB.fasta', 'ABD', codons=12)
+    sources = ['original_files/atpA.fasta', 'original_files/atpB.fasta', 'original_files/accD.fasta']
+    options = ('--store', '.stage_store')
+
+    run_preprocess(project, *sources, options=options, trace_file=tmp_path / 'first.jsonl')
+    assert processed(tmp_path / 'first.jsonl') == 3
+    assert stored_runs(project) == 3  # accD is stored as having no output
+    written = mtimes(project)
+    assert set(written) == {'atpA_L1_gaps_trimmed.fasta', 'atpB_L1_gaps_trimmed.fasta'}
+
+    # Nothing changed: every alignment comes from the store and no output is rewritten
+    finished = run_preprocess(project, *sources, options=options, trace_file=tmp_path / 'unchanged.jsonl')
+    assert processed(tmp_path / 'unchanged.jsonl') == 0
+    assert finished.stdout.count('unchanged') == 2
+    assert mtimes(project) == written
+    assert stored_runs(project) == 3
+
+    # A changed source alignment has a new key, and only its output is rewritten
+    source = project / 'original_files' / 'atpB.fasta'
+    source.write_text(source.read_text().replace('ATG', 'ATC', 1))
+    run_preprocess(project, *sources, options=options, trace_file=tmp_path / 'source.jsonl')
+    assert processed(tmp_path / 'source.jsonl') == 1
+    assert stored_runs(project) == 4
+    after_source = mtimes(project)
+    assert after_source['atpA_L1_gaps_trimmed.fasta'] == written['atpA_L1_gaps_trimmed.fasta']
+    assert after_source['atpB_L1_gaps_trimmed.fasta'] != written['atpB_L1_gaps_trimmed.fasta']
+    assert 'ATC' in (project / 'alignments' / 'L1' / 'atpB_L1_gaps_trimmed.fasta').read_text()
+
+    # A changed taxa list changes the key of every alignment. Reordering it doesn't change
+    # the outputs, which keep the taxa in alignment order, so none is rewritten
+    (project / 'lists' / 'taxa' / 'taxa_L1.txt').write_text('B\nA\n')
+    run_preprocess(project, *sources, options=options, trace_file=tmp_path / 'reordered.jsonl')
+    assert processed(tmp_path / 'reordered.jsonl') == 3
+    assert stored_runs(project) == 7
+    assert mtimes(project) == after_source
+
+    # Adding D gives atpA and atpB a new record, so both outputs are rewritten, and accD now has an output
+    (project / 'lists' / 'taxa' / 'taxa_L1.txt').write_text('B\nA\nD\n')
+    run_preprocess(project, *sources, options=options, trace_file=tmp_path / 'taxa.jsonl')
+    assert processed(tmp_path / 'taxa.jsonl') == 3
+    assert stored_runs(project) == 10
+    after_taxa = mtimes(project)
+    assert set(after_taxa) == set(after_source) | {'accD_L1_gaps_trimmed.fasta'}
+    assert all(after_taxa[name] != after_source[name] for name in after_source)
+    assert '>D' in (project / 'alignments' / 'L1' / 'atpA_L1_gaps_trimmed.fasta').read_text()
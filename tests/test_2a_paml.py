@@ -0,0 +1,69 @@
+"""2a_paml.py run end to end on the fake codeml."""
+
+from contextlib import closing  # Closing database connections
+import sqlite3  # Reading the results database
+import subprocess  # Running the script
+import sys  # The Python interpreter to run it with
+from conftest import FAKE_CODEML, SCRIPTS  # The fake codeml and script locations
+
+
+def run_paml(group, env, *options, test='branch'):
+    '''runs 2a_paml.py in a staged gene group directory and returns the finished process'''
+    return subprocess.run([sys.executable, str(SCRIPTS / '2a_paml.py'), 'grp_L1.fasta', '../tree_L1.tre', test,
+                           '../test_taxa_L1.txt', '--workdir', '../scratch', '--db', '../results.sqlite', *options],
+                          cwd=group, env=env, capture_output=True, text=True)
+
+
+def best_parameters(db_file):
+    '''returns {(clade, model, parameter): value} of the best fits in a results database'''
+    with closing(sqlite3.connect(db_file)) as connection:
+        rows = connection.execute('SELECT clade, model, name, value FROM best_parameters').fetchall()
+    return {(clade, model, name): value for clade, model, name, value in rows}
+
+
+def test_b_free_with_foreground_reaching_the_root(paml_group, fake_env):
+    finished = run_paml(paml_group, fake_env)
+    assert finished.returncode == 0, finished.stderr
+    parameters = best_parameters(paml_group.parent / 'results.sqlite')
+    assert parameters[('L1', 'b_free', 'background_w')] is not None
+    assert parameters[('L1', 'M0', 'w')] is not None
+
+
+def test_b_free_reports_a_foreground_branch_below_the_root(paml_group, fake_env):
+    finished = run_paml(paml_group, fake_env)
+    assert finished.returncode == 0, finished.stderr
+    parameters = best_parameters(paml_group.parent / 'results.sqlite')
+    # The fake codeml triples w on the marked branches under the branch model
+    assert parameters[('L1', 'b_free', 'foreground_w')] > parameters[('L1', 'b_free', 'background_w')]
+
+
+def journal_mode(db_file):
+    with closing(sqlite3.connect(db_file)) as connection:
+        return connection.execute('PRAGMA journal_mode').fetchone()[0]
+
+
+def test_results_database_uses_a_rollback_journal_with_a_queue(paml_group, fake_env, tmp_path):
+    finished = run_paml(paml_group, fake_env)
+    assert finished.returncode == 0, finished.stderr
+    assert journal_mode(paml_group.parent / 'results.sqlite') == 'wal'
+
+    worker = subprocess.Popen([sys.executable, str(SCRIPTS / 'fit_queue.py'), 'worker', str(tmp_path / 'queue'),
+                               '--codeml', str(FAKE_CODEML), '--poll', '0.1', '--idle-exit', '0.05'],
+                              stdout=subprocess.DEVNULL)
+    finished = run_paml(paml_group, fake_env, '--queue', str(tmp_path / 'queue'))
+    worker.wait(30)
+    assert finished.returncode == 0, finished.stderr
+    assert journal_mode(paml_group.parent / 'results.sqlite') == 'delete'
+
+
+def test_retried_fit_is_found_in_the_cache_on_a_rerun(paml_group, fake_env):
+    # Every start point from omega 0.7 hangs until it is killed and retried from a perturbed one
+    env = dict(fake_env, FAKE_CODEML_HANG_OMEGAS='0.7')
+    options = ('--cache-dir', '../cache', '--timeout', '0.02', '--retries', '1')
+    finished = run_paml(paml_group, env, *options)
+    assert finished.returncode == 0, finished.stderr
+    assert 'was retried 1 times' in finished.stdout
+    finished = run_paml(paml_group, env, *options)
+    assert finished.returncode == 0, finished.stderr
+    assert 'Fitting' not in finished.stdout
+    assert 'Using the cached fit' in finished.stdout
@@ -0,0 +1,14 @@
+"""Likelihood ratio statistics of 3b_paml_stats.py."""
+
+import importlib  # Script names aren't identifiers
+import numpy as np  # Columns of results
+
+paml_stats = importlib.import_module('3b_paml_stats')
+
+
+def test_likelihood_ratios_clamp_worse_alternatives_to_zero():
+    lnL = np.array([[[-100.0, -98.0]], [[-100.0, -101.0]], [[np.nan, -100.0]]])
+    ratios = paml_stats.likelihood_ratios(lnL)
+    assert ratios[0, 0] == 4.0
+    assert ratios[1, 0] == 0.0
+    assert np.isnan(ratios[2, 0])
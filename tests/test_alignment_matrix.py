@@ -0,0 +1,28 @@
+"""Duplicate ids in AlignmentMatrix and the filter steps."""
+
+import importlib  # Script names aren't identifiers
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from conftest import write_alignment  # Test alignments
+
+filter_species = importlib.import_module('0a_filter-species')
+
+
+def test_duplicate_ids_are_accepted_and_resolve_to_the_first_record():
+    alignment = AlignmentMatrix.from_strings(['A', 'B', 'A'], ['AAA', 'CCC', 'GGG'])
+    assert alignment.duplicate_ids() == ['A']
+    assert alignment.sequence('A') == 'AAA'
+
+
+def test_filter_keeps_the_first_record_of_a_duplicated_id(tmp_path, capsys):
+    source = tmp_path / 'gene.fasta'
+    write_alignment(source, 'ABC')
+    with open(source, 'a') as fasta:
+        fasta.write('>A\n' + 'TTT' * 10 + '\n')
+    out_path = tmp_path / 'L1' / 'gene_filtered.fasta'
+    failed = filter_species.filter_alignment(source, {'L1': ['A', 'C', 'D']}, {'L1': out_path})
+    assert failed == []
+    assert 'several records for A' in capsys.readouterr().out
+    filtered = AlignmentMatrix.read(out_path)
+    assert filtered.ids == ['A', 'C', 'D']
+    assert filtered.sequence('A') == AlignmentMatrix.read(source).sequence('A')
+    assert filtered.empty_ids() == ['D']
@@ -0,0 +1,28 @@
+"""The benchmark run end to end on a small synthetic project with the fake codeml and hyphy."""
+
+import json  # Reading the results
+import shutil  # Finding snakemake
+import subprocess  # Running the benchmark
+import sys  # The Python interpreter to run it with
+from conftest import REPO  # Repository location
+
+
+def test_every_stage_runs_without_failures(tmp_path):
+    out_file = tmp_path / 'results.json'
+    finished = subprocess.run([sys.executable, str(REPO / 'benchmarks' / 'run_benchmarks.py'), 'run',
+                               '--out', str(out_file), '--work-dir', str(tmp_path / 'work'), '--taxa', '10',
+                               '--genes', '3', '--lineages', '2', '--sites', '40', '--paml-groups', '2',
+                               '--repeat', '2'],
+                              capture_output=True, text=True)
+    assert finished.returncode == 0, finished.stdout + finished.stderr
+    results = {result['name']: result for result in json.loads(out_file.read_text())['benchmarks']}
+    assert all(result['failed_calls'] == 0 for result in results.values())
+    for name in ('0a_filter-species', '1_trim-terminal-stops', '1_preprocess', '2a_paml',
+                 'relax/2d_relax (fake hyphy)'):
+        assert results[name]['calls'] > 0, name
+    if shutil.which('snakemake') is not None:
+        assert 'snakemake DAG (processed project)' in results
+    # Each repeat trims fresh copies of the filtered alignments, as the script deletes its input
+    trimmed = sorted((tmp_path / 'work' / 'project' / 'stops_trimmed').glob('*/*_stops_trimmed.fasta'))
+    assert len(trimmed) == results['1_trim-terminal-stops']['calls']
+    assert not list((tmp_path / 'work' / 'project' / 'stops_trimmed').glob('*/*_filtered.fasta'))
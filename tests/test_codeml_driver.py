@@ -0,0 +1,67 @@
+"""codeml_driver.py run on the fake codeml."""
+
+import os  # Making the wrapper executable
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from codeml_driver import CodemlFit, paml_alignment, run_fits  # Running codeml
+from conftest import FAKE_CODEML, write_alignment  # The fake codeml and test alignments
+from test_2a_paml import run_paml  # Running 2a_paml.py
+
+TREE = '((A,B) #1,(C,D),(E,F));'
+
+
+def alignment_text(tmp_path):
+    '''returns a six taxon alignment in PAML format'''
+    write_alignment(tmp_path / 'algn.fasta', 'ABCDEF')
+    alignment = AlignmentMatrix.read(tmp_path / 'algn.fasta')
+    return paml_alignment(alignment, alignment.ids)
+
+
+def test_timed_out_fit_is_killed_and_retried_from_a_perturbed_start(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_CODEML_HANG_OMEGAS', '0.7')
+    fits = [CodemlFit('b_free.bl_0.7w', 'b_free', {'fix_blength': 1, 'omega': 0.7})]
+    [outcome] = run_fits(fits, str(FAKE_CODEML), tmp_path / 'work', alignment_text(tmp_path), TREE,
+                         timeout=1, retries=2)
+    assert outcome.status == 'done'
+    assert outcome.attempts == 2
+    assert outcome.options['omega'] != 0.7
+    assert outcome.options['fix_blength'] == -1
+    assert f"omega = {outcome.options['omega']}" in (tmp_path / 'work' / 'b_free.bl_0.7w' / 'tmp.ctl').read_text()
+
+
+def test_fit_that_never_finishes_times_out_after_every_retry(tmp_path, monkeypatch):
+    # bsA1 fixes omega, so its retries start from the omega the fake codeml hangs on too
+    monkeypatch.setenv('FAKE_CODEML_HANG_OMEGAS', '1.0')
+    fits = [CodemlFit('bsA1.bl_1.0w', 'bsA1', {'fix_blength': 1, 'omega': 1.0})]
+    [outcome] = run_fits(fits, str(FAKE_CODEML), tmp_path / 'work', alignment_text(tmp_path), TREE,
+                         timeout=0.5, retries=1)
+    assert outcome.status == 'timeout'
+    assert outcome.attempts == 2
+
+
+def test_no_more_than_jobs_fits_run_at_once(tmp_path, monkeypatch):
+    # A codeml that records how many runs are under way as it starts
+    running = tmp_path / 'running'
+    running.mkdir()
+    wrapper = tmp_path / 'codeml'
+    wrapper.write_text(f'#!/bin/sh\ntouch "{running}/$$"\nls "{running}" | wc -l >> "{tmp_path}/counts"\n'
+                       f'"{FAKE_CODEML}" "$@"\nstatus=$?\nrm "{running}/$$"\nexit $status\n')
+    os.chmod(wrapper, 0o755)
+    monkeypatch.setenv('FAKE_CODEML_SLEEP', '0.3')
+    fits = [CodemlFit(f'M0.bl_{omega}w', 'M0', {'fix_blength': 1, 'omega': omega})
+            for omega in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]]
+    outcomes = run_fits(fits, str(wrapper), tmp_path / 'work', alignment_text(tmp_path), TREE, jobs=2)
+    assert [outcome.status for outcome in outcomes] == ['done'] * 6
+    counts = [int(line) for line in (tmp_path / 'counts').read_text().split()]
+    assert len(counts) == 6
+    assert max(counts) == 2
+
+
+def test_xx_is_fitted_as_m2a_rel(paml_group, fake_env):
+    finished = run_paml(paml_group, fake_env, test='cmC')
+    assert finished.returncode == 0, finished.stderr
+    control_files = sorted((paml_group.parent / 'scratch').glob('XX.*/tmp.ctl'))
+    assert control_files
+    for control_file in control_files:
+        options = dict(line.replace(' ', '').split('=') for line in control_file.read_text().splitlines() if '=' in line)
+        assert options['NSsites'] == '22'
+        assert options['ncatG'] == '3'
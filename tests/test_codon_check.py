@@ -0,0 +1,12 @@
+"""Codon checks of codon_check.py."""
+
+from alignment_matrix import AlignmentMatrix  # Shared alignment representation
+from codon_check import find_codon_issues, summarise_issues  # Vectorised codon checks
+
+
+def test_summary_reports_records_out_of_frame():
+    alignment = AlignmentMatrix.from_strings(['A', 'B', 'C'], ['ATGGCTAAA', 'ATG-CTAAA', 'ATGTAAAAA'])
+    lines = summarise_issues(find_codon_issues(alignment, 'gene.fasta'))
+    assert "gene.fasta B is out of frame." in lines
+    assert "gene.fasta contains at least one stop codon in C." in lines
+    assert not any(' A ' in line for line in lines)
@@ -0,0 +1,56 @@
+"""fdr_adjust() against a plain Benjamini-Hochberg correction of each group."""
+
+import numpy as np  # Columns of p-values
+from fdr import fdr_adjust  # The grouped correction
+
+
+def benjamini_hochberg(p):
+    '''Benjamini-Hochberg adjusted p-values of one group, one p-value at a time'''
+    m = len(p)
+    order = sorted(range(m), key=lambda i: p[i])
+    adjusted = [0.0] * m
+    running_min = 1.0
+    for rank in range(m, 0, -1):
+        i = order[rank - 1]
+        running_min = min(running_min, p[i] * m / rank)
+        adjusted[i] = running_min
+    return adjusted
+
+
+def test_adjusted_p_values_match_a_separate_correction_of_each_group():
+    rng = np.random.default_rng(7)
+    groups = np.repeat([3, 0, 5], [1, 7, 20])  # unequal sizes, including a group of one
+    rng.shuffle(groups)
+    p = rng.uniform(0, 1, len(groups)) ** 3
+    p[[2, 11, 19]] = np.nan
+    p[5] = p[6]  # a tie
+
+    adjusted, qvalues = fdr_adjust(p, groups)
+
+    assert np.array_equal(np.isnan(adjusted), np.isnan(p))
+    assert np.array_equal(np.isnan(qvalues), np.isnan(p))
+    for group in np.unique(groups):
+        members = np.flatnonzero((groups == group) & ~np.isnan(p))
+        np.testing.assert_allclose(adjusted[members], benjamini_hochberg(list(p[members])))
+
+
+def test_q_values_scale_adjusted_p_values_by_the_estimated_null_proportion():
+    p = np.array([0.001, 0.01, 0.02, 0.03, 0.04, 0.2, 0.7, 0.9,    # two of eight above lambda
+                  0.6, 0.8, 0.9, 0.01])                           # pi0 would exceed 1
+    groups = np.array([0] * 8 + [1] * 4)
+
+    adjusted, qvalues = fdr_adjust(p, groups, storey_lambda=0.5)
+
+    # pi0 = (#p > lambda + 1) / (m * (1 - lambda)), capped at 1: (2 + 1) / (8 * 0.5) and 1
+    pi0 = np.array([0.75] * 8 + [1.0] * 4)
+    np.testing.assert_allclose(adjusted[:8], [0.008, 0.04, 0.16 / 3, 0.06, 0.064, 0.8 / 3, 0.8, 0.9])
+    np.testing.assert_allclose(qvalues, pi0 * adjusted)
+
+    # A lower lambda counts more tests as null
+    _, qvalues = fdr_adjust(p, groups, storey_lambda=0.1)
+    np.testing.assert_allclose(qvalues[:8], min((3 + 1) / (8 * 0.9), 1) * adjusted[:8])
+
+
+def test_all_nan_p_values_give_nan():
+    adjusted, qvalues = fdr_adjust(np.array([np.nan, np.nan]), np.array([0, 1]))
+    assert np.isnan(adjusted).all() and np.isnan(qvalues).all()
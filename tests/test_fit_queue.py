@@ -0,0 +1,103 @@
+"""fit_queue.py with several worker processes running the fake codeml."""
+
+import os  # Environment of the workers
+import signal  # Killing workers
+import socket  # Worker names
+import subprocess  # Running workers
+import sys  # The Python interpreter to run them with
+import threading  # Running the coordinator beside the workers
+import time  # Waiting for workers
+from codeml_driver import CodemlFit, prepare_fit  # Fits
+from conftest import FAKE_CODEML, SCRIPTS  # The fake codeml and script locations
+from fit_queue import FitQueue  # The queue
+from test_codeml_driver import TREE, alignment_text  # A test alignment and tree
+
+
+def start_worker(queue_dir, sleep=0.0, jobs=2, poll=0.1):
+    '''starts a worker process running the fake codeml, which takes sleep seconds per fit'''
+    env = dict(os.environ, FAKE_CODEML_SLEEP=str(sleep))
+    return subprocess.Popen([sys.executable, str(SCRIPTS / 'fit_queue.py'), 'worker', str(queue_dir), '--jobs', str(jobs),
+                             '--codeml', str(FAKE_CODEML), '--heartbeat', '0.3', '--poll', str(poll), '--idle-exit', '0.05'],
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+def name_of(process):
+    return f"{socket.gethostname()}-{process.pid}"
+
+
+def wait_for(condition, seconds=20):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting"
+        time.sleep(0.05)
+
+
+def fits(n):
+    return [CodemlFit(f"M0.bl_{i}w", 'M0', {'fix_blength': 1, 'omega': 0.1 * (i + 1)}) for i in range(n)]
+
+
+def coordinate(queue, tmp_path, fit_list, outcomes, dead_after=120):
+    '''runs the fits on the queue in a thread, putting their outcomes in outcomes'''
+    text = alignment_text(tmp_path)
+
+    def run():
+        outcomes.extend(queue.run_fits(fit_list, tmp_path / 'work', text, TREE, poll=0.1, dead_after=dead_after))
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_several_workers_run_every_fit_once(tmp_path):
+    queue = FitQueue(tmp_path / 'queue')
+    workers = [start_worker(queue.queue_dir, sleep=0.2) for _ in range(3)]
+    outcomes = []
+    coordinate(queue, tmp_path, fits(9), outcomes).join(60)
+    for worker in workers:
+        worker.wait(30)
+    assert [outcome.status for outcome in outcomes] == ['done'] * 9
+    for fit in fits(9):
+        assert (tmp_path / 'work' / fit.name / 'out').is_file()
+    ran = sum(output.count('done: ') for output in (worker.stdout.read() for worker in workers))
+    assert ran == 9
+    assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 0}
+
+
+def test_fits_of_a_killed_worker_are_run_by_another(tmp_path):
+    queue = FitQueue(tmp_path / 'queue')
+    doomed = start_worker(queue.queue_dir, sleep=30, jobs=4)
+    outcomes = []
+    coordinator = coordinate(queue, tmp_path, fits(4), outcomes, dead_after=1)
+    wait_for(lambda: queue.counts()['claimed'] == 4)
+    doomed.send_signal(signal.SIGKILL)
+    doomed.wait()
+    survivor = start_worker(queue.queue_dir)
+    coordinator.join(60)
+    survivor.wait(30)
+    assert [outcome.status for outcome in outcomes] == ['done'] * 4
+    assert survivor.stdout.read().count('done: ') == 4
+    # The killed worker's codeml runs died with it
+    assert subprocess.run(['pgrep', '-f', f"{FAKE_CODEML} tmp.ctl"], capture_output=True).stdout == b''
+
+
+def test_worker_stops_a_fit_requeued_while_it_runs(tmp_path):
+    queue = FitQueue(tmp_path / 'queue')
+    [fit] = fits(1)
+    fit_dir = tmp_path / 'work' / fit.name
+    prepare_fit(fit_dir, fit.model, fit.options, alignment_text(tmp_path), TREE)
+    task_id = queue.submit({'fit': fit._asdict(), 'fit_dir': str(fit_dir), 'timeout': None, 'retries': 0})
+    # The slow worker looks for new fits too rarely to claim the requeued fit again first
+    slow = start_worker(queue.queue_dir, sleep=30, jobs=1, poll=5)
+    wait_for(lambda: queue.counts()['claimed'] == 1)
+    # As requeue_dead() does when the worker's heartbeat looks stale
+    claim = queue.claimed / f"{task_id}@{name_of(slow)}.json"
+    os.rename(claim, queue.pending / f"{task_id}.json")
+    fast = start_worker(queue.queue_dir)
+    wait_for(lambda: queue.counts()['done'] == 1)
+    outcome = queue.take_outcome(task_id)
+    assert outcome['status'] == 'done'
+    assert outcome['worker'] == name_of(fast)
+    assert (fit_dir / 'out').is_file()
+    slow.wait(30)
+    fast.wait(30)
+    assert f"Stopping {task_id}" in slow.stdout.read()  # its codeml was killed, not left to finish
+    assert not list(fit_dir.glob('.*'))  # both claim directories are gone
@@ -0,0 +1,35 @@
+"""relax/2d_relax.py run on the fake hyphy."""
+
+import subprocess  # Running the script
+import sys  # The Python interpreter to run it with
+from conftest import SCRIPTS, write_alignment  # Script locations and test alignments
+
+
+def relax_gene(tmp_path):
+    '''a relax/L1/atpA directory with an alignment and a batch file naming it'''
+    gene_dir = tmp_path / 'relax' / 'L1' / 'atpA'
+    gene_dir.mkdir(parents=True)
+    write_alignment(gene_dir / 'atpA_L1.fasta', 'ABCD')
+    (gene_dir / 'relax_run.bf').write_text('inputRedirect = {};\ninputRedirect["02"]= "atpA_L1.fasta";\n')
+    return gene_dir
+
+
+def run_relax(tmp_path, env, *options):
+    return subprocess.run([sys.executable, str(SCRIPTS / 'relax' / '2d_relax.py'), str(tmp_path / 'relax'),
+                           '--cpus', '2', *options], env=env, capture_output=True, text=True)
+
+
+def test_relax_writes_the_json_of_every_gene(tmp_path, fake_env):
+    gene_dir = relax_gene(tmp_path)
+    finished = run_relax(tmp_path, fake_env, '--hyphy', 'hyphy')
+    assert finished.returncode == 0, finished.stdout + finished.stderr
+    assert (gene_dir / 'atpA_L1.fasta.RELAX.json').exists()
+
+
+def test_missing_hyphy_fails_the_gene_instead_of_crashing(tmp_path, fake_env):
+    gene_dir = relax_gene(tmp_path)
+    finished = run_relax(tmp_path, fake_env, '--hyphy', str(tmp_path / 'no_hyphy'))
+    assert finished.returncode == 1
+    assert 'Traceback' not in finished.stderr
+    assert '0 done, 0 skipped, 1 failed' in finished.stdout
+    assert 'Could not run' in (gene_dir / 'relax.log').read_text()
@@ -0,0 +1,49 @@
+"""The Snakefile run on a small synthetic project with the fake codeml."""
+
+import collections  # Counting fits
+import json  # Reading the trace
+import shutil  # Finding snakemake
+import subprocess  # Running snakemake
+import pytest  # Skipping without snakemake
+from conftest import REPO, SCRIPTS  # Repository and script locations
+from generate import generate  # Synthetic data
+
+pytestmark = pytest.mark.skipif(shutil.which('snakemake') is None, reason="snakemake is not installed")
+
+
+def snakemake(project, env, *targets):
+    '''runs snakemake in a project and returns the finished process'''
+    finished = subprocess.run(['snakemake', '-j', '4', '--snakefile', str(REPO / 'Snakefile'), *targets],
+                              cwd=project, env=env, capture_output=True, text=True)
+    assert finished.returncode == 0, finished.stdout + finished.stderr
+    return finished
+
+
+def codeml_runs(trace_file):
+    '''returns {alignment: fits run by codeml rather than taken from the fit cache} of a trace'''
+    records = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    return collections.Counter(record['alignment'] for record in records
+                               if record['kind'] == 'fit' and not record['cached'])
+
+
+def test_changed_source_alignment_is_fitted_again(tmp_path, fake_env):
+    project = tmp_path / 'project'
+    generate(project, 10, 3, 2, 40, 0.0, seed=4)
+    (project / 'scripts').symlink_to(SCRIPTS)
+    snakemake(project, fake_env, 'preprocess_all')
+    snakemake(project, fake_env, 'collect_results')
+
+    # Change a codon of a taxon both lineages keep
+    source = project / 'original_files' / 'atpA.fasta'
+    lines = source.read_text().split('\n')
+    taxon = (project / 'lists' / 'taxa' / 'taxa_L1.txt').read_text().split()[0]
+    row = lines.index(f">{taxon}") + 1
+    lines[row] = lines[row][:3] + ('C' if lines[row][3] != 'C' else 'T') + lines[row][4:]
+    source.write_text('\n'.join(lines))
+
+    trace_file = tmp_path / 'trace.jsonl'
+    finished = snakemake(project, dict(fake_env, SELECTION_PIPELINE_TRACE=str(trace_file)), 'collect_results')
+    assert 'paml_prep' in finished.stdout + finished.stderr
+    # Only atpA and its gene group are fitted again; the rest come from the fit cache
+    assert set(codeml_runs(trace_file)) == {'atpA_L1_gaps_trimmed.fasta', 'atpA_L2_gaps_trimmed.fasta',
+                                            'atp_L1_gaps_trimmed.fasta', 'atp_L2_gaps_trimmed.fasta'}